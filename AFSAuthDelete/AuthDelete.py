@@ -1,8 +1,13 @@
 import praw
-import logging
 import time
 import os
-from helper_functions import print_and_log
+import traceback
+from helper_functions import log_debug, print_and_log
+from inbox import (DELETE_COMMAND, READ_BATCH_SIZE, READ_FLUSH_INTERVAL,
+                   SHUTDOWN_COMMAND, STREAM_PAUSE_AFTER, ReadMarker,
+                   get_commands)
+from metrics import METRICS, CountingRequestor
+from reply_journal import ReplyJournal, REPLY_JOURNAL_DB
 
 #get creds from environment variables
 credsUserAgent = os.environ.get("AFS_USERAGENT")
@@ -10,12 +15,15 @@ credsClientID = os.environ.get("AFS_ID")
 credsClientSecret = os.environ.get("AFS_SECRET")
 credsPassword = os.environ.get("AFS_PASSWORD")
 credsUserName = os.environ.get("AFS_USERNAME")
+# messages are marked read in batches, after at most this many seconds
+readFlushInterval = int(os.environ.get("AFS_READ_FLUSH", READ_FLUSH_INTERVAL))
+readBatchSize = int(os.environ.get("AFS_READ_BATCH", READ_BATCH_SIZE))
+# SQLite file AFSCbot records its replies in, shared with it
+replyJournalDB = os.environ.get("AFS_REPLY_JOURNAL", REPLY_JOURNAL_DB)
 
-# Initialize a logging object and have some examples below from the Python
-# Doc page
-logging.basicConfig(filename='AuthDelete.log', level=logging.INFO)
-
-logging.info(time.strftime("%Y/%m/%d %H:%M:%S ") + "Starting script")
+print_and_log("Starting script")
+# Prometheus endpoint and/or metrics file, see AFS_METRICS_PORT/FILE
+METRICS.start()
 
 # Try to login or sleep/wait until logged in, or exit if user/pass wrong
 NotLoggedIn = True
@@ -26,76 +34,105 @@ while NotLoggedIn:
             client_id=credsClientID.strip(),
             client_secret=credsClientSecret.strip(),
             username=credsUserName.strip(),
-            password=credsPassword.strip())
+            password=credsPassword.strip(),
+            requestor_class=CountingRequestor)
         print_and_log("Logged in")
         NotLoggedIn = False
     except praw.errors.InvalidUserPass:
-        print_and_log("Wrong username or password")
-        logging.error(time.strftime("%Y/%m/%d %H:%M:%S ") + "Wrong username or password")
+        print_and_log("Wrong username or password", error=True)
         exit(1)
     except Exception as err:
-        print_and_log(err)
+        print_and_log(str(err), error=True)
         time.sleep(5)
 
 # vars
 globalCount = 0
+readMarker = ReadMarker(reddit.inbox, readFlushInterval, readBatchSize)
+journal = ReplyJournal(replyJournalDB)
 
-logging.info(time.strftime("%Y/%m/%d %H:%M:%S ") +
-             "Starting processing loop for comments")
+print_and_log("Starting processing loop for comments")
 
 while True:
     try:
-        # stream all unread messages from inbox
-        for rAirForceComments in reddit.inbox.stream():
+        # stream all unread messages from inbox, None when it has been quiet
+        for rAirForceComments in METRICS.timed(
+                reddit.inbox.stream(pause_after=STREAM_PAUSE_AFTER),
+                "stream_fetch_seconds"):
+            if rAirForceComments is None:
+                readMarker.flush_if_due()
+                continue
+            #Marks the comment as read, with the next batch. A restarted stream
+            #yields the messages still waiting to be marked read again
+            if not readMarker.add(rAirForceComments):
+                continue
             globalCount += 1
-
-            #Marks the comment as read
-            rAirForceComments.mark_read()
+            METRICS.inc("messages_total")
 
             #print(unread_messages)
-            print_and_log("\nComments processed since start of script: " + str(globalCount))
+            log_debug("Comments processed since start of script: %d",
+                      globalCount)
             print_and_log("Processing comment: " + rAirForceComments.id)
-            print_and_log("Submission: {}".format(str(rAirForceComments.submission)))
-            logging.info(time.strftime("%Y/%m/%d %H:%M:%S ") +
-                         "Processing comment: " + rAirForceComments.id)
+            #Private messages have no submission
+            if isinstance(rAirForceComments, praw.models.Comment):
+                log_debug("Submission: %s", rAirForceComments.submission)
 
             #If, for some odd reason, the bot is the author, ignore it.
             if rAirForceComments.author == "AFSCbot":
                 print_and_log("Author was the bot, skipping...")
                 continue
-            else:
-                #Get the parent comment(the bot) and grandparent(comment originally replied to)
-                parent = rAirForceComments.parent()
-                grandparent = parent.parent()
 
-                formattedComment = rAirForceComments.body
-                formattedComment = formattedComment.lower()
-                formattedComment = formattedComment.replace(' ', '')
+            #Most messages have no command and need nothing from reddit
+            commands = get_commands(rAirForceComments.body)
+            if not commands:
+                continue
+            METRICS.inc("commands_total")
+            #Commands are marked read before acting on them, so a restart
+            #doesn't act twice
+            readMarker.flush()
+
+            #Shutdown bot if mod commands it
+            if SHUTDOWN_COMMAND in commands and rAirForceComments.author == ("HadManySons" or "SilentD"):
+                os.system("cat /home/redditbots/bots/AFILinkerBot/AFILinkerBot.pid | xargs kill -9")
+
+            #Only replies to the bot's comments can delete them
+            if DELETE_COMMAND in commands and isinstance(rAirForceComments, praw.models.Comment):
+                #The parent comment(the bot) and the author of the comment it replied to,
+                #from the journal if AFSCbot recorded the reply
+                parentId = rAirForceComments.parent_id[3:]
+                entry = journal.lookup(parentId)
+                if entry is not None:
+                    METRICS.inc("delete_auth_total", source="journal")
+                    parent = reddit.comment(parentId)
+                    originalAuthor = entry[1]
+                else:
+                    #Get the parent comment(the bot) and grandparent(comment originally replied to)
+                    METRICS.inc("delete_auth_total", source="reddit")
+                    with METRICS.timer("parent_fetch_seconds"):
+                        parent = rAirForceComments.parent()
+                        grandparent = parent.parent()
+                    originalAuthor = grandparent.author
 
-                #Shutdown bot if mod commands it
-                if "shutdown!" in formattedComment and rAirForceComments.author == ("HadManySons" or "SilentD"):
-                    os.system("cat /home/redditbots/bots/AFILinkerBot/AFILinkerBot.pid | xargs kill -9")
-            
-                if "deletethis!" in formattedComment:
-                        #Must be the original comment author
-                        if rAirForceComments.author == grandparent.author:
-                            print_and_log("Deleting comment per redditors request")
-                            rAirForceComments.parent().delete()
-                            logging.info(time.strftime("%Y/%m/%d %H:%M:%S ") +
-                                     "Deleting comment: " + rAirForceComments.id)
+                #Must be the original comment author
+                if rAirForceComments.author == originalAuthor:
+                    print_and_log("Deleting comment per redditors request")
+                    with METRICS.timer("delete_seconds"):
+                        parent.delete()
+                    journal.forget(parentId)
+                    METRICS.inc("deletions_total")
+                    print_and_log("Deleting comment: " + rAirForceComments.id)
 
-                            #Let them know we deleted the comment
-                            rAirForceComments.author.message("Comment deleted", "Comment deleted: " + rAirForceComments.id)
+                    #Let them know we deleted the comment
+                    rAirForceComments.author.message("Comment deleted", "Comment deleted: " + rAirForceComments.id)
 
     # what to do if Ctrl-C is pressed while script is running
     except KeyboardInterrupt:
         print_and_log("Keyboard Interrupt experienced, cleaning up and exiting")
         print_and_log("Exiting due to keyboard interrupt")
-        logging.info(time.strftime("%Y/%m/%d %H:%M:%S ")
-                     + "Exiting due to keyboard interrupt")
+        readMarker.flush()
         exit(0)
 
     except Exception as err:
-        print_and_log("Exception: " + str(err.with_traceback()))
-        logging.error(time.strftime("%Y/%m/%d %H:%M:%S ")
-                      + "Unhandled exception: " + + str(err.with_traceback()))
+        print_and_log("Unhandled exception\n{}".format(
+            traceback.format_exc()), error=True)
+        #The restarted stream yields every unread message again
+        readMarker.flush()
@@ -1,15 +1,67 @@
-import time
+import atexit
 import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-LOG_TIME_FORMAT = "%Y/%m/%d %H:%M:%S "
+LOG_TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+LOG_FILE = os.environ.get("AFS_LOG_FILE", "AuthDelete.log")
+# DEBUG logs the per-match details, INFO and up is meant for production
+LOG_LEVEL = os.environ.get("AFS_LOG_LEVEL", "INFO").upper()
+# set to 0 to only write to the log file
+LOG_ECHO = os.environ.get("AFS_LOG_ECHO", "1") != "0"
 
 
-def print_and_log(text, error=False):
-    print(text)
+class LazyQueueHandler(QueueHandler):
+    """
+    Queues records as they are, so the message is only formatted by the
+    background writer thread instead of the thread that logged it.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+logger = logging.getLogger("AuthDelete Log")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+# add a rotating handler, written to by a background thread
+handler = RotatingFileHandler(LOG_FILE, maxBytes=2048000, backupCount=25)
+handler.setFormatter(logging.Formatter("%(asctime)s %(message)s",
+                                       LOG_TIME_FORMAT))
+log_handlers = [handler]
+if LOG_ECHO:
+    echo_handler = logging.StreamHandler(sys.stdout)
+    echo_handler.setFormatter(logging.Formatter("%(message)s"))
+    log_handlers.append(echo_handler)
+
+log_queue = queue.SimpleQueue()
+logger.addHandler(LazyQueueHandler(log_queue))
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+# write out whatever is still queued on exit
+atexit.register(log_listener.stop)
+
+
+def print_and_log(text, *args, error=False):
+    """
+    Logs text at INFO, or ERROR if error is set. Any args are %-formatted
+    into text by the background writer.
+    """
     if error:
-        logging.error(time.strftime(LOG_TIME_FORMAT) + text)
+        logger.error(text, *args)
     else:
-        logging.info(time.strftime(LOG_TIME_FORMAT) + text)
+        logger.info(text, *args)
+
+
+def log_debug(text, *args):
+    """
+    Logs text at DEBUG. Costs a level check when debug logging is off, so
+    use %-style args rather than formatting text beforehand.
+    """
+    logger.debug(text, *args)
 
 
 def has_number(string):
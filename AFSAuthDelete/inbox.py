@@ -0,0 +1,91 @@
+import time
+from helper_functions import log_debug, print_and_log
+from metrics import METRICS
+
+DELETE_COMMAND = "deletethis!"
+SHUTDOWN_COMMAND = "shutdown!"
+COMMANDS = (DELETE_COMMAND, SHUTDOWN_COMMAND)
+
+# seconds a message can wait to be marked read
+READ_FLUSH_INTERVAL = 30
+# messages marked read in one call, reddit takes 25 ids per request
+READ_BATCH_SIZE = 25
+# empty polls, about 15 seconds of backing off, before the inbox stream
+# yields None so the pending messages are marked read while it's quiet
+STREAM_PAUSE_AFTER = 4
+
+
+def get_commands(body):
+    """
+    :param body: text of an inbox message
+    :return: set of the commands in the message, empty for most messages,
+    which then need nothing fetched from reddit
+    """
+    formatted = body.lower().replace(" ", "")
+    return set(command for command in COMMANDS if command in formatted)
+
+
+class ReadMarker:
+    """
+    Marks inbox messages read in bulk. Messages are queued and marked read
+    with a single inbox.mark_read call once READ_BATCH_SIZE are queued or
+    the oldest has waited READ_FLUSH_INTERVAL seconds, so a burst of
+    replies to the bot costs one request per batch instead of one per
+    message. Messages that fail to be marked read stay queued for the next
+    flush. A restarted inbox stream yields the unread messages again, so
+    a message already queued isn't queued twice.
+    """
+
+    def __init__(self, inbox, interval=READ_FLUSH_INTERVAL,
+                 batch_size=READ_BATCH_SIZE):
+        """
+        :param inbox: PRAW Inbox the messages came from
+        :param interval: seconds a message can wait to be marked read
+        :param batch_size: messages marked read in one call
+        """
+        self.inbox = inbox
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = []
+        # fullnames of the pending messages
+        self.pending_names = set()
+        # time the oldest pending message was queued
+        self.oldest = None
+
+    def add(self, message):
+        """
+        Queues a message, and marks the queue read if it is due.
+        :return: False if the message was already queued
+        """
+        if message.fullname in self.pending_names:
+            return False
+        if not self.pending:
+            self.oldest = time.monotonic()
+        self.pending.append(message)
+        self.pending_names.add(message.fullname)
+        self.flush_if_due()
+        return True
+
+    def flush_if_due(self):
+        if self.pending and (len(self.pending) >= self.batch_size or
+                             time.monotonic() - self.oldest >= self.interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Marks every pending message read.
+        """
+        if not self.pending:
+            return
+        try:
+            with METRICS.timer("mark_read_seconds"):
+                self.inbox.mark_read(self.pending)
+        except Exception as err:
+            print_and_log("Couldn't mark {} messages read, {}".format(
+                len(self.pending), err), error=True)
+            return
+        METRICS.inc("mark_read_calls_total")
+        log_debug("Marked %d messages read", len(self.pending))
+        self.pending = []
+        self.pending_names = set()
+        self.oldest = None
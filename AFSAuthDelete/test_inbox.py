@@ -0,0 +1,81 @@
+import time
+import unittest
+from types import SimpleNamespace
+from inbox import DELETE_COMMAND, SHUTDOWN_COMMAND, ReadMarker, get_commands
+
+#####################
+""" Unit tests """
+#####################
+
+
+class FakeInbox:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    def mark_read(self, items):
+        if self.fail:
+            raise ConnectionError("inbox unavailable")
+        self.calls.append([item.fullname for item in items])
+
+
+def message(number):
+    return SimpleNamespace(fullname="t1_m{}".format(number))
+
+
+class GetCommands(unittest.TestCase):
+    def test_no_command(self):
+        self.assertEqual(set(), get_commands("Thanks bot, good one"))
+
+    def test_spaces_and_case(self):
+        self.assertEqual({DELETE_COMMAND}, get_commands("Delete This!"))
+
+    def test_both(self):
+        self.assertEqual({DELETE_COMMAND, SHUTDOWN_COMMAND},
+                         get_commands("shutdown! and deletethis!"))
+
+
+class ReadMarking(unittest.TestCase):
+    def test_batch_size(self):
+        inbox = FakeInbox()
+        marker = ReadMarker(inbox, interval=60, batch_size=3)
+        for number in range(7):
+            marker.add(message(number))
+        self.assertEqual([["t1_m0", "t1_m1", "t1_m2"],
+                          ["t1_m3", "t1_m4", "t1_m5"]], inbox.calls)
+        self.assertEqual(1, len(marker.pending))
+
+    def test_interval(self):
+        inbox = FakeInbox()
+        marker = ReadMarker(inbox, interval=0.01, batch_size=25)
+        marker.add(message(1))
+        marker.flush_if_due()
+        self.assertEqual([], inbox.calls)
+        time.sleep(0.02)
+        marker.flush_if_due()
+        self.assertEqual([["t1_m1"]], inbox.calls)
+
+    def test_duplicates(self):
+        # a restarted stream yields the pending messages again
+        inbox = FakeInbox()
+        marker = ReadMarker(inbox, interval=60, batch_size=25)
+        self.assertTrue(marker.add(message(1)))
+        self.assertFalse(marker.add(message(1)))
+        marker.flush()
+        self.assertEqual([["t1_m1"]], inbox.calls)
+
+    def test_failed_flush(self):
+        inbox = FakeInbox(fail=True)
+        marker = ReadMarker(inbox, interval=60, batch_size=25)
+        marker.add(message(1))
+        marker.flush()
+        self.assertEqual(1, len(marker.pending))
+        self.assertFalse(marker.add(message(1)))
+        inbox.fail = False
+        marker.flush()
+        self.assertEqual([["t1_m1"]], inbox.calls)
+        self.assertEqual([], marker.pending)
+
+
+if __name__ == "__main__":
+    unittest.main()
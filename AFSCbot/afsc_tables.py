@@ -0,0 +1,230 @@
+import threading
+from collections import namedtuple
+from collections.abc import Mapping
+from reply_lines import ReplyLineIndex
+from title_index import TitleIndex
+from typo_index import TypoIndex
+
+DICT_TYPES = ("enlisted", "officer")
+
+
+class AFSCRecord(namedtuple("AFSCRecord", ["code", "title", "shreds",
+                                           "link"])):
+    """
+    A single base AFSC. shreds is a tuple of (suffix, title) pairs in CSV
+    order, empty for most AFSCs, and link is "" when the wiki has no page.
+    Records are tuples, so they are immutable and much smaller than the
+    dict per AFSC they replace.
+    """
+    __slots__ = ()
+
+    def shred(self, suffix):
+        """
+        :param suffix: uppercase suffix, can be empty
+        :return: title of the shred, None if the AFSC has no such shred
+        """
+        for shred_char, shred_title in self.shreds:
+            if shred_char == suffix:
+                return shred_title
+        return None
+
+    def to_dict(self):
+        """
+        :return: dict of the record in the format of the snapshot file
+        """
+        return {"base_afsc": self.code,
+                "job_title": self.title,
+                "shreds": dict(self.shreds),
+                "link": self.link}
+
+    @classmethod
+    def from_dict(cls, afsc_info):
+        """
+        :param afsc_info: dict of an AFSC in the format of to_dict
+        :return: AFSCRecord
+        """
+        return cls(afsc_info["base_afsc"], afsc_info["job_title"],
+                   tuple(afsc_info["shreds"].items()), afsc_info["link"])
+
+
+class AFSCDictView(Mapping):
+    """
+    Read-only view of one partition of an AFSCTable in the nested dict
+    format the AFSC dicts used to have, with the "dict_type" key and a
+    dict per AFSC. Kept for code written against that format, the bot
+    itself uses the records.
+    """
+
+    def __init__(self, partition, dict_type):
+        self.partition = partition
+        self.dict_type = dict_type
+
+    def __getitem__(self, key):
+        if key == "dict_type":
+            return self.dict_type
+        return self.partition[key].to_dict()
+
+    def __iter__(self):
+        yield "dict_type"
+        yield from self.partition
+
+    def __len__(self):
+        return len(self.partition) + 1
+
+
+class AFSCTable(Mapping):
+    """
+    Every AFSC, with explicit enlisted and officer partitions. Each
+    partition is a dict mapping the base AFSC to its AFSCRecord. Tables
+    are never modified, the with_ methods build new ones that share the
+    unchanged partitions. table["enlisted"] gives an AFSCDictView, so the
+    table can still be read like the old full_afsc_dict.
+    """
+    __slots__ = ("enlisted", "officer")
+
+    def __init__(self, enlisted, officer):
+        """
+        :param enlisted: dict mapping base AFSC to AFSCRecord
+        :param officer: dict mapping base AFSC to AFSCRecord
+        """
+        self.enlisted = enlisted
+        self.officer = officer
+
+    def partition(self, dict_type):
+        """
+        :param dict_type: "enlisted" or "officer"
+        :return: dict mapping base AFSC to AFSCRecord
+        """
+        if dict_type == "enlisted":
+            return self.enlisted
+        if dict_type == "officer":
+            return self.officer
+        raise KeyError(dict_type)
+
+    def lookup(self, dict_type, base_afsc):
+        """
+        :param dict_type: "enlisted" or "officer"
+        :param base_afsc: uppercase base AFSC, see get_base_afsc
+        :return: AFSCRecord, None if the AFSC doesn't exist
+        """
+        return self.partition(dict_type).get(base_afsc)
+
+    def with_partition(self, dict_type, partition):
+        """
+        :return: new AFSCTable with the given partition replaced
+        """
+        if dict_type == "enlisted":
+            return AFSCTable(partition, self.officer)
+        return AFSCTable(self.enlisted, partition)
+
+    def with_links(self, links):
+        """
+        :param links: dict mapping base AFSC to link, see get_wiki_links.
+        Currently all wiki AFSCs are enlisted.
+        :return: new AFSCTable whose enlisted links are exactly links
+        """
+        return self.with_partition("enlisted", {
+            base_afsc: record._replace(link=links.get(base_afsc, ""))
+            for base_afsc, record in self.enlisted.items()})
+
+    def to_dict(self):
+        """
+        :return: nested dicts in the format of the snapshot file
+        """
+        return {dict_type: dict(AFSCDictView(self.partition(dict_type),
+                                             dict_type))
+                for dict_type in DICT_TYPES}
+
+    @classmethod
+    def from_dict(cls, full_afsc_dict):
+        """
+        :param full_afsc_dict: nested dicts in the format of to_dict
+        :return: AFSCTable
+        """
+        return cls(*({base_afsc: AFSCRecord.from_dict(afsc_info)
+                      for base_afsc, afsc_info
+                      in full_afsc_dict[dict_type].items()
+                      if base_afsc != "dict_type"}
+                     for dict_type in DICT_TYPES))
+
+    def __getitem__(self, dict_type):
+        return AFSCDictView(self.partition(dict_type), dict_type)
+
+    def __iter__(self):
+        return iter(DICT_TYPES)
+
+    def __len__(self):
+        return len(DICT_TYPES)
+
+
+class AFSCTables:
+    """
+    One consistent set of lookup tables. Tables are never modified once
+    built, an update builds a new AFSCTables and publishes it to the
+    TableStore.
+    """
+
+    def __init__(self, full_afsc_dict, prefix_dict, csv_mtimes=None,
+                 wiki_revision=None):
+        """
+        :param full_afsc_dict: AFSCTable used for afsc lookups
+        :param prefix_dict: dict used for prefix lookups
+        :param csv_mtimes: CSV modification times the dicts were built from
+        :param wiki_revision: wiki revision id the links were taken from,
+        None if the links haven't been loaded
+        """
+        self.full_afsc_dict = full_afsc_dict
+        self.prefix_dict = prefix_dict
+        self.csv_mtimes = csv_mtimes
+        self.wiki_revision = wiki_revision
+        # finished reply line of every valid AFSC
+        self.reply_lines = ReplyLineIndex(full_afsc_dict, prefix_dict)
+        # words of the job titles -> AFSCs, for the reverse lookups
+        self.title_index = TitleIndex(full_afsc_dict, prefix_dict)
+        # TypoIndex per maximum distance, only built if typos are corrected
+        self.typo_indexes = {}
+        # the worker threads share the tables, only one builds each index
+        self.typo_lock = threading.Lock()
+
+    def get_typo_index(self, max_distance):
+        """
+        :param max_distance: maximum edit distance of a correction
+        :return: TypoIndex of the enlisted AFSCs, built on first use
+        """
+        with self.typo_lock:
+            typo_index = self.typo_indexes.get(max_distance)
+            if typo_index is None:
+                typo_index = TypoIndex(self.full_afsc_dict.enlisted,
+                                       max_distance)
+                self.typo_indexes[max_distance] = typo_index
+            return typo_index
+
+
+class TableStore:
+    """
+    Holds the AFSCTables currently in use. Readers take store.current once
+    per comment and use it throughout. Replacing a single reference is
+    atomic, so the comment stream keeps running on the old tables until
+    the new ones are published. Writers go through update() so two
+    background updates can't overwrite each other.
+    """
+
+    def __init__(self, tables):
+        """
+        :param tables: initial AFSCTables
+        """
+        self.current = tables
+        self.lock = threading.Lock()
+
+    def update(self, build):
+        """
+        Builds new tables from the current ones and publishes them.
+        :param build: function taking the current AFSCTables and returning
+        new AFSCTables, or None to keep the current ones
+        :return: the published AFSCTables, None if nothing changed
+        """
+        with self.lock:
+            tables = build(self.current)
+            if tables is not None:
+                self.current = tables
+            return tables
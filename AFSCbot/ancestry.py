@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+
+PARENT_CACHE_SIZE = 4096
+
+
+class ParentCache:
+    """
+    Bounded LRU cache of ancestor comments keyed by comment id. Sibling
+    replies in the same thread share their ancestors, so a walk up the
+    thread only fetches the parents that haven't been seen recently.
+    Each entry is a tuple of (upper-cased body, parent fullname). The cache
+    can be shared between threads.
+    """
+
+    def __init__(self, max_size=PARENT_CACHE_SIZE):
+        """
+        :param max_size: maximum number of comments kept in the cache
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, comment_id):
+        """
+        :param comment_id: id of the comment, without the t1_ prefix
+        :return: (body, parent_id) tuple or None if not cached
+        """
+        with self.lock:
+            entry = self.entries.get(comment_id)
+            if entry is not None:
+                self.entries.move_to_end(comment_id)
+            return entry
+
+    def put(self, comment_id, body, parent_id):
+        """
+        :param comment_id: id of the comment, without the t1_ prefix
+        :param body: upper-cased body of the comment
+        :param parent_id: fullname of the comment's parent
+        """
+        with self.lock:
+            self.entries[comment_id] = (body, parent_id)
+            self.entries.move_to_end(comment_id)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+PARENT_CACHE = ParentCache()
+
+
+def get_ancestors(comment, cache=PARENT_CACHE):
+    """
+    Returns the upper-cased bodies of every parent comment, nearest first,
+    up to the top level comment. A parent that isn't cached is refreshed,
+    which pulls it along with up to 8 of its own ancestors in one request.
+    The next parent() calls are then answered from the submission's comment
+    map, so a deep thread costs about one request per 9 levels.
+    :param comment: a PRAW instance of a comment
+    :param cache: ParentCache used to store fetched parents
+    :return: list of upper-cased parent bodies
+    """
+    ancestors = []
+    parent_id = comment.parent_id
+    # loaded PRAW comment whose parent is next, None if it came from the cache
+    node = comment
+    # parents that are comments are t1_, the submission is t3_
+    while parent_id.startswith("t1_"):
+        parent_key = parent_id[3:]
+        entry = cache.get(parent_key)
+        if entry is None:
+            if node is not None:
+                parent = node.parent()
+            else:
+                parent = comment._reddit.comment(parent_key)
+                parent.submission = comment.submission
+            if "body" not in parent.__dict__:
+                parent.refresh()
+            entry = (parent.body.upper(), parent.parent_id)
+            cache.put(parent_key, *entry)
+            node = parent
+        else:
+            node = None
+        ancestors.append(entry[0])
+        parent_id = entry[1]
+    return ancestors
+
+
+async def get_ancestors_async(reddit, comment, cache=PARENT_CACHE):
+    """
+    asyncpraw version of get_ancestors, sharing the same cache.
+    :param reddit: asyncpraw reddit object
+    :param comment: an asyncpraw instance of a comment
+    :param cache: ParentCache used to store fetched parents
+    :return: list of upper-cased parent bodies
+    """
+    ancestors = []
+    parent_id = comment.parent_id
+    # loaded comment whose parent is next, None if it came from the cache
+    node = comment
+    while parent_id.startswith("t1_"):
+        parent_key = parent_id[3:]
+        entry = cache.get(parent_key)
+        if entry is None:
+            if node is not None:
+                parent = await node.parent()
+            else:
+                parent = await reddit.comment(parent_key, fetch=False)
+                parent.submission = comment.submission
+            if "body" not in parent.__dict__:
+                await parent.refresh()
+            entry = (parent.body.upper(), parent.parent_id)
+            cache.put(parent_key, *entry)
+            node = parent
+        else:
+            node = None
+        ancestors.append(entry[0])
+        parent_id = entry[1]
+    return ancestors
+
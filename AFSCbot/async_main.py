@@ -0,0 +1,198 @@
+import asyncio
+import time
+import asyncpraw
+import asyncprawcore
+from ancestry import get_ancestors_async
+from helper_functions import print_and_log
+from metrics import METRICS
+from process_comment import (build_reply_body, find_previous_matches,
+                             record_sent)
+from pipeline import renderer
+from reply_scheduler import (MAX_ATTEMPTS, RESERVE, get_budget_delay,
+                             get_retry_delay)
+
+# number of comments processed at the same time
+CONCURRENCY = 8
+# how often, in streamed comments, the pipeline stats are logged
+STATS_INTERVAL = 100
+
+
+class AsyncCountingRequestor(asyncprawcore.Requestor):
+    """
+    Counts every HTTP request asyncpraw makes, see metrics.CountingRequestor.
+    """
+
+    def request(self, *args, **kwargs):
+        METRICS.inc("api_calls_total")
+        return super().request(*args, **kwargs)
+
+
+async def send_reply_async(reddit, comment, body, reserve=RESERVE):
+    """
+    Replies to a comment, retrying with backoff like ReplyScheduler.send,
+    and waiting for the ratelimit window to reset first if the API budget
+    is down to the reserve.
+    :param reddit: asyncpraw reddit object
+    :param comment: asyncpraw comment to reply to
+    :param body: text of the reply
+    :param reserve: API calls left for everything but the replies
+    :return: the reply, None if it was given up on
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        delay = get_budget_delay(reddit.auth.limits, reserve)
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            with METRICS.timer("reply_seconds"):
+                return await comment.reply(body)
+        except Exception as err:
+            delay = get_retry_delay(err, attempt, asyncpraw.exceptions,
+                                    asyncprawcore.exceptions)
+            if delay is None:
+                print_and_log("Reply to {} can't be sent, {}".format(
+                    comment.id, err), error=True)
+                break
+            if attempt + 1 == MAX_ATTEMPTS:
+                break
+            print_and_log("Reply to {} failed, retrying in {}s, {}".format(
+                comment.id, delay, err), error=True)
+            await asyncio.sleep(delay)
+
+    print_and_log("Giving up on reply to {}".format(comment.id), error=True)
+    METRICS.inc("reply_failures_total")
+    return None
+
+
+async def process_comment_async(reddit, comment, comment_pipeline,
+                                replied_index, claims=None, journal=None):
+    """
+    Runs a comment through the local pipeline stages, then walks its
+    ancestry and replies with asyncpraw.
+    :param reddit: asyncpraw reddit object
+    :param comment: asyncpraw comment from the stream
+    :param comment_pipeline: Pipeline without the ancestry and render stages
+    :param replied_index: RepliedIndex of comments already replied to
+    :param claims: optional ClaimStore the reply is recorded in
+    :param journal: optional ReplyJournal the reply is recorded in
+    """
+    context = comment_pipeline.run(comment)
+    if context is None:
+        return
+
+    if not comment.is_root:
+        matches = [match.group(1).upper() for dict_type, match
+                   in context.candidates]
+        with METRICS.timer("stage_seconds", stage="ancestry"):
+            parent_bodies = await get_ancestors_async(reddit, comment)
+        previous_matches = find_previous_matches(parent_bodies, matches)
+        context.candidates = [(dict_type, match) for dict_type, match
+                              in context.candidates
+                              if match.group(1).upper() not in previous_matches]
+    with METRICS.timer("stage_seconds", stage="render"):
+        rendered = renderer(context)
+    if not rendered:
+        return
+
+    # another task may have replied while this one was waiting
+    if comment.id in replied_index:
+        return
+    print_and_log("Preparing to reply to id {} by author: {}".format(
+        comment.id, comment.author))
+    reply = await send_reply_async(reddit, comment,
+                                   build_reply_body(context.reply_text,
+                                                    comment.id))
+    if reply is None:
+        return
+    record_sent(comment, reply, replied_index, journal)
+    if claims is not None:
+        claims.mark_replied(comment.id)
+    METRICS.inc("replies_total")
+    print_and_log("Sent reply...")
+
+
+async def run_async(comment_pipeline, replied_index, subreddit_name,
+                    reddit_kwargs, concurrency=CONCURRENCY, checkpoint=None,
+                    skip_existing=False, sharder=None, journal=None):
+    """
+    Streams comments with asyncpraw and processes up to concurrency of
+    them at the same time, so one slow parent() or reply() call doesn't
+    stall the comments behind it.
+    :param comment_pipeline: Pipeline from build_pipeline
+    :param replied_index: RepliedIndex of comments already replied to
+    :param subreddit_name: name of the subreddit to stream
+    :param reddit_kwargs: credentials passed to asyncpraw.Reddit
+    :param concurrency: maximum number of comments processed at once
+    :param checkpoint: optional StreamCheckpoint, comments at or before it
+    are skipped
+    :param skip_existing: skip the comments made before the stream started
+    :param sharder: optional Sharder, only the comments of the shards it
+    owns are processed
+    :param journal: optional ReplyJournal the replies are recorded in
+    """
+    claims = sharder.store if sharder is not None else None
+    # the ancestry is walked with asyncpraw instead, and rendered after it
+    comment_pipeline.remove_stage("ancestry")
+    comment_pipeline.remove_stage("render")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    # comments currently being processed, so each one gets a single task
+    in_progress = set()
+    # running tasks, the event loop only keeps weak references to them
+    tasks = set()
+
+    async def handle(comment):
+        try:
+            await process_comment_async(reddit, comment, comment_pipeline,
+                                        replied_index, claims, journal)
+        except Exception as err:
+            print_and_log("Error processing comment {}, {}".format(
+                comment.id, err), error=True)
+        finally:
+            in_progress.discard(comment.id)
+            semaphore.release()
+            if claims is not None:
+                # no-op if the reply was recorded
+                claims.release(comment.id)
+            if checkpoint is not None:
+                checkpoint.done(comment)
+
+    async def submit(comment):
+        if comment.id in in_progress:
+            return
+        if checkpoint is not None:
+            checkpoint.start(comment)
+        await semaphore.acquire()
+        in_progress.add(comment.id)
+        task = asyncio.create_task(handle(comment))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async with asyncpraw.Reddit(requestor_class=AsyncCountingRequestor,
+                                **reddit_kwargs) as reddit:
+        subreddit = await reddit.subreddit(subreddit_name)
+        print_and_log("Starting async processing loop for subreddit: {}, "
+                      "concurrency {}".format(subreddit_name, concurrency))
+        comments_seen = 0
+        fetch_start = time.perf_counter()
+        async for streamed in subreddit.stream.comments(
+                skip_existing=skip_existing):
+            METRICS.observe("stream_fetch_seconds",
+                            time.perf_counter() - fetch_start)
+            if checkpoint is not None and checkpoint.seen(streamed):
+                METRICS.inc("checkpoint_skipped_total")
+                fetch_start = time.perf_counter()
+                continue
+            if sharder is None:
+                comments = [streamed]
+            else:
+                comments = sharder.route(streamed)
+            for comment in comments:
+                await submit(comment)
+            fetch_start = time.perf_counter()
+
+            comments_seen += 1
+            if comments_seen % STATS_INTERVAL == 0:
+                print_and_log("Comments processed since start of script: {}"
+                              .format(comments_seen))
+                for line in comment_pipeline.report():
+                    print_and_log(line)
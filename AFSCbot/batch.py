@@ -0,0 +1,350 @@
+import argparse
+import bz2
+import gzip
+import io
+import itertools
+import json
+import logging
+import lzma
+import multiprocessing
+import os
+import time
+from collections import Counter, deque
+import helper_functions
+from ancestry import ParentCache
+from helper_functions import has_number
+from process_comment import (build_reply_body, filter_out_quotes,
+                             find_previous_matches, get_afsc_candidates,
+                             get_base_afsc, render_reply, resolve_candidates)
+from read_csv_files import get_tables, SNAPSHOT_FILE
+
+# dump lines sent to a worker at a time
+CHUNK_SIZE = 1000
+# chunks queued per worker, bounds the memory used by results waiting to be
+# written
+CHUNKS_PER_WORKER = 2
+# comments kept for ancestry lookups. Dumps are sorted by creation time, so
+# a parent more than this many comments before its reply is treated as
+# missing
+WINDOW_SIZE = 200000
+
+# AFSC tables of the worker process, loaded once by init_worker
+worker_tables = None
+worker_ignored_authors = frozenset()
+worker_typo_distance = 0
+
+
+def open_dump(path):
+    """
+    :param path: JSONL dump, optionally compressed with gzip, bz2, xz or
+    zstandard (.zst, needs the zstandard package)
+    :return: binary file object of the uncompressed lines
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path)
+    if path.endswith(".bz2"):
+        return bz2.open(path)
+    if path.endswith(".xz"):
+        return lzma.open(path)
+    if path.endswith(".zst"):
+        # only needed, and imported, for zstandard dumps
+        import zstandard
+        # the reddit dumps are compressed with a long window
+        reader = zstandard.ZstdDecompressor(
+            max_window_size=2 ** 31).stream_reader(open(path, "rb"))
+        return io.BufferedReader(reader)
+    return open(path, "rb")
+
+
+def read_chunks(f, size=CHUNK_SIZE):
+    """
+    :param f: binary file object of JSONL lines
+    :param size: maximum number of lines per chunk
+    :return: generator of lists of lines
+    """
+    while True:
+        chunk = list(itertools.islice(f, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def init_worker(snapshot_path, ignored_authors, log_level, typo_distance,
+                log_queue=None):
+    """
+    Loads the AFSC tables once in every worker process.
+    :param log_queue: multiprocessing queue the worker process logs to,
+    None to log in this process
+    """
+    global worker_tables, worker_ignored_authors, worker_typo_distance
+    if log_queue is not None:
+        helper_functions.log_to_queue(log_queue)
+    helper_functions.logger.setLevel(log_level)
+    worker_tables = get_tables(snapshot_path)
+    worker_ignored_authors = frozenset(ignored_authors)
+    worker_typo_distance = typo_distance
+
+
+def scan_chunk(lines):
+    """
+    Runs the local part of generate_reply over a chunk of dump lines, in a
+    worker process. The ancestry check needs the comments before it in the
+    dump, so it is left to the parent process.
+    :param lines: list of JSONL lines of reddit comments
+    :return: list with a (id, parent_id, body, candidates, data) tuple for
+    every comment, in order. body is the upper-cased body, empty if it has
+    no digits as no AFSC can match it. candidates is the list of resolved
+    (dict_type, AFSCMatch) tuples and data the comment's JSON object if
+    there are any, None otherwise. Unreadable lines are None.
+    """
+    full_afsc_dict = worker_tables.full_afsc_dict
+    typo_index = None
+    if worker_typo_distance:
+        typo_index = worker_tables.get_typo_index(worker_typo_distance)
+    results = []
+    for line in lines:
+        try:
+            data = json.loads(line)
+            comment_id = data["id"]
+            parent_id = data["parent_id"]
+            body = data["body"]
+        except (ValueError, KeyError, TypeError):
+            results.append(None)
+            continue
+        candidates = None
+        if data.get("author") not in worker_ignored_authors:
+            formatted_comment = filter_out_quotes(body)
+            candidates = resolve_candidates(
+                get_afsc_candidates(formatted_comment), full_afsc_dict)
+            if typo_index is not None:
+                candidates += typo_index.correct(formatted_comment, candidates)
+        results.append((comment_id, parent_id,
+                        body.upper() if has_number(body) else "",
+                        candidates or None, data if candidates else None))
+    return results
+
+
+def get_dump_ancestors(parent_id, cache):
+    """
+    Walks a comment's thread over the comments already read from the dump.
+    :param parent_id: fullname of the comment's parent
+    :param cache: ParentCache of the comments read so far
+    :return: tuple of the list of upper-cased parent bodies, nearest first,
+    and whether the walk reached the top level comment
+    """
+    ancestors = []
+    while parent_id.startswith("t1_"):
+        entry = cache.get(parent_id[3:])
+        if entry is None:
+            return ancestors, False
+        ancestors.append(entry[0])
+        parent_id = entry[1]
+    return ancestors, True
+
+
+class BatchStats:
+    """
+    Counters of a batch run. The AFSC counts are keyed by base AFSC, so
+    their size is bounded by the AFSC tables and not by the dump.
+    """
+
+    def __init__(self):
+        self.comments = 0
+        self.bad_lines = 0
+        self.with_afscs = 0
+        self.replies = 0
+        # comments whose AFSCs were all mentioned further up the thread
+        self.already_mentioned = 0
+        # comments with an AFSC whose thread left the window or the dump
+        self.missing_parents = 0
+        self.mentions = Counter()
+        self.replied_afscs = Counter()
+        self.start = time.perf_counter()
+
+    def to_dict(self, top=50):
+        elapsed = time.perf_counter() - self.start
+        return {"comments": self.comments,
+                "bad_lines": self.bad_lines,
+                "comments_with_afscs": self.with_afscs,
+                "replies": self.replies,
+                "already_mentioned": self.already_mentioned,
+                "missing_parents": self.missing_parents,
+                "seconds": round(elapsed, 3),
+                "comments_per_second": round(self.comments / elapsed
+                                             if elapsed else 0, 1),
+                "top_mentions": self.mentions.most_common(top),
+                "top_replied": self.replied_afscs.most_common(top)}
+
+    def report(self):
+        """
+        :return: list of strings describing the run
+        """
+        stats = self.to_dict(10)
+        return ["{comments} comments in {seconds}s, {comments_per_second} "
+                "comments/sec".format(**stats),
+                "{comments_with_afscs} with an AFSC, {replies} replies, "
+                "{already_mentioned} already mentioned up the thread, "
+                "{missing_parents} with missing parents, {bad_lines} bad "
+                "lines".format(**stats),
+                "top AFSCs: " + ", ".join("{} {}".format(afsc, count)
+                                          for afsc, count
+                                          in stats["top_mentions"])]
+
+
+def get_base_afscs(candidates):
+    return [get_base_afsc(match.group(3).upper(), match.group(4).upper(),
+                          dict_type)[1]
+            for dict_type, match in candidates]
+
+
+def handle_results(results, cache, tables, stats, out):
+    """
+    Checks the ancestry of the scanned comments in dump order, and writes
+    the would-be replies.
+    :param results: list returned by scan_chunk
+    :param cache: ParentCache of the comments read so far
+    :param tables: AFSCTables the replies are rendered with
+    :param stats: BatchStats updated with the results
+    :param out: text file the replies are written to, one JSON per line
+    """
+    for result in results:
+        if result is None:
+            stats.bad_lines += 1
+            continue
+        comment_id, parent_id, body, candidates, data = result
+        stats.comments += 1
+        cache.put(comment_id, body, parent_id)
+        if candidates is None:
+            continue
+
+        stats.with_afscs += 1
+        stats.mentions.update(get_base_afscs(candidates))
+        ancestors, complete = get_dump_ancestors(parent_id, cache)
+        if not complete:
+            stats.missing_parents += 1
+        previous_matches = find_previous_matches(
+            ancestors, [match.group(1).upper() for _, match in candidates])
+        candidates = [(dict_type, match) for dict_type, match in candidates
+                      if match.group(1).upper() not in previous_matches]
+        comment_text = render_reply(candidates, tables.full_afsc_dict,
+                                    tables.prefix_dict, tables.reply_lines)
+        if not comment_text:
+            stats.already_mentioned += 1
+            continue
+
+        stats.replies += 1
+        afscs = get_base_afscs(candidates)
+        stats.replied_afscs.update(afscs)
+        out.write(json.dumps({"id": comment_id,
+                              "parent_id": parent_id,
+                              "link_id": data.get("link_id"),
+                              "author": data.get("author"),
+                              "subreddit": data.get("subreddit"),
+                              "created_utc": data.get("created_utc"),
+                              "afscs": afscs,
+                              "complete_thread": complete,
+                              "reply": build_reply_body(comment_text,
+                                                        comment_id)}) + "\n")
+
+
+def run_batch(dump_path, out_path, processes=None, snapshot_path=SNAPSHOT_FILE,
+              ignored_authors=(), window=WINDOW_SIZE, typo_distance=0):
+    """
+    Replays a comment dump through the reply logic without reddit. Chunks
+    of lines are scanned by a process pool, and the results are checked
+    against the thread and written in dump order. Only a bounded number of
+    chunks is in flight and the ancestry window is bounded, so memory use
+    doesn't grow with the dump.
+    :param dump_path: JSONL dump of reddit comments, see open_dump
+    :param out_path: JSONL file the would-be replies are written to
+    :param processes: number of worker processes, all CPUs by default, 0
+    scans in this process
+    :param snapshot_path: AFSC snapshot the tables are loaded from, the CSV
+    files are used if it is out of date
+    :param ignored_authors: usernames whose comments get no reply
+    :param window: number of comments kept for ancestry lookups
+    :param typo_distance: maximum edit distance of the corrected AFSC
+    typos, 0 turns it off
+    :return: BatchStats
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    log_level = helper_functions.logger.level
+    init_worker(snapshot_path, ignored_authors, log_level, typo_distance)
+    tables = worker_tables
+    cache = ParentCache(window)
+    stats = BatchStats()
+
+    with open_dump(dump_path) as f, open(out_path, "w") as out:
+        if processes == 0:
+            for chunk in read_chunks(f):
+                handle_results(scan_chunk(chunk), cache, tables, stats, out)
+            return stats
+
+        # the workers' records are written out by this process
+        log_queue = multiprocessing.Queue()
+        log_forwarder = helper_functions.forward_logs(log_queue)
+        try:
+            with multiprocessing.Pool(processes, init_worker,
+                                      (snapshot_path, ignored_authors,
+                                       log_level, typo_distance,
+                                       log_queue)) as pool:
+                # Pool.imap would read the whole dump ahead of the workers
+                pending = deque()
+                for chunk in read_chunks(f):
+                    pending.append(pool.apply_async(scan_chunk, (chunk,)))
+                    if len(pending) >= processes * CHUNKS_PER_WORKER:
+                        handle_results(pending.popleft().get(), cache,
+                                       tables, stats, out)
+                while pending:
+                    handle_results(pending.popleft().get(), cache, tables,
+                                   stats, out)
+                # lets the workers send their last records before exiting
+                pool.close()
+                pool.join()
+        finally:
+            log_forwarder.stop()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a JSONL dump of "
+                                                 "reddit comments through the "
+                                                 "bot offline and writes the "
+                                                 "replies it would send")
+    parser.add_argument("dump", help="JSONL dump of reddit comments, "
+                                     "optionally .gz, .bz2, .xz or .zst")
+    parser.add_argument("out", help="JSONL file the replies are written to")
+    parser.add_argument("--stats",
+                        help="JSON file the stats are written to, "
+                             "OUT.stats.json by default")
+    parser.add_argument("--processes", type=int,
+                        help="number of worker processes, all CPUs by "
+                             "default, 0 runs in a single process")
+    parser.add_argument("--snapshot", default=SNAPSHOT_FILE,
+                        help="AFSC snapshot with the wiki links")
+    parser.add_argument("--window", type=int, default=WINDOW_SIZE,
+                        help="number of comments kept for ancestry lookups")
+    parser.add_argument("--ignore-author", action="append",
+                        default=["AFSCbot"],
+                        help="username whose comments get no reply, can be "
+                             "given several times")
+    parser.add_argument("--typo-distance", type=int, default=0,
+                        help="also answer the enlisted AFSC typos within "
+                             "this edit distance, 0 turns it off")
+    parser.add_argument("--log", action="store_true",
+                        help="keep logging at INFO")
+    args = parser.parse_args()
+    if not args.log:
+        helper_functions.logger.setLevel(logging.WARNING)
+
+    stats = run_batch(args.dump, args.out, args.processes, args.snapshot,
+                      args.ignore_author, args.window, args.typo_distance)
+    with open(args.stats or args.out + ".stats.json", "w") as f:
+        json.dump(stats.to_dict(), f, indent=2)
+    for line in stats.report():
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import logging
+import time
+import helper_functions
+from afsc_tables import AFSCTables, TableStore
+from ancestry import PARENT_CACHE
+from fake_reddit import FakeReddit
+from main import handle_comment
+from pipeline import build_pipeline
+from process_comment import generate_reply
+from read_csv_files import get_AFSCs, get_prefixes
+from replied_index import RepliedIndex
+from reply_scheduler import ReplyScheduler
+from synthetic_corpus import CorpusGenerator
+
+# links served by the fake wiki, enough to exercise the link lookups
+WIKI_LINKS = ["https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1",
+              "https://www.reddit.com/r/AirForce/wiki/jobs/1n2x1ac",
+              "https://www.reddit.com/r/AirForce/wiki/jobs/3d1x2"]
+
+
+def add_synthetic_threads(reddit, generator, threads, depth):
+    """
+    Adds threads of synthetic comments to the fake reddit.
+    :param reddit: FakeReddit the threads are added to
+    :param generator: CorpusGenerator the comment bodies come from
+    :param threads: number of threads
+    :param depth: number of comments in every thread
+    """
+    for _ in range(threads):
+        reddit.add_thread(list(generator.comments(depth)))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction),
+                             len(sorted_values) - 1)]
+
+
+def report(name, latencies, elapsed, api_calls, replies):
+    """
+    :param latencies: seconds spent on every comment
+    :param elapsed: seconds the whole run took
+    :return: list of strings describing the run
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return ["{}: {} comments in {:.2f}s, {:.0f} comments/sec".format(
+                name, count, elapsed, count / elapsed if elapsed else 0),
+            "  latency p50 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms".format(
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                (latencies[-1] if latencies else 0) * 1000),
+            "  API calls per comment {:.3f}, replies {}".format(
+                api_calls / count if count else 0, replies)]
+
+
+def bench_generate_reply(reddit, tables):
+    """
+    Replays the stream through generate_reply.
+    :return: list of report lines
+    """
+    PARENT_CACHE.clear()
+    start_calls = reddit.api_calls
+    latencies = []
+    replies = 0
+    start = time.perf_counter()
+    for comment in reddit.subreddit("AirForce").stream.comments():
+        comment_start = time.perf_counter()
+        if generate_reply(comment, tables.full_afsc_dict, tables.prefix_dict,
+                          tables.reply_lines):
+            replies += 1
+        latencies.append(time.perf_counter() - comment_start)
+    return report("generate_reply", latencies, time.perf_counter() - start,
+                  reddit.api_calls - start_calls, replies)
+
+
+def bench_main_loop(reddit, tables):
+    """
+    Replays the stream through the main loop, with the pipeline and the
+    reply scheduler thread. The run ends once every reply was sent.
+    :return: list of report lines
+    """
+    PARENT_CACHE.clear()
+    replied_index = RepliedIndex(":memory:")
+    comment_pipeline = build_pipeline(TableStore(tables), replied_index,
+                                      [reddit.username])
+    scheduler = ReplyScheduler(reddit, replied_index)
+    scheduler.start()
+    start_calls = reddit.api_calls
+    start_replies = len(reddit.replies)
+    latencies = []
+    start = time.perf_counter()
+    for comment in reddit.subreddit("AirForce").stream.comments():
+        comment_start = time.perf_counter()
+        handle_comment(comment, comment_pipeline, scheduler)
+        latencies.append(time.perf_counter() - comment_start)
+    while scheduler.pending:
+        time.sleep(0.001)
+    lines = report("main loop", latencies, time.perf_counter() - start,
+                   reddit.api_calls - start_calls,
+                   len(reddit.replies) - start_replies)
+    return lines + ["  " + line for line in comment_pipeline.report()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replays comments through "
+                                                 "the bot against a fake "
+                                                 "reddit")
+    parser.add_argument("--corpus",
+                        help="JSONL file of reddit comments to replay, "
+                             "synthetic threads are used if not given")
+    parser.add_argument("--threads", type=int, default=200,
+                        help="number of synthetic threads")
+    parser.add_argument("--depth", type=int, default=10,
+                        help="number of comments in every synthetic thread")
+    parser.add_argument("--match-rate", type=float, default=0.2,
+                        help="share of synthetic comments mentioning an AFSC")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--parent-latency", type=float, default=0.0,
+                        help="seconds every parent fetch takes")
+    parser.add_argument("--reply-latency", type=float, default=0.0,
+                        help="seconds every reply takes")
+    parser.add_argument("--fetch-latency", type=float, default=0.0,
+                        help="seconds every stream request of 100 comments "
+                             "takes")
+    parser.add_argument("--mode", choices=("generate", "main", "both"),
+                        default="both")
+    parser.add_argument("--log", action="store_true",
+                        help="keep logging at INFO, it is turned off so "
+                             "the log writes don't skew the numbers")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.log:
+        helper_functions.logger.setLevel(logging.WARNING)
+
+    reddit = FakeReddit(parent_latency=args.parent_latency,
+                        reply_latency=args.reply_latency,
+                        fetch_latency=args.fetch_latency,
+                        wiki_links=WIKI_LINKS)
+    tables = AFSCTables(get_AFSCs(reddit), get_prefixes())
+    if args.corpus:
+        reddit.load_jsonl(args.corpus)
+    else:
+        generator = CorpusGenerator(tables.full_afsc_dict, tables.prefix_dict,
+                                    afsc_rate=args.match_rate, seed=args.seed)
+        add_synthetic_threads(reddit, generator, args.threads, args.depth)
+
+    if args.mode in ("generate", "both"):
+        for line in bench_generate_reply(reddit, tables):
+            print(line)
+    if args.mode in ("main", "both"):
+        for line in bench_main_loop(reddit, tables):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
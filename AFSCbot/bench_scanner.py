@@ -0,0 +1,123 @@
+import argparse
+import logging
+import time
+import tracemalloc
+import helper_functions
+from afsc_tables import AFSCTables
+from process_comment import (filter_out_quotes, get_afsc_candidates,
+                             resolve_candidates, render_reply)
+from read_csv_files import get_AFSCs, get_prefixes
+from synthetic_corpus import CorpusGenerator, read_bodies
+
+
+def get_stages(tables):
+    """
+    :param tables: AFSCTables used by the resolve and render stages
+    :return: list of (name, function) tuples, each function takes the
+    output of the one before it
+    """
+    full_afsc_dict = tables.full_afsc_dict
+    prefix_dict = tables.prefix_dict
+    reply_lines = tables.reply_lines
+    return [("quotes", filter_out_quotes),
+            ("scan", get_afsc_candidates),
+            ("resolve", lambda candidates: resolve_candidates(
+                candidates, full_afsc_dict)),
+            ("render", lambda candidates: render_reply(
+                candidates, full_afsc_dict, prefix_dict, reply_lines))]
+
+
+def bench_stages(bodies, stages, repeat=3):
+    """
+    Times every stage over the whole corpus, the best of repeat runs.
+    :param bodies: list of comment bodies
+    :return: list of (name, seconds) tuples
+    """
+    results = []
+    inputs = bodies
+    for name, function in stages:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outputs = [function(value) for value in inputs]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((name, best))
+        inputs = outputs
+    return results
+
+
+def measure_allocations(bodies, stages):
+    """
+    Runs every comment through all the stages under tracemalloc.
+    :param bodies: list of comment bodies
+    :return: tuple of the average peak bytes allocated per comment and the
+    average bytes still allocated after each comment
+    """
+    tracemalloc.start()
+    peak_total = 0
+    kept_total = 0
+    for body in bodies:
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        value = body
+        for _, function in stages:
+            value = function(value)
+        current, peak = tracemalloc.get_traced_memory()
+        peak_total += peak - start
+        kept_total += current - start
+        del value
+    tracemalloc.stop()
+    return peak_total / len(bodies), kept_total / len(bodies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the quote "
+                                                 "filter, scan, resolve and "
+                                                 "render path")
+    parser.add_argument("--corpus", help="JSONL file of reddit comments, a "
+                                         "synthetic corpus is generated if "
+                                         "not given")
+    parser.add_argument("--count", type=int, default=100000,
+                        help="number of comments benchmarked")
+    parser.add_argument("--afsc-rate", type=float, default=0.2,
+                        help="share of synthetic comments mentioning an AFSC")
+    parser.add_argument("--long-rate", type=float, default=0.01,
+                        help="share of synthetic comments with thousands of "
+                             "words")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--allocations", type=int, default=10000,
+                        help="number of comments traced for allocations, "
+                             "0 skips it")
+    args = parser.parse_args()
+    helper_functions.logger.setLevel(logging.WARNING)
+
+    tables = AFSCTables(get_AFSCs(None), get_prefixes())
+    if args.corpus:
+        bodies = read_bodies(args.corpus, args.count)
+    else:
+        generator = CorpusGenerator(tables.full_afsc_dict, tables.prefix_dict,
+                                    afsc_rate=args.afsc_rate,
+                                    long_rate=args.long_rate, seed=args.seed)
+        bodies = list(generator.comments(args.count))
+    megabytes = sum(len(body.encode()) for body in bodies) / 1e6
+    print("{} comments, {:.1f}MB".format(len(bodies), megabytes))
+
+    stages = get_stages(tables)
+    total = 0
+    for name, seconds in bench_stages(bodies, stages, args.repeat):
+        total += seconds
+        print("{}: {:.3f}s, {:.1f}MB/s, {:.2f}us per comment".format(
+            name, seconds, megabytes / seconds, seconds / len(bodies) * 1e6))
+    print("total: {:.3f}s, {:.1f}MB/s, {:.0f} comments/sec".format(
+        total, megabytes / total, len(bodies) / total))
+
+    if args.allocations:
+        peak, kept = measure_allocations(bodies[:args.allocations], stages)
+        print("allocated per comment: {:.0f} bytes peak, {:.0f} bytes kept"
+              .format(peak, kept))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from helper_functions import print_and_log
+
+CHECKPOINT_FILE = "checkpoint.json"
+# how often the checkpoint is written, in seconds
+CHECKPOINT_INTERVAL = 10
+
+
+def get_position(comment):
+    """
+    :param comment: PRAW comment
+    :return: (created_utc, id as a number) tuple, later comments compare
+    greater. Ids are base 36 and increase over time, so they break ties
+    between comments created in the same second.
+    """
+    return (int(comment.created_utc), int(comment.id, 36))
+
+
+class StreamCheckpoint:
+    """
+    Remembers the last comment of the stream that was fully processed, so a
+    restart skips the backlog the stream yields again without running it
+    through the pipeline. Comments are started in stream order and may be
+    done in any order, by the workers or by the reply scheduler once the
+    reply was sent. The checkpoint only moves past a comment when it and
+    every comment streamed before it are done. The file is written at most
+    every interval seconds, from whichever thread moved the checkpoint,
+    and once more on exit.
+    """
+
+    def __init__(self, path=CHECKPOINT_FILE, interval=CHECKPOINT_INTERVAL):
+        """
+        :param path: path of the checkpoint file
+        :param interval: minimum number of seconds between writes
+        """
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        # comment id -> [position, fullname, done] in stream order
+        self.in_progress = OrderedDict()
+        self.position = None
+        self.fullname = None
+        self.last_flush = 0
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                checkpoint = json.load(f)
+            self.position = (checkpoint["created_utc"],
+                             int(checkpoint["fullname"][3:], 36))
+            self.fullname = checkpoint["fullname"]
+            print_and_log("Resuming after {}".format(self.fullname))
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            print_and_log("Couldn't read checkpoint, {}".format(e),
+                          error=True)
+
+    def seen(self, comment):
+        """
+        :param comment: PRAW comment from the stream
+        :return: True if the comment is at or before the checkpoint
+        """
+        return (self.position is not None
+                and get_position(comment) <= self.position)
+
+    def start(self, comment):
+        """
+        Records that a comment from the stream is being processed.
+        """
+        with self.lock:
+            if comment.id not in self.in_progress:
+                self.in_progress[comment.id] = [get_position(comment),
+                                                comment.fullname, False]
+
+    def done(self, comment):
+        """
+        Records that a comment needs no more work, and moves the checkpoint
+        past every comment done so far in stream order.
+        """
+        with self.lock:
+            entry = self.in_progress.get(comment.id)
+            if entry is None:
+                return
+            entry[2] = True
+            while self.in_progress:
+                position, fullname, is_done = next(
+                    iter(self.in_progress.values()))
+                if not is_done:
+                    break
+                self.in_progress.popitem(last=False)
+                if self.position is None or position > self.position:
+                    self.position = position
+                    self.fullname = fullname
+                    self.dirty = True
+            if self.dirty and time.time() - self.last_flush >= self.interval:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.flush_locked()
+
+    def flush_locked(self):
+        checkpoint = {"fullname": self.fullname,
+                      "created_utc": self.position[0]}
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(checkpoint, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print_and_log("Couldn't write checkpoint, {}".format(e),
+                          error=True)
+        self.last_flush = time.time()
+        self.dirty = False
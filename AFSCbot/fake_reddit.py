@@ -0,0 +1,319 @@
+import html
+import json
+import threading
+import time
+
+# number of ancestors reddit returns along with a refreshed comment
+CONTEXT_DEPTH = 8
+
+
+class FakeRedditor:
+    """
+    Stand-in for a PRAW Redditor, compares equal to its name like PRAW does.
+    """
+
+    def __init__(self, reddit, name):
+        self._reddit = reddit
+        self.name = name
+
+    def __eq__(self, other):
+        if isinstance(other, FakeRedditor):
+            other = other.name
+        return isinstance(other, str) and other.lower() == self.name.lower()
+
+    def __hash__(self):
+        return hash(self.name.lower())
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def comments(self):
+        return FakeListing(self._reddit.comments_by(self.name))
+
+    def message(self, subject, message):
+        self._reddit.api_call(self._reddit.reply_latency)
+        self._reddit.messages.append((self.name, subject, message))
+
+
+class FakeListing:
+    def __init__(self, items):
+        self.items = items
+
+    def new(self, limit=None):
+        return iter(self.items[::-1][:limit])
+
+
+class FakeSubmission:
+    def __init__(self, reddit, id):
+        self._reddit = reddit
+        self.id = id
+        self.fullname = "t3_" + id
+        # comments loaded so far, keyed by fullname like PRAW's
+        self._comments_by_id = {}
+
+
+class FakeComment:
+    """
+    Stand-in for a PRAW Comment. Like PRAW, a comment returned by parent()
+    or reddit.comment() is lazy: only its id is set until refresh() loads
+    it along with up to 8 of its ancestors, which costs one API call.
+    """
+
+    def __init__(self, reddit, id, submission=None):
+        self._reddit = reddit
+        self.id = id
+        self.fullname = "t1_" + id
+        if submission is not None:
+            self.submission = submission
+
+    def __eq__(self, other):
+        return isinstance(other, FakeComment) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "FakeComment(id={!r})".format(self.id)
+
+    def _load(self, register=False):
+        """
+        Sets the fields of the comment from the store.
+        :param register: whether the comment is added to its submission's
+        comment map, which only refresh() does
+        """
+        data = self._reddit.store[self.id]
+        self.body = data["body"]
+        self.author = (None if data["author"] is None else
+                       FakeRedditor(self._reddit, data["author"]))
+        self.parent_id = data["parent_id"]
+        self.link_id = data["link_id"]
+        self.created = self.created_utc = data["created_utc"]
+        self.is_root = self.parent_id.startswith("t3_")
+        self.subreddit = FakeSubreddit(self._reddit, data["subreddit"])
+        self.permalink = "/r/{}/comments/{}/_/{}/".format(
+            data["subreddit"], self.link_id[3:], self.id)
+        if "submission" not in self.__dict__:
+            # every comment gets its own lazy submission, like PRAW's
+            self.submission = self._reddit.submission(self.link_id[3:])
+        if register:
+            self.submission._comments_by_id[self.fullname] = self
+        return self
+
+    def parent(self):
+        if self.parent_id == self.submission.fullname:
+            return self.submission
+        if self.parent_id in self.submission._comments_by_id:
+            return self.submission._comments_by_id[self.parent_id]
+        return FakeComment(self._reddit, self.parent_id[3:], self.submission)
+
+    def refresh(self):
+        self._reddit.api_call(self._reddit.parent_latency)
+        self._load(register=True)
+        node = self
+        for _ in range(CONTEXT_DEPTH):
+            if node.is_root:
+                break
+            parent_key = node.parent_id[3:]
+            if parent_key not in self._reddit.store:
+                break
+            node = FakeComment(self._reddit, parent_key,
+                               self.submission)._load(register=True)
+        return self
+
+    def reply(self, body):
+        self._reddit.api_call(self._reddit.reply_latency)
+        reply = self._reddit.add_comment(body, self._reddit.username,
+                                         self.fullname, self.link_id)
+        self._reddit.replies.append((self.id, body))
+        return reply
+
+    def delete(self):
+        self._reddit.api_call(self._reddit.reply_latency)
+        self._reddit.deleted.append(self.id)
+
+
+class FakeWikiPage:
+    def __init__(self, reddit, content_html):
+        self._reddit = reddit
+        self._content_html = content_html
+
+    @property
+    def content_html(self):
+        self._reddit.api_call(self._reddit.parent_latency)
+        return self._content_html
+
+    def revisions(self, limit=None):
+        self._reddit.api_call(self._reddit.parent_latency)
+        return iter([{"id": str(hash(self._content_html))}][:limit])
+
+
+class FakeStream:
+    def __init__(self, reddit):
+        self._reddit = reddit
+
+    def comments(self, skip_existing=False):
+        """
+        Yields the streamed comments and stops, unlike PRAW's stream.
+        :param skip_existing: yield nothing, every comment already exists
+        """
+        if skip_existing:
+            return
+        for comment_id in self._reddit.stream_ids:
+            self._reddit.api_call(self._reddit.fetch_latency, 1 / 100)
+            yield FakeComment(self._reddit, comment_id)._load()
+
+
+class FakeSubreddit:
+    def __init__(self, reddit, display_name):
+        self._reddit = reddit
+        self.display_name = display_name
+        self.stream = FakeStream(reddit)
+        self.wiki = {}
+
+
+class FakeUser:
+    def __init__(self, reddit):
+        self._reddit = reddit
+
+    def me(self):
+        return FakeRedditor(self._reddit, self._reddit.username)
+
+
+class FakeAuth:
+    def __init__(self):
+        # no ratelimit headers, see ReplyScheduler.update_usage
+        self.limits = {}
+
+
+class FakeReddit:
+    """
+    In-process stand-in for praw.Reddit backed by a dict of comments, for
+    tests and benchmarks that shouldn't need credentials or the network.
+    Every method that would make a request counts an API call and sleeps
+    for the configured latency.
+    """
+
+    def __init__(self, username="AFSCbot", parent_latency=0.0,
+                 reply_latency=0.0, fetch_latency=0.0, wiki_links=()):
+        """
+        :param username: name of the logged in bot
+        :param parent_latency: seconds every comment fetch takes
+        :param reply_latency: seconds every reply takes
+        :param fetch_latency: seconds every stream request takes, a request
+        returns up to 100 comments
+        :param wiki_links: links served on the /r/AirForce wiki index page
+        """
+        self.username = username
+        self.parent_latency = parent_latency
+        self.reply_latency = reply_latency
+        self.fetch_latency = fetch_latency
+        self.wiki_html = "".join('<a href="{}">{}</a>'.format(
+            html.escape(link), link.split("/")[-1].upper())
+            for link in wiki_links)
+        # comment id -> dict of its fields
+        self.store = {}
+        self.threads = 0
+        # ids of the comments yielded by the subreddit stream, in order
+        self.stream_ids = []
+        self.replies = []
+        self.messages = []
+        self.deleted = []
+        self.api_calls = 0.0
+        self.lock = threading.Lock()
+        self.user = FakeUser(self)
+        self.auth = FakeAuth()
+        self.next_id = 0
+
+    def api_call(self, latency, cost=1):
+        """
+        Counts an API call and sleeps for its latency.
+        :param cost: fraction of a request, stream items share one request
+        """
+        with self.lock:
+            self.api_calls += cost
+        if latency:
+            time.sleep(latency * cost)
+
+    def add_comment(self, body, author, parent_id, link_id, created_utc=None,
+                    comment_id=None, subreddit="AirForce"):
+        """
+        Adds a comment to the store without streaming it.
+        :param parent_id: fullname of the parent, t3_ for a top level comment
+        :param link_id: fullname of the submission
+        :return: the loaded FakeComment
+        """
+        with self.lock:
+            if comment_id is None:
+                comment_id = "f{}".format(self.next_id)
+                self.next_id += 1
+            self.store[comment_id] = {
+                "body": body, "author": author, "parent_id": parent_id,
+                "link_id": link_id, "subreddit": subreddit,
+                "created_utc": (time.time() if created_utc is None
+                                else created_utc)}
+        return FakeComment(self, comment_id)._load()
+
+    def add_thread(self, bodies, author="someone", link_id=None, stream=True):
+        """
+        Adds a chain of comments, each replying to the one before it.
+        :param bodies: bodies of the comments, top level comment first
+        :param stream: whether the comments are yielded by the stream
+        :return: list of the FakeComments, top level comment first
+        """
+        if link_id is None:
+            link_id = "t3_s{}".format(self.threads)
+            self.threads += 1
+        parent_id = link_id
+        comments = []
+        for body in bodies:
+            comment = self.add_comment(body, author, parent_id, link_id)
+            comments.append(comment)
+            parent_id = comment.fullname
+            if stream:
+                self.stream_ids.append(comment.id)
+        return comments
+
+    def load_jsonl(self, path, stream=True):
+        """
+        Adds the comments of a JSONL file with one reddit comment object per
+        line, using the id, body, author, parent_id, link_id and
+        created_utc fields.
+        :return: number of comments loaded
+        """
+        count = 0
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                self.add_comment(data["body"], data.get("author"),
+                                 data["parent_id"], data["link_id"],
+                                 data.get("created_utc"), data["id"],
+                                 data.get("subreddit", "AirForce"))
+                if stream:
+                    self.stream_ids.append(data["id"])
+                count += 1
+        return count
+
+    def comments_by(self, name):
+        return [FakeComment(self, comment_id)._load()
+                for comment_id, data in self.store.items()
+                if data["author"] == name]
+
+    def submission(self, id):
+        return FakeSubmission(self, id)
+
+    def comment(self, id):
+        return FakeComment(self, id)
+
+    def info(self, fullnames):
+        self.api_call(self.parent_latency)
+        for fullname in fullnames:
+            if fullname[3:] in self.store:
+                yield FakeComment(self, fullname[3:])._load()
+
+    def subreddit(self, display_name):
+        subreddit = FakeSubreddit(self, display_name)
+        subreddit.wiki["index"] = FakeWikiPage(self, self.wiki_html)
+        return subreddit
@@ -1,22 +1,92 @@
-import time
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+LOG_FILE = os.environ.get("AFS_LOG_FILE", "AFSCbot.log")
+# DEBUG logs the per-match details, INFO and up is meant for production
+LOG_LEVEL = os.environ.get("AFS_LOG_LEVEL", "INFO").upper()
+# set to 0 to only write to the log file
+LOG_ECHO = os.environ.get("AFS_LOG_ECHO", "1") != "0"
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Queues records as they are, so the message is only formatted by the
+    background writer thread instead of the thread that logged it.
+    """
+
+    def prepare(self, record):
+        return record
 
-LOG_TIME_FORMAT = "%Y/%m/%d %H:%M:%S "
 
 logger = logging.getLogger("AFSCbot Rotating Log")
-logger.setLevel(logging.INFO)
-    
-# add a rotating handler
-handler = RotatingFileHandler("AFSCbot.log", maxBytes=2048000, backupCount=25)
-logger.addHandler(handler)
-
-def print_and_log(text, error=False):
-    print(text)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+# add a rotating handler, written to by a background thread
+handler = RotatingFileHandler(LOG_FILE, maxBytes=2048000, backupCount=25)
+handler.setFormatter(logging.Formatter("%(asctime)s %(message)s",
+                                       LOG_TIME_FORMAT))
+log_handlers = [handler]
+if LOG_ECHO:
+    echo_handler = logging.StreamHandler(sys.stdout)
+    echo_handler.setFormatter(logging.Formatter("%(message)s"))
+    log_handlers.append(echo_handler)
+
+log_queue = queue.SimpleQueue()
+logger.addHandler(LazyQueueHandler(log_queue))
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+# write out whatever is still queued on exit
+atexit.register(log_listener.stop)
+
+
+def log_to_queue(target):
+    """
+    Sends the records logged in a worker process to the parent. A forked
+    worker has a copy of log_queue but not the thread writing it out.
+    :param target: multiprocessing queue read by forward_logs
+    """
+    for queue_handler in list(logger.handlers):
+        logger.removeHandler(queue_handler)
+    # formats the message in the worker, so the record can be pickled
+    logger.addHandler(QueueHandler(target))
+
+
+def forward_logs(source):
+    """
+    :param source: multiprocessing queue the worker processes log to, see
+    log_to_queue
+    :return: started QueueListener passing the workers' records on to
+    logger, stop it once the workers exited
+    """
+    # a Logger has the handle() method QueueListener calls on its handlers
+    listener = QueueListener(source, logger)
+    listener.start()
+    return listener
+
+
+def print_and_log(text, *args, error=False):
+    """
+    Logs text at INFO, or ERROR if error is set. Any args are %-formatted
+    into text by the background writer.
+    """
     if error:
-        logger.error(time.strftime(LOG_TIME_FORMAT) + text)
+        logger.error(text, *args)
     else:
-        logger.info(time.strftime(LOG_TIME_FORMAT) + text)
+        logger.info(text, *args)
+
+
+def log_debug(text, *args):
+    """
+    Logs text at DEBUG. Costs a level check when debug logging is off, so
+    use %-style args rather than formatting text beforehand.
+    """
+    logger.debug(text, *args)
 
 
 def has_number(string):
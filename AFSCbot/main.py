@@ -1,103 +1,298 @@
+import argparse
+import asyncio
+import atexit
 import logging
 import sys
 import os
 import time
-from read_csv_files import get_AFSCs, get_prefixes
+import traceback
+from read_csv_files import (get_tables, CsvWatcher, SNAPSHOT_FILE,
+                            CSV_POLL_INTERVAL, WIKI_SUBREDDIT, WIKI_PAGE)
 from setup_bot import login
-from process_comment import generate_reply, send_reply
-from helper_functions import print_and_log
+from reply_scheduler import ReplyScheduler
+from pipeline import build_pipeline
+from helper_functions import log_debug, print_and_log
+from afsc_tables import TableStore
+from checkpoint import StreamCheckpoint, CHECKPOINT_FILE
+from shard import ClaimStore, Sharder, CLAIMS_DB
+from metrics import METRICS
+from worker_pool import WorkerPool
+from wiki_refresher import WikiLinkRefresher, WIKI_TTL, with_links
+from subreddit_config import (load_subreddit_configs, get_stream_name,
+                              SUBREDDIT_CONFIG_FILE)
+from replied_index import load_replied_index, REPLIED_DB
+from reply_journal import ReplyJournal, REPLY_JOURNAL_DB
 
 credsPassword = os.environ.get('AFS_PASSWORD')
 credsUserName = os.environ.get('AFS_USERNAME')
 credsClientSecret = os.environ.get('AFS_SECRET')
 credsClientID = os.environ.get("AFS_ID")
 credsUserAgent = os.environ.get("AFS_USERAGENT")
+# one subreddit or several joined with +, "AirForce+AFROTC"
 subreddit = os.environ.get("AFS_SUBREDDIT")
+subreddit_config_path = os.environ.get("AFS_SUBREDDIT_CONFIG",
+                                       SUBREDDIT_CONFIG_FILE)
+replied_db = os.environ.get("AFS_REPLIED_DB", REPLIED_DB)
+# SQLite file shared with AuthDelete, who each reply may be deleted by
+reply_journal_db = os.environ.get("AFS_REPLY_JOURNAL", REPLY_JOURNAL_DB)
+snapshot_path = os.environ.get("AFS_SNAPSHOT", SNAPSHOT_FILE)
+wiki_ttl = int(os.environ.get("AFS_WIKI_TTL", WIKI_TTL))
+csv_poll = int(os.environ.get("AFS_CSV_POLL", CSV_POLL_INTERVAL))
+checkpoint_path = os.environ.get("AFS_CHECKPOINT")
+# maximum edit distance of the corrected AFSC typos, 0 turns it off
+typo_distance = int(os.environ.get("AFS_TYPO_DISTANCE", 0))
+# 1 also answers "what's the AFSC for loadmaster?"
+title_lookup = os.environ.get("AFS_TITLE_LOOKUP") == "1"
+# SQLite file shared by the instances when the stream is sharded
+claims_db = os.environ.get("AFS_CLAIMS_DB", CLAIMS_DB)
 
-def checkForReplies(comment_list, rAirForceComments, permlink):
+# how often, in processed comments, the pipeline stats are logged
+STATS_INTERVAL = 100
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replies to AFSCs mentioned "
+                                                 "in reddit comments")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="process comments concurrently with asyncpraw")
+    parser.add_argument("--concurrency", type=int,
+                        default=int(os.environ.get("AFS_CONCURRENCY", 8)),
+                        help="maximum number of comments processed at once "
+                             "in --async mode")
+    parser.add_argument("--workers", type=int,
+                        default=int(os.environ.get("AFS_WORKERS", 0)),
+                        help="number of worker threads processing the stream, "
+                             "0 processes it in the main thread")
+    parser.add_argument("--queue-size", type=int,
+                        default=int(os.environ.get("AFS_QUEUE_SIZE", 100)),
+                        help="maximum number of comments waiting for a worker")
+    parser.add_argument("--skip-backlog", action="store_true",
+                        default=os.environ.get("AFS_SKIP_BACKLOG") == "1",
+                        help="ignore the comments made before the start, "
+                             "for a fast cold start")
+    parser.add_argument("--shard", type=int,
+                        default=int(os.environ.get("AFS_SHARD", 0)),
+                        help="shard served by this instance, from 0 to "
+                             "--shard-count - 1")
+    parser.add_argument("--shard-count", type=int,
+                        default=int(os.environ.get("AFS_SHARD_COUNT", 1)),
+                        help="number of instances sharing the stream, they "
+                             "coordinate through AFS_CLAIMS_DB")
+    return parser.parse_args()
+
+def handle_comment(rAirForceComment, comment_pipeline, scheduler):
+    """
+    Runs a streamed comment through the pipeline and queues the reply.
+    :param rAirForceComment: PRAW comment from the stream
+    :param comment_pipeline: Pipeline from build_pipeline
+    :param scheduler: ReplyScheduler the reply is submitted to
+    :return: True if a reply was queued
+    """
+    # prints a link to the comment. A True for permalink
+    # generates a fast find (but is not an accurate link,
+    # just makes the script faster (SIGNIFICANTLY FASTER)
+    log_debug("Processing comment: http://www.reddit.com%s",
+              rAirForceComment.permalink)
+
+    # local filters and AFSC lookups run before any network call
+    context = comment_pipeline.run(rAirForceComment)
+
+    if not context:
+        log_debug("No AFSC found, skipping...")
+        return False
+
+    # log that comment was prepared
+    print_and_log("Preparing to reply to id {} by author: {}".format(
+        rAirForceComment.id, rAirForceComment.author))
+    scheduler.submit(rAirForceComment, context.reply_text)
+    return True
+
+def start_table_stores(reddit, subreddit_configs, tables):
+    """
+    Gives every enabled subreddit the TableStore of its wiki. Subreddits
+    using the same wiki share a store, and every store gets its own wiki
+    refresher and CSV watcher. Only the default wiki's tables are written
+    to the snapshot.
+    :param reddit: PRAW reddit object
+    :param subreddit_configs: dict of SubredditConfig
+    :param tables: AFSCTables loaded at startup, with the default wiki's
+    links
+    :return: dict mapping (wiki_subreddit, wiki_page), or None for no
+    links, to TableStore
+    """
+    stores = {}
+    for config in subreddit_configs.values():
+        if not config.enabled:
+            continue
+        wiki = config.wiki
+        if wiki not in stores:
+            if wiki == (WIKI_SUBREDDIT, WIKI_PAGE):
+                store = TableStore(tables)
+                store_snapshot = snapshot_path
+            else:
+                store = TableStore(with_links(tables, {}, None))
+                store_snapshot = None
+            if wiki is not None:
+                # keeps the wiki links up to date without blocking the stream
+                WikiLinkRefresher(reddit, store, wiki_ttl, store_snapshot,
+                                  *wiki).start()
+            # reloads the tables when a CSV file is edited
+            CsvWatcher(store, csv_poll, store_snapshot).start()
+            stores[wiki] = store
+        config.store = stores[wiki]
+    return stores
+
+def start_sharder(args):
     """
-    Checks any replies the comment in question to see if the bot
-    has already replied
-    :param comment_list: a list of comments that are replies
-    :param rAirForceComments: the comment in question
-    :param permlink: permanent link to the comment
-    :return: returns true if the comment has already been replied to, otherwise false
+    :param args: parsed command line arguments
+    :return: running Sharder if the stream is split between several
+    instances, None otherwise
     """
-    for comment in comment_list:
-        if rAirForceComments.id in comment.body:
-            print_and_log("Already processed comment: " + permlink + ", skipping")
-            print("Comment already processed, skipping")
-            return True
-    return False
+    if args.shard_count <= 1:
+        return None
+    if not 0 <= args.shard < args.shard_count:
+        raise ValueError("shard {} is not between 0 and {}".format(
+            args.shard, args.shard_count - 1))
+    sharder = Sharder(ClaimStore(claims_db), args.shard, args.shard_count)
+    sharder.start()
+    print_and_log("Serving shard {} of {}".format(args.shard,
+                                                 args.shard_count))
+    return sharder
 
 def main():
+    args = parse_args()
+
     # Initialize a logging object
     #logging.basicConfig(filename='AFSCbot.log', level=logging.INFO)
     print_and_log("Starting script")
 
     # reddit user object
     reddit = login(credsUserName, credsPassword, credsClientSecret, credsClientID, credsUserAgent)
+    # Prometheus endpoint and/or metrics file, see AFS_METRICS_PORT/FILE
+    METRICS.start()
 
     # load all the AFSCs and prefixes into dictionaries
     try:
-        full_afsc_dict = get_AFSCs(reddit)
-        prefix_dict = get_prefixes()
-        # subreddit instance of /r/AirForce.
-        rAirForce = reddit.subreddit(subreddit)
+        tables = get_tables(snapshot_path)
+        print_and_log(tables.reply_lines.report())
+        subreddit_configs = load_subreddit_configs(subreddit,
+                                                   subreddit_config_path)
+        start_table_stores(reddit, subreddit_configs, tables)
+        # ids of comments the bot already replied to
+        replied_index = load_replied_index(reddit, replied_db)
+        journal = ReplyJournal(reply_journal_db)
+        # one combined stream of every enabled subreddit, "AirForce+AFROTC"
+        stream_name = get_stream_name(subreddit_configs)
+        rAirForce = reddit.subreddit(stream_name)
+        # splits the stream with the other instances, if any
+        sharder = start_sharder(args)
+        claims = sharder.store if sharder is not None else None
+        comment_pipeline = build_pipeline(None, replied_index,
+                                          [credsUserName], subreddit_configs,
+                                          claims, typo_distance,
+                                          title_lookup)
+        # last fully processed comment, so a restart skips the backlog.
+        # Every shard skips different comments, so each has its own file
+        checkpoint = StreamCheckpoint(
+            checkpoint_path or (CHECKPOINT_FILE if sharder is None else
+                                "checkpoint-{}.json".format(args.shard)))
+        atexit.register(checkpoint.flush)
+
+        def reply_done(comment):
+            # other instances must not reply to it after the claim expires
+            if claims is not None:
+                if comment.id in replied_index:
+                    claims.mark_replied(comment.id)
+                else:
+                    claims.release(comment.id)
+            checkpoint.done(comment)
+
+        # sends replies within the API budget without blocking the stream
+        scheduler = ReplyScheduler(reddit, replied_index, on_done=reply_done,
+                                   journal=journal)
+        scheduler.start()
     except Exception as e:
         print_and_log("Couldn't load dicts, {}".format(e), error=True)
         sys.exit(1)
 
-    print_and_log("Starting processing loop for subreddit: " + subreddit)
+    if args.use_async:
+        # only needed, and imported, in --async mode
+        from async_main import run_async
+        reddit_kwargs = {"user_agent": credsUserAgent,
+                         "client_id": credsClientID,
+                         "client_secret": credsClientSecret,
+                         "username": credsUserName,
+                         "password": credsPassword}
+        try:
+            asyncio.run(run_async(comment_pipeline, replied_index, stream_name,
+                                  reddit_kwargs, args.concurrency, checkpoint,
+                                  args.skip_backlog, sharder, journal))
+        except KeyboardInterrupt:
+            print_and_log("Exiting due to keyboard interrupt")
+        return
+
+    if args.workers > 0:
+        pool = WorkerPool(comment_pipeline, scheduler, args.workers,
+                          args.queue_size, checkpoint, sharder)
+        try:
+            pool.run(rAirForce, args.skip_backlog)
+        except KeyboardInterrupt:
+            print_and_log("Exiting due to keyboard interrupt")
+        return
+
+    print_and_log("Starting processing loop for subreddit: " + stream_name)
     comments_seen = 0
     try:
         while True:
             # stream all comments from /r/AirForce
-            for rAirForceComment in rAirForce.stream.comments():
+            for streamed in METRICS.timed(
+                    rAirForce.stream.comments(skip_existing=args.skip_backlog),
+                    "stream_fetch_seconds"):
 
-                #If the post is older than about 5 months, ignore it and move on.
-                if (time.time() - rAirForceComment.created) > 13148715:
-                    print_and_log("Post too old, continuing")
+                # already handled before the last restart
+                if checkpoint.seen(streamed):
+                    METRICS.inc("checkpoint_skipped_total")
                     continue
-                
-                # prints a link to the comment. A True for permalink
-                # generates a fast find (but is not an accurate link,
-                # just makes the script faster (SIGNIFICANTLY FASTER)
-                permlink = "http://www.reddit.com{}".format(
-                    rAirForceComment.permalink)
-                print_and_log("Processing comment: " + permlink)
-
-                # Check replies to make sure the bot hasn't responded yet
-                rAirForceComment.refresh()
-                rAirForceComment.replies.replace_more()
-                if checkForReplies(rAirForceComment.replies.list(), rAirForceComment, permlink):
-                    continue
-
-                reply_text = generate_reply(rAirForceComment,
-                                                full_afsc_dict, prefix_dict)
-
-                # log that comment was prepared
-                comment_info_text = (
-                "Preparing to reply to id {} by author: {}".format(
-                    rAirForceComment.id, rAirForceComment.author))
-                print_and_log(comment_info_text)
-
-                if reply_text:
-                    send_reply(reply_text, rAirForceComment)
-
+                # the comments of this instance's shards, with those of a
+                # shard it just took over
+                if sharder is None:
+                    comments = [streamed]
                 else:
-                    print_and_log("No AFSC found, skipping...")
+                    comments = sharder.route(streamed)
+                for rAirForceComment in comments:
+                    checkpoint.start(rAirForceComment)
+                    # an error only drops this comment, not the stream
+                    try:
+                        replying = handle_comment(rAirForceComment,
+                                                  comment_pipeline, scheduler)
+                    except Exception:
+                        print_and_log("Error processing comment {}\n{}".format(
+                            rAirForceComment.id, traceback.format_exc()),
+                            error=True)
+                        replying = False
+                    # comments with a reply are done once the scheduler sent
+                    # it
+                    if not replying:
+                        if claims is not None:
+                            claims.release(rAirForceComment.id)
+                        checkpoint.done(rAirForceComment)
 
                 comments_seen += 1
-                print_and_log("")
-                print_and_log("Comments processed since start of script: {}".format(
-                        comments_seen))
+                log_debug("Comments processed since start of script: %d",
+                          comments_seen)
+                if comments_seen % STATS_INTERVAL == 0:
+                    print_and_log("Comments processed since start of script: "
+                                  "{}".format(comments_seen))
+                    for line in comment_pipeline.report():
+                        print_and_log(line)
+                    for line in scheduler.report(comments_seen):
+                        print_and_log(line)
 
     # what to do if Ctrl-C is pressed while script is running
     except KeyboardInterrupt:
         print_and_log("Exiting due to keyboard interrupt")
     except Exception as err:
-        print_and_log(str(err.with_traceback())
+        print_and_log("Unhandled exception\n{}".format(
+            traceback.format_exc()), error=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,237 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import prawcore
+from helper_functions import print_and_log
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# port of the Prometheus text endpoint, 0 turns it off
+METRICS_PORT = int(os.environ.get("AFS_METRICS_PORT", 0))
+# file the metrics are flushed to, empty turns it off
+METRICS_FILE = os.environ.get("AFS_METRICS_FILE", "")
+# how often the metrics file is flushed, in seconds
+METRICS_INTERVAL = int(os.environ.get("AFS_METRICS_INTERVAL", 60))
+
+
+class Histogram:
+    """
+    Cumulative latency histogram in the Prometheus format.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: sorted upper bounds of the buckets, in seconds
+        """
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+class Metrics:
+    """
+    Registry of counters and latency histograms, keyed by metric name and
+    labels. Every update is a dict lookup and an add under a lock, so it
+    can be called from any thread in the hot path.
+    """
+
+    def __init__(self, namespace):
+        """
+        :param namespace: prefix of every metric name, "afscbot" for example
+        """
+        self.namespace = namespace
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Adds amount to a counter.
+        :param name: name of the counter, without the namespace
+        :param amount: number to add
+        :param labels: labels of the counter, stage="scan" for example
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records a latency in a histogram.
+        :param name: name of the histogram, without the namespace
+        :param seconds: latency to record
+        :param labels: labels of the histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Records the time spent in the with block in a histogram.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, iterable, name, **labels):
+        """
+        Records how long every item of iterable took to arrive, the stream
+        fetch time of a PRAW stream for example.
+        :param iterable: iterable to wrap
+        :return: generator yielding the items of iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(name, time.perf_counter() - start, **labels)
+            yield item
+
+    def render(self):
+        """
+        :return: string of every metric in the Prometheus text format
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(histogram.counts), histogram.count,
+                                       histogram.sum))
+                                for key, histogram
+                                in self.histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            full_name = "{}_{}".format(self.namespace, name)
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append("# TYPE {} counter".format(full_name))
+            lines.append("{}{} {}".format(full_name, format_labels(labels),
+                                          value))
+        for (name, labels), (counts, count, total) in histograms:
+            full_name = "{}_{}".format(self.namespace, name)
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append("# TYPE {} histogram".format(full_name))
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",),
+                                           counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(
+                    full_name, format_labels(labels + (("le", bound),)),
+                    cumulative))
+            lines.append("{}_sum{} {}".format(full_name, format_labels(labels),
+                                              total))
+            lines.append("{}_count{} {}".format(full_name,
+                                                format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serves the metrics on http://host:port/metrics from a background
+        thread.
+        :return: the server
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True,
+                         name="MetricsServer").start()
+        return server
+
+    def flush(self, path):
+        """
+        Writes the metrics to path, replacing it atomically so readers never
+        see a partial file.
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+    def flush_every(self, path, interval):
+        """
+        Flushes the metrics to path every interval seconds from a background
+        thread.
+        """
+        def flush_forever():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush(path)
+                except OSError as e:
+                    print_and_log("Couldn't write metrics, {}".format(e),
+                                  error=True)
+
+        threading.Thread(target=flush_forever, daemon=True,
+                         name="MetricsFlusher").start()
+
+    def start(self, port=METRICS_PORT, path=METRICS_FILE,
+              interval=METRICS_INTERVAL):
+        """
+        Starts the endpoint and the file flusher if they are configured.
+        """
+        if port:
+            self.serve(port)
+            print_and_log("Serving metrics on port {}".format(port))
+        if path:
+            self.flush_every(path, interval)
+            print_and_log("Writing metrics to {} every {}s".format(path,
+                                                                   interval))
+
+
+def format_labels(labels):
+    """
+    :param labels: tuple of (name, value) tuples
+    :return: string of the labels in the Prometheus format, {stage="scan"}
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, value)
+                          for name, value in labels) + "}"
+
+
+METRICS = Metrics("afscbot")
+
+
+class CountingRequestor(prawcore.Requestor):
+    """
+    Counts every HTTP request PRAW makes, pass it to praw.Reddit as
+    requestor_class.
+    """
+
+    def request(self, *args, **kwargs):
+        METRICS.inc("api_calls_total")
+        return super().request(*args, **kwargs)
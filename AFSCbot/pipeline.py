@@ -0,0 +1,343 @@
+import threading
+import time
+from helper_functions import log_debug
+from metrics import METRICS
+from process_comment import (filter_out_quotes, get_afsc_candidates,
+                             resolve_candidates, check_parents_for_matches,
+                             render_reply)
+from title_index import TITLE_TRIGGER_SEARCH
+from typo_index import TYPO_TOKEN_SEARCH
+
+# comments older than about 5 months are ignored
+MAX_COMMENT_AGE = 13148715
+
+
+class CommentContext:
+    """
+    State of a single comment as it moves through the pipeline stages.
+    """
+
+    def __init__(self, comment):
+        """
+        :param comment: PRAW comment being processed
+        """
+        self.comment = comment
+        # SubredditConfig of the comment's subreddit, None with a single
+        # subreddit
+        self.config = None
+        # AFSCTables used for the whole comment, even if new ones are published
+        self.tables = None
+        self.formatted_comment = ""
+        self.candidates = []
+        self.reply_text = []
+
+
+class Pipeline:
+    """
+    Ordered list of named stages a comment goes through. Each stage is a
+    callable taking a CommentContext and returning False to drop the
+    comment, in which case the remaining stages are skipped. The number of
+    calls, drops and the total time spent are recorded for every stage, and
+    the latency of every call goes to the stage_seconds histogram.
+    run() can be called from several threads at once.
+    """
+
+    def __init__(self, stages=()):
+        """
+        :param stages: iterable of (name, stage) tuples
+        """
+        self.stages = []
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        for name, stage in stages:
+            self.add_stage(name, stage)
+
+    def add_stage(self, name, stage, before=None):
+        """
+        Adds a stage to the pipeline.
+        :param name: unique name of the stage
+        :param stage: callable taking a CommentContext, returns False to drop
+        :param before: name of the stage to insert in front of, appended to
+        the end of the pipeline if None
+        """
+        index = len(self.stages)
+        if before is not None:
+            index = [stage_name for stage_name, _ in self.stages].index(before)
+        self.stages.insert(index, (name, stage))
+        self.stats[name] = {"calls": 0, "dropped": 0, "seconds": 0.0}
+
+    def remove_stage(self, name):
+        """
+        :param name: name of the stage to remove
+        """
+        self.stages = [(stage_name, stage) for stage_name, stage in self.stages
+                       if stage_name != name]
+        del self.stats[name]
+
+    def run(self, comment):
+        """
+        Runs a comment through every stage.
+        :param comment: PRAW comment to process
+        :return: the CommentContext if the comment made it through every
+        stage, otherwise None
+        """
+        context = CommentContext(comment)
+        METRICS.inc("comments_total")
+        for name, stage in self.stages:
+            stats = self.stats[name]
+            start = time.perf_counter()
+            keep = stage(context)
+            elapsed = time.perf_counter() - start
+            METRICS.observe("stage_seconds", elapsed, stage=name)
+            with self.stats_lock:
+                stats["seconds"] += elapsed
+                stats["calls"] += 1
+                if not keep:
+                    stats["dropped"] += 1
+            if not keep:
+                return None
+        return context
+
+    def report(self):
+        """
+        :return: list of strings, one line of stats per stage
+        """
+        lines = []
+        for name, _ in self.stages:
+            stats = self.stats[name]
+            average = stats["seconds"] / stats["calls"] if stats["calls"] else 0
+            lines.append("{}: {} calls, {} dropped, {:.3f}ms avg".format(
+                name, stats["calls"], stats["dropped"], average * 1000))
+        return lines
+
+
+def table_pinner(store):
+    """
+    :param store: TableStore holding the current AFSCTables
+    :return: stage pinning the current tables to the comment
+    """
+    def stage(context):
+        context.tables = store.current
+        return True
+    return stage
+
+
+def subreddit_router(configs):
+    """
+    :param configs: dict mapping lowercase subreddit names to
+    SubredditConfig, see load_subreddit_configs
+    :return: stage pinning the config and current tables of the comment's
+    subreddit, dropping comments from disabled or unknown subreddits
+    """
+    def stage(context):
+        config = configs.get(context.comment.subreddit.display_name.lower())
+        if config is None or not config.enabled:
+            return False
+        context.config = config
+        context.tables = config.store.current
+        return True
+    return stage
+
+
+def age_filter(max_age=MAX_COMMENT_AGE):
+    """
+    :param max_age: maximum age of a comment in seconds, the subreddit's
+    max_age is used instead if the comment has a config
+    :return: stage dropping comments older than max_age
+    """
+    def stage(context):
+        limit = max_age if context.config is None else context.config.max_age
+        if (time.time() - context.comment.created) > limit:
+            log_debug("Post too old, continuing")
+            return False
+        return True
+    return stage
+
+
+def author_filter(ignored_authors):
+    """
+    :param ignored_authors: usernames whose comments are skipped, the bot
+    itself for example
+    :return: stage dropping comments by any of the ignored authors
+    """
+    ignored = set(author.lower() for author in ignored_authors if author)
+
+    def stage(context):
+        author = context.comment.author
+        return author is None or author.name.lower() not in ignored
+    return stage
+
+
+def quote_filter(context):
+    """
+    Removes quoted text from the comment body.
+    """
+    context.formatted_comment = filter_out_quotes(context.comment.body)
+    return True
+
+
+def regex_scan(context):
+    """
+    Finds everything that looks like an AFSC, drops the comment if none.
+    """
+    context.candidates = get_afsc_candidates(context.formatted_comment)
+    return bool(context.candidates)
+
+
+def typo_scan(context):
+    """
+    regex_scan of the typo correcting mode, also keeps the comments with
+    a code that could be a mistyped AFSC.
+    """
+    context.candidates = get_afsc_candidates(context.formatted_comment)
+    return bool(context.candidates or
+                TYPO_TOKEN_SEARCH.search(context.formatted_comment))
+
+
+def title_scan(scan_stage):
+    """
+    :param scan_stage: scan stage the title lookups are added to
+    :return: stage that also answers "what's the AFSC for loadmaster?",
+    with the AFSCs of the job title asked for
+    """
+    def stage(context):
+        found = scan_stage(context)
+        trigger = TITLE_TRIGGER_SEARCH.search(context.formatted_comment)
+        if trigger is None:
+            return found
+        lookups = context.tables.title_index.candidates(trigger.group(1))
+        METRICS.inc("title_lookups_total")
+        log_debug("Looked up \"%s\", found %d AFSCs", trigger.group(1),
+                  len(lookups))
+        context.candidates = list(context.candidates) + lookups
+        return bool(found or lookups)
+    return stage
+
+
+def afsc_resolver(context):
+    """
+    Keeps only the candidates that exist in the AFSC dicts.
+    """
+    context.candidates = resolve_candidates(context.candidates,
+                                            context.tables.full_afsc_dict)
+    METRICS.inc("matches_total", len(context.candidates))
+    return bool(context.candidates)
+
+
+def typo_resolver(max_distance):
+    """
+    :param max_distance: maximum edit distance of a correction, 1 or 2
+    :return: afsc_resolver stage that also adds the corrected near misses
+    of enlisted AFSCs
+    """
+    def stage(context):
+        tables = context.tables
+        candidates = resolve_candidates(context.candidates,
+                                        tables.full_afsc_dict)
+        corrections = tables.get_typo_index(max_distance).correct(
+            context.formatted_comment, candidates)
+        context.candidates = candidates + corrections
+        METRICS.inc("matches_total", len(candidates))
+        METRICS.inc("typo_matches_total", len(corrections))
+        return bool(context.candidates)
+    return stage
+
+
+def replied_filter(replied_index):
+    """
+    :param replied_index: RepliedIndex of comments already replied to
+    :return: stage dropping comments the bot already replied to
+    """
+    def stage(context):
+        if context.comment.id in replied_index:
+            log_debug("Already processed comment: %s, skipping",
+                      context.comment.id)
+            return False
+        return True
+    return stage
+
+
+def claim_filter(claims):
+    """
+    :param claims: ClaimStore shared with the other instances
+    :return: stage dropping comments claimed by another instance
+    """
+    def stage(context):
+        if not claims.claim(context.comment.id):
+            log_debug("Comment %s claimed by another instance, skipping",
+                      context.comment.id)
+            return False
+        return True
+    return stage
+
+
+def ancestry_filter(context):
+    """
+    Drops the candidates already mentioned further up the comment thread.
+    """
+    previous_matches = check_parents_for_matches(
+        context.comment, [match.group(1).upper() for dict_type, match
+                          in context.candidates])
+    context.candidates = [(dict_type, match) for dict_type, match
+                          in context.candidates
+                          if match.group(1).upper() not in previous_matches]
+    return bool(context.candidates)
+
+
+def renderer(context):
+    """
+    Builds the reply lines of the remaining candidates.
+    """
+    tables = context.tables
+    context.reply_text = render_reply(context.candidates,
+                                      tables.full_afsc_dict,
+                                      tables.prefix_dict, tables.reply_lines)
+    return bool(context.reply_text)
+
+
+def build_pipeline(store, replied_index, ignored_authors=(),
+                   subreddit_configs=None, claims=None, typo_distance=0,
+                   title_lookup=False):
+    """
+    Builds the default comment pipeline. Cheap local stages come first, the
+    stages that hit the network only see comments with a valid AFSC.
+    :param store: TableStore holding the current AFSCTables
+    :param replied_index: RepliedIndex of comments already replied to
+    :param ignored_authors: usernames whose comments are skipped
+    :param subreddit_configs: optional dict of SubredditConfig, the tables
+    and age cutoff then come from the comment's subreddit instead of store
+    :param claims: optional ClaimStore, comments are claimed before any
+    network call when several instances share the stream
+    :param typo_distance: maximum edit distance of the enlisted AFSC near
+    misses answered with a "did you mean", 0 doesn't correct any
+    :param title_lookup: also answer the comments asking for the AFSC of a
+    job title
+    :return: Pipeline
+    """
+    if subreddit_configs is None:
+        tables_stage = table_pinner(store)
+    else:
+        tables_stage = subreddit_router(subreddit_configs)
+    if typo_distance:
+        scan_stage = typo_scan
+        resolve_stage = typo_resolver(typo_distance)
+    else:
+        scan_stage = regex_scan
+        resolve_stage = afsc_resolver
+    if title_lookup:
+        scan_stage = title_scan(scan_stage)
+    comment_pipeline = Pipeline([
+        ("tables", tables_stage),
+        ("age", age_filter()),
+        ("author", author_filter(ignored_authors)),
+        ("quotes", quote_filter),
+        ("scan", scan_stage),
+        ("resolve", resolve_stage),
+        ("dedup", replied_filter(replied_index)),
+        ("ancestry", ancestry_filter),
+        ("render", renderer),
+    ])
+    if claims is not None:
+        comment_pipeline.add_stage("claim", claim_filter(claims),
+                                   before="ancestry")
+    return comment_pipeline
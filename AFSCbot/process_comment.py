@@ -1,9 +1,15 @@
 import re
-from helper_functions import print_and_log
+from collections import namedtuple
+from helper_functions import log_debug, print_and_log
+from ancestry import get_ancestors
 
 ENLISTED_AFSC_REGEX = "(?:^|\s|[\,])(([A-Z]?)(\d[A-Z]\d([013579]|X)\d)([A-Z]?))"
 OFFICER_AFSC_REGEX = "(?:^|\s)(([A-Z]?)(\d\d[A-Z]([013579]|X?))([A-Z]?))"
 
+# compiled once, enlisted matching is NOT case sensitive, officer matching IS
+ENLISTED_AFSC_SEARCH = re.compile(ENLISTED_AFSC_REGEX, re.IGNORECASE)
+OFFICER_AFSC_SEARCH = re.compile(OFFICER_AFSC_REGEX)
+
 ENLISTED_SKILL_LEVELS = ['Helper', '', 'Apprentice', '', 'Journeyman', '',
                          'Craftsman', '', 'Superintendent']
 
@@ -13,69 +19,225 @@ COMMENT_HEADER = ("^^You've ^^mentioned ^^an ^^AFSC, ^^here's ^^the"
 COMMENT_FOOTER = ("\n\n[^^Source](https://github.com/HadManySons/AFSCbot)"
                   " ^^| [^^Subreddit](https://www.reddit.com/r/AFSCbot/)")
 
-def check_parents_for_matches(comment, match):
+class AFSCMatch(namedtuple("AFSCMatch", ["whole_match", "prefix", "afsc",
+                                           "skill_level", "suffix"])):
+    """
+    Groups of a single AFSC found by the AFSCScanner. group() follows the
+    group numbers of ENLISTED_AFSC_REGEX and OFFICER_AFSC_REGEX, so it can
+    be used in place of their regex matches.
+    """
+    __slots__ = ()
+
+    def group(self, index):
+        return self[index - 1]
+
+
+class CorrectedMatch(AFSCMatch):
+    """
+    AFSCMatch of a near miss corrected by the TypoIndex. whole_match is the
+    code as it was typed, the other groups are those of the AFSC it was
+    corrected to. The reply line asks whether that AFSC was meant.
+    """
+    __slots__ = ()
+
+
+class AFSCScanner:
+    """
+    Finds both enlisted and officer AFSCs in a single pass over the text,
+    with one combined pattern. Text without a digit can't contain an AFSC
+    and is rejected before the pattern runs.
+    """
+
+    def __init__(self):
+        # the scoped flag keeps officer matching case sensitive
+        self.search = re.compile("(?i:{})|{}".format(ENLISTED_AFSC_REGEX,
+                                                     OFFICER_AFSC_REGEX))
+        self.has_digit = re.compile(r"\d").search
+
+    def scan(self, formatted_comment):
+        """
+        :param formatted_comment: string not including any quoted text
+        :return: list of (dict_type, AFSCMatch) tuples in the order they
+        appear in the text
+        """
+        if not self.has_digit(formatted_comment):
+            return []
+        candidates = []
+        for match in self.search.finditer(formatted_comment):
+            groups = match.groups()
+            if groups[0] is not None:
+                candidates.append(("enlisted", AFSCMatch(*groups[:5])))
+            else:
+                candidates.append(("officer", AFSCMatch(*groups[5:])))
+        return candidates
+
+
+AFSC_SCANNER = AFSCScanner()
+
+
+def check_parents_for_matches(comment, matches):
     """
     Checks parent comments for any previous matches of an
-    AFSC, so the bot doesn't spam a comment thread
+    AFSC, so the bot doesn't spam a comment thread. The thread is walked
+    once for all matches, over the in-memory list of parent bodies.
     :param comment: a PRAW instance of a comment
-    :param match: a string containing an AFSC to check. "1A1X1" for example. Needs to be
-    in uppercase
-    :return: Returns true if a previous match was found, otherwise false if it
-    reaches a top level comment without finding a match.
+    :param matches: strings containing AFSCs to check. "1A1X1" for example.
+    Need to be in uppercase
+    :return: Returns the set of matches found in a parent comment, empty if
+    it reaches a top level comment without finding any.
     """
     if comment.is_root:
-        print_and_log("Is top level comment")
-        return False
-    else:
-        formatted_parent_comment = comment.parent().body
-        formatted_parent_comment = formatted_parent_comment.upper()
-        if match in formatted_parent_comment:
-            print_and_log("Previous match")
-            return True
-        else:
-            print_and_log("Checking next parent")
-            return check_parents_for_matches(comment.parent(), match)
+        log_debug("Is top level comment")
+        return set()
+
+    return find_previous_matches(get_ancestors(comment), matches)
+
 
-def generate_reply(comment, full_afsc_dict, prefix_dict):
+def find_previous_matches(parent_bodies, matches):
+    """
+    Finds the matches that were already mentioned in a parent comment.
+    :param parent_bodies: upper-cased bodies of the parent comments
+    :param matches: strings containing AFSCs to check, in uppercase
+    :return: set of matches found in a parent comment
+    """
+    remaining = set(matches)
+    previous = set()
+    for parent_body in parent_bodies:
+        found = set(match for match in remaining if match in parent_body)
+        if found:
+            log_debug("Previous match: %s", ", ".join(sorted(found)))
+            previous |= found
+            remaining -= found
+            if not remaining:
+                break
+    return previous
+
+def generate_reply(comment, full_afsc_dict, prefix_dict, reply_lines=None,
+                   typo_index=None):
     """
     Generates a reply to a given comment based on any AFSC mentioned.
+    All local work (quote filtering, regex scan and dictionary lookup) is
+    done first, the parent comments are only fetched if the comment
+    mentions at least one valid AFSC.
     :param comment: string body of comment to be replied to 
-    :param full_afsc_dict: dict used for afsc lookups
+    :param full_afsc_dict: AFSCTable used for afsc lookups
     :param prefix_dict: dict used for prefix lookups
+    :param reply_lines: optional ReplyLineIndex used to render the reply
+    :param typo_index: optional TypoIndex, near misses of an AFSC are then
+    answered with the AFSC they probably meant
     :return: a list of strings representing lines that will be in the reply
     """
 
     formatted_comment = filter_out_quotes(comment.body)
 
-    # Search through the comments for things that look like enlisted AFSCs
-    matched_comments_enlisted = get_enlisted_regex_matches(formatted_comment)
-    matched_comments_officer = get_officer_regex_matches(formatted_comment)
+    # Search through the comment for things that look like AFSCs and
+    # keep the ones that exist
+    candidates = resolve_candidates(get_afsc_candidates(formatted_comment),
+                                    full_afsc_dict)
+    if typo_index is not None:
+        candidates += typo_index.correct(formatted_comment, candidates)
+    if not candidates:
+        return []
 
-    # prepare dicts for enlisted and officer AFSCs
-    enlisted_afsc_dict = full_afsc_dict["enlisted"]
-    enlisted_prefix_dict = prefix_dict["enlisted"]
-    officer_afsc_dict = full_afsc_dict["officer"]
-    officer_prefix_dict = prefix_dict["officer"]
+    # walk the thread once for every match
+    previous_matches = check_parents_for_matches(
+        comment, [match.group(1).upper() for dict_type, match in candidates])
+    candidates = [(dict_type, match) for dict_type, match in candidates
+                  if match.group(1).upper() not in previous_matches]
 
-    comment_text = []
+    return render_reply(candidates, full_afsc_dict, prefix_dict, reply_lines)
 
-    # process all enlisted
-    for match in matched_comments_enlisted:
-        if check_parents_for_matches(comment, match.group(1).upper()):
-            continue
-        comment_text = process_comment(comment_text, match,
-                                        enlisted_afsc_dict, enlisted_prefix_dict)
 
-    # process all officer
-    for match in matched_comments_officer:
-        if check_parents_for_matches(comment, match.group(1).upper()):
-            continue
-        comment_text = process_comment(comment_text, match,
-                                       officer_afsc_dict, officer_prefix_dict)
+def get_afsc_candidates(formatted_comment):
+    """
+    Gets every match that looks like an AFSC, enlisted first.
+    :param formatted_comment: string not including any quoted text
+    :return: list of (dict_type, AFSCMatch) tuples
+    """
+    candidates = AFSC_SCANNER.scan(formatted_comment)
+    return ([candidate for candidate in candidates
+             if candidate[0] == "enlisted"] +
+            [candidate for candidate in candidates
+             if candidate[0] == "officer"])
+
+
+def resolve_candidates(candidates, full_afsc_dict):
+    """
+    Drops the candidates whose base AFSC isn't in the AFSC dicts.
+    :param candidates: list of (dict_type, regex match) tuples
+    :param full_afsc_dict: AFSCTable used for afsc lookups
+    :return: list of (dict_type, regex match) tuples of existing AFSCs
+    """
+    resolved = []
+    for dict_type, match in candidates:
+        afsc, tempAFSC = get_base_afsc(match.group(3).upper(),
+                                       match.group(4).upper(), dict_type)
+        if tempAFSC in full_afsc_dict.partition(dict_type):
+            resolved.append((dict_type, match))
+        else:
+            log_debug("Did not find %s in %s AFSCs", tempAFSC, dict_type)
+    return resolved
+
 
+def render_reply(candidates, full_afsc_dict, prefix_dict, reply_lines=None):
+    """
+    Builds the reply lines for the given candidates.
+    :param candidates: list of (dict_type, regex match) tuples
+    :param full_afsc_dict: AFSCTable used for afsc lookups
+    :param prefix_dict: dict used for prefix lookups
+    :param reply_lines: optional ReplyLineIndex, lines are looked up in it
+    instead of being built for every match
+    :return: a list of strings representing lines that will be in the reply
+    """
+    comment_text = []
+    for dict_type, match in candidates:
+        if isinstance(match, CorrectedMatch):
+            # the line of the AFSC it was corrected to, as a question
+            for comment_line in render_reply(
+                    [(dict_type, AFSCMatch(*match))], full_afsc_dict,
+                    prefix_dict, reply_lines):
+                comment_line = "Did you mean " + comment_line
+                if comment_line not in comment_text:
+                    comment_text.append(comment_line)
+            continue
+        if reply_lines is None:
+            comment_text = process_comment(
+                comment_text, match, full_afsc_dict.partition(dict_type),
+                prefix_dict[dict_type], dict_type)
+            continue
+        comment_line = reply_lines.lookup(match, dict_type)
+        if comment_line is not None and comment_line not in comment_text:
+            comment_text.append(comment_line)
     return comment_text
 
 
+def get_base_afsc(afsc, skill_level, dict_type):
+    """
+    Standardizes the skill level of an AFSC to find its base AFSC.
+    :param afsc: uppercase AFSC from the regex match, "1W051" for example
+    :param skill_level: uppercase skill level from the regex match
+    :param dict_type: "enlisted" or "officer"
+    :return: tuple of the AFSC as it is printed and the base AFSC used for
+    lookups, ("1W051", "1W0X1") for example
+    """
+    if dict_type == "enlisted":
+        if skill_level != "0":
+            # replaces the skill level with an X
+            tempAFSC = afsc[:3] + "X" + afsc[4:]
+        else:
+            tempAFSC = afsc
+    else:
+        # standardize officer tempAFSC to be 12SX
+        if skill_level == "X":
+            tempAFSC = afsc
+        elif skill_level.isnumeric():
+            afsc = afsc[:-1] + "X"  # skill level printed as X
+            tempAFSC = afsc
+        else:
+            tempAFSC = afsc + 'X'
+    return afsc, tempAFSC
+
+
 def get_enlisted_regex_matches(formatted_comment):
     """
     Gets a regex match for enlisted AFSCs. 
@@ -83,8 +245,7 @@ def get_enlisted_regex_matches(formatted_comment):
     :param formatted_comment: string not including any quoted text
     :return: regex matches
     """
-    enlisted_AFSC_search = re.compile(ENLISTED_AFSC_REGEX, re.IGNORECASE)
-    matched_comments_enlisted = enlisted_AFSC_search.finditer(formatted_comment)
+    matched_comments_enlisted = ENLISTED_AFSC_SEARCH.finditer(formatted_comment)
     return matched_comments_enlisted
 
 
@@ -97,26 +258,79 @@ def get_officer_regex_matches(formatted_comment):
     """
     # officer afsc matching is case sensitive to prevent 12s
     # from matching 12S and other officer AFSCs
-    officer_AFSC_search = re.compile(OFFICER_AFSC_REGEX)
-    matched_comments_officer = officer_AFSC_search.finditer(formatted_comment)
+    matched_comments_officer = OFFICER_AFSC_SEARCH.finditer(formatted_comment)
     return matched_comments_officer
 
 
-def send_reply(comment_text, rAirForceComment):
+def send_reply(comment_text, rAirForceComment, replied_index=None,
+               journal=None):
     """
     Replies to rAirForceComment with comment_text using Bot that is 
     currently logged in.
     :param comment_text: list of strings representing lines in the reply
     :param rAirForceComment: reddit comment to be replied to
+    :param replied_index: optional RepliedIndex, the comment id is recorded
+    in it once the reply was sent
+    :param journal: optional ReplyJournal, the reply is recorded in it so
+    AuthDelete can tell who may delete it
     """
-    print_and_log("comment: {}".format(comment_text))
+    log_debug("comment: %s", comment_text)
 
-    comment_str = "\n\n".join(comment_text)
-    rAirForceComment.reply(COMMENT_HEADER + comment_str + COMMENT_FOOTER + " ^^^^^^" + rAirForceComment.id)
+    reply = rAirForceComment.reply(build_reply_body(comment_text,
+                                                    rAirForceComment.id))
+    record_sent(rAirForceComment, reply, replied_index, journal)
 
     print_and_log("Sent reply...")
 
 
+def record_sent(comment, reply, replied_index=None, journal=None):
+    """
+    Records a reply once it was sent. The reply can't be taken back, so
+    errors are only logged and never make the caller send it again.
+    :param comment: reddit comment that was replied to
+    :param reply: reddit comment the bot replied with
+    :param replied_index: optional RepliedIndex the comment id is recorded in
+    :param journal: optional ReplyJournal the reply is recorded in
+    """
+    if replied_index is not None:
+        try:
+            replied_index.add(comment.id)
+        except Exception as err:
+            print_and_log("Couldn't record the reply to {}, {}".format(
+                comment.id, err), error=True)
+    record_reply(journal, reply, comment)
+
+
+def record_reply(journal, reply, comment):
+    """
+    Records who may delete a reply. Replies to a deleted comment have no
+    author to record.
+    :param journal: ReplyJournal, or None to record nothing
+    :param reply: reddit comment the bot replied with
+    :param comment: reddit comment that was replied to
+    """
+    if journal is None or reply is None or comment.author is None:
+        return
+    try:
+        journal.record(reply.id, comment.id, comment.author.name)
+    except Exception as err:
+        # AuthDelete falls back to fetching the reply's parent
+        print_and_log("Couldn't record reply {}, {}".format(reply.id, err),
+                      error=True)
+
+
+def build_reply_body(comment_text, comment_id):
+    """
+    Builds the full text of a reply, ending with the id of the comment
+    replied to so the bot can tell it already replied.
+    :param comment_text: list of strings representing lines in the reply
+    :param comment_id: id of the comment replied to
+    :return: string of the reply
+    """
+    comment_str = "\n\n".join(comment_text)
+    return COMMENT_HEADER + comment_str + COMMENT_FOOTER + " ^^^^^^" + comment_id
+
+
 def filter_out_quotes(comment):
     """
     Removes any quoted text from reddit comment text. On reddit, lines of 
@@ -135,15 +349,16 @@ def filter_out_quotes(comment):
     return "\n\n".join(lines)
 
 
-def process_comment(comment_text, match, afsc_dict, prefix_dict):
+def process_comment(comment_text, match, afsc_dict, prefix_dict, dict_type):
     """
     Takes the given enlisted AFSC match and appends a line of reply 
     to comment_text. If there is a wiki page it will also reply with that. If 
     there are no matches to AFSC dict then there is no change to comment_text.
     :param comment_text: list of strings representing lines in the reply
     :param match: regex match of enlisted AFSC
-    :param afsc_dict: dict used for AFSC lookup
+    :param afsc_dict: enlisted or officer partition of the AFSCTable
     :param prefix_dict: dict used for prefix lookup
+    :param dict_type: "enlisted" or "officer"
     :return: modified comment_text with 0, 1, or 2 appended
     """
 
@@ -153,93 +368,100 @@ def process_comment(comment_text, match, afsc_dict, prefix_dict):
     skill_level = match.group(4).upper()
     suffix = match.group(5).upper()
 
-    dict_type = afsc_dict["dict_type"]
-
     #print("Whole match: " + whole_match)
     if prefix:
-        print("Prefix: " + prefix)
-    print("AFSC: " + afsc)
+        log_debug("Prefix: %s", prefix)
+    log_debug("AFSC: %s", afsc)
     if skill_level:
-        print("Skill Level: " + skill_level)
+        log_debug("Skill Level: %s", skill_level)
     if suffix:
-        print("Suffix: " + suffix)
+        log_debug("Suffix: %s", suffix)
 
     # handle skill levels
-    if dict_type == "enlisted":
-        if skill_level != "0":
-            # replaces the skill level with an X
-            tempAFSC = afsc[:3] + "X" + afsc[4:]
-        else:
-            tempAFSC = afsc
-    else:
-        # standardize officer tempAFSC to be 12SX
-        if skill_level == "X":
-            tempAFSC = afsc
-        elif skill_level.isnumeric():
-            afsc = afsc[:-1] + "X"  # skill level printed as X
-            tempAFSC = afsc[:-1] + "X"
-        else:
-            tempAFSC = afsc + 'X'
+    afsc, tempAFSC = get_base_afsc(afsc, skill_level, dict_type)
 
-    comment_line = ""
     # if comment base AFSC is in dict of base AFSC's
-    if tempAFSC in afsc_dict.keys():
-        print_and_log("from whole_match: {}, found {} in {} AFSCs"
-                      .format(whole_match, tempAFSC, dict_type))
-
-        # build whole AFSC only if prefix and suffix exist
-        if prefix in prefix_dict.keys():
-            comment_line += prefix
-        comment_line += afsc
-        if suffix in afsc_dict[tempAFSC]["shreds"].keys():
-            comment_line += suffix
-        comment_line += " = "
-
-        # Is there a prefix? If so, add its title
+    afsc_info = afsc_dict.get(tempAFSC)
+    if afsc_info is not None:
+        log_debug("from whole_match: %s, found %s in %s AFSCs",
+                  whole_match, tempAFSC, dict_type)
+
+        # Is there a prefix or suffix? If so, log if its title was found
         if prefix:
             if prefix in prefix_dict.keys():
-                comment_line += prefix_dict[prefix] + " "
-                print_and_log("found prefix {} in {} dict"
-                              .format(prefix, dict_type))
+                log_debug("found prefix %s in %s dict", prefix, dict_type)
             else:
-                print_and_log("could not find prefix {} in {} dict"
-                              .format(prefix, dict_type))
-
-        # add job title
-        comment_line += afsc_dict[tempAFSC]["job_title"]
-
-        # add skill level, officer skill level is ignored
-        if dict_type == "enlisted":
-            # if skill level given is not X or O, describe skill level given
-            if skill_level != 'X' and skill_level != '0':
-                comment_line += " " + \
-                ENLISTED_SKILL_LEVELS[int(skill_level) - 1]
-
-        # Is there a suffix? If so, add its title
+                log_debug("could not find prefix %s in %s dict",
+                          prefix, dict_type)
         if suffix:
-            if suffix in afsc_dict[tempAFSC]["shreds"].keys():
-                comment_line += ", " + afsc_dict[tempAFSC]["shreds"][suffix]
-                print_and_log("found suffix {} under {}"
-                          .format(suffix, tempAFSC))
+            if afsc_info.shred(suffix) is not None:
+                log_debug("found suffix %s under %s", suffix, tempAFSC)
             else:
-                print_and_log("could not find suffix {} under {}"
-                              .format(suffix, tempAFSC))
-
-        # Is there a link? If so, add its link
-        afsc_link = afsc_dict[tempAFSC]["link"]
-        if afsc_link:
-            comment_line += " [^wiki]({})".format(afsc_link)
-            print_and_log("found a link for {} at {}"
-                          .format(tempAFSC, afsc_link))
+                log_debug("could not find suffix %s under %s",
+                          suffix, tempAFSC)
 
+        comment_line = build_comment_line(prefix, afsc, skill_level, suffix,
+                                          afsc_info, prefix_dict,
+                                          dict_type)
         if comment_line not in comment_text:
             comment_text.append(comment_line)
     else:
-        print_and_log("Did not find {} in {} AFSCs".format(tempAFSC, dict_type))
-    print_and_log("-------")
+        log_debug("Did not find %s in %s AFSCs", tempAFSC, dict_type)
+    log_debug("-------")
     return comment_text
 
 
+def build_comment_line(prefix, afsc, skill_level, suffix, afsc_info,
+                       prefix_dict, dict_type):
+    """
+    Builds the reply line of a single AFSC. Prefixes and suffixes that
+    don't exist are left out.
+    :param prefix: uppercase prefix, can be empty
+    :param afsc: uppercase AFSC as it is printed, see get_base_afsc
+    :param skill_level: uppercase skill level, can be empty
+    :param suffix: uppercase suffix, can be empty
+    :param afsc_info: AFSCRecord of the base AFSC
+    :param prefix_dict: dict used for prefix lookup
+    :param dict_type: "enlisted" or "officer"
+    :return: string of the reply line
+    """
+    comment_line = ""
+    shred_title = afsc_info.shred(suffix)
+
+    # build whole AFSC only if prefix and suffix exist
+    if prefix in prefix_dict.keys():
+        comment_line += prefix
+    comment_line += afsc
+    if shred_title is not None:
+        comment_line += suffix
+    comment_line += " = "
+
+    # Is there a prefix? If so, add its title
+    if prefix in prefix_dict.keys():
+        comment_line += prefix_dict[prefix] + " "
+
+    # add job title
+    comment_line += afsc_info.title
+
+    # add skill level, officer skill level is ignored
+    if dict_type == "enlisted":
+        # if skill level given is not X or O, describe skill level given
+        if skill_level != 'X' and skill_level != '0':
+            comment_line += " " + \
+            ENLISTED_SKILL_LEVELS[int(skill_level) - 1]
+
+    # Is there a suffix? If so, add its title
+    if shred_title is not None:
+        comment_line += ", " + shred_title
+
+    # Is there a link? If so, add its link
+    afsc_link = afsc_info.link
+    if afsc_link:
+        comment_line += " [^wiki]({})".format(afsc_link)
+
+    return comment_line
+
+
 def break_up_regex(matches):
     """
     Creates a dict of regex matches for testing purposes.
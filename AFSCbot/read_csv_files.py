@@ -1,51 +1,65 @@
 import csv
+import html
+import json
 import os
-from bs4 import BeautifulSoup
-from helper_functions import has_number
+import re
+import threading
+import time
+from afsc_tables import AFSCRecord, AFSCTable, AFSCTables
+from helper_functions import has_number, print_and_log
 from pprint import pprint
 
 CSV_FOLDER = os.getcwd() + "/csv_files/"
+CSV_FILES = ["EnlistedAFSCs.csv", "OfficerAFSCs.csv", "EnlistedShreds.csv",
+             "OfficerShreds.csv", "EnlistedPrefixes.csv", "OfficerPrefixes.csv"]
+
+# wiki page the AFSC links are taken from
+WIKI_SUBREDDIT = "AirForce"
+WIKI_PAGE = "index"
+
+# href of every link in the wiki html, much faster than a full html parse
+WIKI_LINK_REGEX = re.compile(r"<a\s[^>]*?href=\"([^\"]*)\"")
+
+# how often the CSV folder is checked for changes, in seconds
+CSV_POLL_INTERVAL = 30
+
+SNAPSHOT_FILE = "afsc_snapshot.json"
+SNAPSHOT_VERSION = 1
 
 
 def get_AFSCs(reddit):
     """
-    Returns a dict used to lookup AFSCs
-    full_afsc_dict -> "enlisted": -> 
-                                     "1W0X1": -> "base_afsc": "1W0X1"
-                                              -> "job_title": "Weather Technician"
-                                              -> "shreds": {}
-                                              -> "link": "https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1"
-                                     ...
-                   -> "officer": ->
-                                     "12SX":  -> "base_afsc": "12SX"
-                                              -> "job_title": "Special Operations Combat Systems Officer"
-                                              -> "shreds": ->
-                                                              "C": "AC-130H"
-                                                              "K": "MC-130H EWO"
-                                                              ...
-                                              -> "link": ""
-                                     ...
-    :param reddit: PRAW reddit object
-    :return: full_afsc_dict used for looking up AFSC information
+    Returns the table used to lookup AFSCs
+    full_afsc_dict -> enlisted -> 
+                                  "1W0X1": AFSCRecord(code="1W0X1",
+                                                      title="Weather Technician",
+                                                      shreds=(),
+                                                      link="https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1")
+                                  ...
+                   -> officer ->
+                                  "12SX":  AFSCRecord(code="12SX",
+                                                      title="Special Operations Combat Systems Officer",
+                                                      shreds=(("C", "AC-130H"),
+                                                              ("K", "MC-130H EWO"),
+                                                              ...),
+                                                      link="")
+                                  ...
+    :param reddit: PRAW reddit object, links are left empty if None
+    :return: AFSCTable used for looking up AFSC information
     """
-    enlisted_dict = {"dict_type": "enlisted"}
-    officer_dict = {"dict_type": "officer"}
-    full_afsc_dict = {"enlisted": enlisted_dict,
-                      "officer": officer_dict}
-
-    # add AFSCs and their titles
-    add_afsc(enlisted_dict, "EnlistedAFSCs.csv")
-    add_afsc(officer_dict, "OfficerAFSCs.csv")
-
-    # add shreds to AFSCs
-    add_shreds(enlisted_dict, "EnlistedShreds.csv")
-    add_shreds(officer_dict, "OfficerShreds.csv")
+    # add AFSCs with their titles and shreds
+    full_afsc_dict = AFSCTable(
+        build_afscs(read_afsc_titles("EnlistedAFSCs.csv"),
+                    read_shreds("EnlistedShreds.csv")),
+        build_afscs(read_afsc_titles("OfficerAFSCs.csv"),
+                    read_shreds("OfficerShreds.csv")))
 
     # add links to AFSCs
-    add_afsc_links(full_afsc_dict, reddit)
+    if reddit is not None:
+        full_afsc_dict = add_afsc_links(full_afsc_dict, reddit)
 
-    # uncomment to see full dictionary
-    #pprint(full_afsc_dict)
+    # uncomment to see full table
+    #pprint(full_afsc_dict.to_dict())
 
     return full_afsc_dict
 
@@ -90,60 +104,313 @@ def add_prefix(dict, fname):
             dict[prefix_char] = prefix_title
 
 
-def add_afsc(dict, fname):
+def read_afsc_titles(fname):
     """
-    Add AFSCs from given filename into the dictionary.
-    :param dict: empty dictionary
+    Reads the AFSCs from given filename.
     :param fname: CSV file using '#' as delimiter
+    :return: dict mapping base AFSC to job title
     """
+    titles = {}
     with open(CSV_FOLDER + fname, newline='') as f:
         reader = csv.reader(f, delimiter='#')
         for row in reader:
             base_afsc = row[0]
             job_title = row[1]
-            afsc_dict = {"base_afsc": base_afsc,
-                         "job_title": job_title,
-                         "shreds": {},
-                         "link": ""}
-            dict[base_afsc] = afsc_dict
+            titles[base_afsc] = job_title
+    return titles
 
 
-def add_shreds(afsc_dict, fname):
+def read_shreds(fname):
     """
-    Add shreds from given filename into the dictionary.
-    :param dict: either enlisted_dict or officer_dict
-    :param fname: CSV file using '#' as delimiter
+    Reads the shreds from given filename.
+    :param fname: CSV file using ',' as delimiter
+    :return: dict mapping base AFSC to a dict of shred char to shred title
     """
+    shreds = {}
     with open(CSV_FOLDER + fname, newline='') as f:
         reader = csv.reader(f, delimiter=',')
         for row in reader:
             base_afsc = row[0]
             shred_char = row[1]
             shred_title = row[2]
-            # if shred AFSC not in base afsc, skip it
-            try:
-                afsc_dict[base_afsc]["shreds"][shred_char] = shred_title
-            except KeyError:
-                pass
+            shreds.setdefault(base_afsc, {})[shred_char] = shred_title
+    return shreds
 
 
-def add_afsc_links(full_afsc_dict, reddit):
+def build_afscs(titles, shreds, links=None):
+    """
+    Builds one partition of the AFSC table. Shreds of an AFSC that isn't
+    in titles are skipped.
+    :param titles: dict mapping base AFSC to job title
+    :param shreds: dict mapping base AFSC to a dict of its shreds
+    :param links: optional dict mapping base AFSC to link
+    :return: dict mapping base AFSC to AFSCRecord
     """
-    Add links to /r/AirForce wiki from given filename into the dictionary.
-    :param dict: either enlisted_dict or officer_dict
+    links = links or {}
+    return {base_afsc: AFSCRecord(base_afsc, job_title,
+                                  tuple(shreds.get(base_afsc, {}).items()),
+                                  links.get(base_afsc, ""))
+            for base_afsc, job_title in titles.items()}
+
+
+def add_afsc_links(full_afsc_dict, reddit, wiki_subreddit=WIKI_SUBREDDIT,
+                   wiki_page=WIKI_PAGE):
+    """
+    Add links to /r/AirForce wiki to the AFSCs.
+    :param full_afsc_dict: AFSCTable without links
     :param reddit: PRAW reddit object
+    :param wiki_subreddit: subreddit whose wiki has the links
+    :param wiki_page: name of the wiki page with the links
+    :return: new AFSCTable with the links
     """
     # gets dict of AFSC to link on /r/AirForce wiki
-    wiki_page = reddit.subreddit("AirForce").wiki["index"]
-    wiki_soup = BeautifulSoup(wiki_page.content_html, "html.parser")
-    links = wiki_soup.find_all("a")
+    page = reddit.subreddit(wiki_subreddit).wiki[wiki_page]
+    return full_afsc_dict.with_links(
+        get_wiki_links(page.content_html, wiki_subreddit))
+
 
-    # currently all wiki AFSC are enlisted
-    for link in links:
+def get_wiki_links(content_html, wiki_subreddit=WIKI_SUBREDDIT):
+    """
+    Gets the AFSC wiki links from the html of the wiki page.
+    :param content_html: html of the /r/AirForce wiki page
+    :param wiki_subreddit: subreddit whose wiki links are kept
+    :return: dict mapping base AFSC to link
+    """
+    links = {}
+    wiki_url = "www.reddit.com/r/{}/wiki/".format(wiki_subreddit)
+    for href in WIKI_LINK_REGEX.findall(content_html):
+        href = html.unescape(href)
         # not all links have /r/AirForce/wiki/jobs so this is more generalized
         # using only /r/AirForce/ wiki links
-        if "www.reddit.com/r/AirForce/wiki/" in link["href"]:
-            AFSC_code = link["href"].split("/")[-1].upper()
+        if wiki_url in href:
+            AFSC_code = href.split("/")[-1].upper()
             base_afsc = AFSC_code[:5]  # shaves off any prefixes
-            if base_afsc in full_afsc_dict["enlisted"].keys():
-                full_afsc_dict["enlisted"][base_afsc]["link"] = link["href"]
+            links[base_afsc] = href
+    return links
+
+
+def get_csv_mtimes():
+    """
+    :return: dict mapping each CSV filename to its modification time
+    """
+    return {fname: os.path.getmtime(CSV_FOLDER + fname) for fname in CSV_FILES}
+
+
+def get_wiki_revision(reddit, wiki_subreddit=WIKI_SUBREDDIT,
+                      wiki_page=WIKI_PAGE):
+    """
+    Gets the id of the latest revision of the wiki page used for links,
+    without downloading the page itself.
+    :param reddit: PRAW reddit object
+    :param wiki_subreddit: subreddit whose wiki has the links
+    :param wiki_page: name of the wiki page with the links
+    :return: revision id string
+    """
+    page = reddit.subreddit(wiki_subreddit).wiki[wiki_page]
+    for revision in page.revisions(limit=1):
+        return revision["id"]
+    return ""
+
+
+def load_snapshot(snapshot_path, csv_mtimes):
+    """
+    Loads the AFSC and prefix dicts from a snapshot file.
+    :param snapshot_path: path of the snapshot file
+    :param csv_mtimes: current CSV modification times, see get_csv_mtimes
+    :return: (full_afsc_dict, prefix_dict, wiki_revision) tuple, or None if
+    there is no snapshot or the CSV files changed since it was written
+    """
+    try:
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if (snapshot.get("version") != SNAPSHOT_VERSION
+            or snapshot.get("csv_mtimes") != csv_mtimes):
+        return None
+    return (AFSCTable.from_dict(snapshot["full_afsc_dict"]),
+            snapshot["prefix_dict"], snapshot["wiki_revision"])
+
+
+def save_snapshot(snapshot_path, full_afsc_dict, prefix_dict, csv_mtimes,
+                  wiki_revision):
+    """
+    Writes the AFSC and prefix dicts to a snapshot file. The file is
+    replaced atomically so a crash can't leave a partial snapshot behind.
+    :param snapshot_path: path of the snapshot file
+    :param full_afsc_dict: AFSCTable used for afsc lookups
+    :param prefix_dict: dict used for prefix lookups
+    :param csv_mtimes: CSV modification times the dicts were built from
+    :param wiki_revision: wiki revision id the links were taken from
+    """
+    snapshot = {"version": SNAPSHOT_VERSION,
+                "csv_mtimes": csv_mtimes,
+                "wiki_revision": wiki_revision,
+                "full_afsc_dict": full_afsc_dict.to_dict(),
+                "prefix_dict": prefix_dict}
+    temp_path = snapshot_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+    os.replace(temp_path, snapshot_path)
+
+
+def get_tables(snapshot_path=SNAPSHOT_FILE):
+    """
+    Returns the AFSC tables, from the snapshot file if the CSV files
+    didn't change since it was written. Otherwise they are rebuilt from the
+    CSV files without links. The wiki is never fetched here, so startup
+    doesn't wait on it, the WikiLinkRefresher adds or updates the links.
+    :param snapshot_path: path of the snapshot file
+    :return: AFSCTables
+    """
+    csv_mtimes = get_csv_mtimes()
+    snapshot = load_snapshot(snapshot_path, csv_mtimes)
+    if snapshot is not None:
+        print_and_log("Loaded AFSCs from snapshot " + snapshot_path)
+        full_afsc_dict, prefix_dict, wiki_revision = snapshot
+        return AFSCTables(full_afsc_dict, prefix_dict, csv_mtimes,
+                          wiki_revision)
+
+    print_and_log("Snapshot out of date, rebuilding AFSCs")
+    return AFSCTables(get_AFSCs(None), get_prefixes(), csv_mtimes)
+
+
+def rebuild_tables(tables, changed, csv_mtimes):
+    """
+    Builds new AFSC tables, re-reading only the tables whose CSV file
+    changed. Unchanged partitions and dicts are shared with the current
+    tables, which are left untouched.
+    :param tables: current AFSCTables
+    :param changed: set of changed CSV filenames
+    :param csv_mtimes: CSV modification times the new tables are built from
+    :return: new AFSCTables
+    """
+    full_afsc_dict = tables.full_afsc_dict
+    prefix_dict = dict(tables.prefix_dict)
+
+    for dict_type, name in (("enlisted", "Enlisted"), ("officer", "Officer")):
+        afsc_fname = name + "AFSCs.csv"
+        shreds_fname = name + "Shreds.csv"
+        prefix_fname = name + "Prefixes.csv"
+        old_afscs = tables.full_afsc_dict.partition(dict_type)
+
+        if afsc_fname in changed or shreds_fname in changed:
+            if afsc_fname in changed:
+                titles = read_afsc_titles(afsc_fname)
+            else:
+                titles = {base_afsc: record.title
+                          for base_afsc, record in old_afscs.items()}
+            # shreds belong to the AFSCs, so they are re-read either way,
+            # and the wiki links are kept until the next refresh
+            afscs = build_afscs(titles, read_shreds(shreds_fname),
+                                {base_afsc: record.link
+                                 for base_afsc, record in old_afscs.items()})
+            full_afsc_dict = full_afsc_dict.with_partition(dict_type, afscs)
+
+        if prefix_fname in changed:
+            new_prefix_dict = {}
+            add_prefix(new_prefix_dict, prefix_fname)
+            prefix_dict[dict_type] = new_prefix_dict
+
+    return AFSCTables(full_afsc_dict, prefix_dict, csv_mtimes,
+                      tables.wiki_revision)
+
+
+class CsvWatcher(threading.Thread):
+    """
+    Background thread reloading the AFSC tables when a CSV file changes.
+    A change is only loaded once the modification times stay the same for
+    a whole poll, so a file that is still being written isn't read. If a
+    file can't be parsed the last good tables keep being served.
+    """
+
+    def __init__(self, store, interval=CSV_POLL_INTERVAL,
+                 snapshot_path=SNAPSHOT_FILE):
+        """
+        :param store: TableStore the new tables are published to
+        :param interval: seconds between checks of the CSV folder
+        :param snapshot_path: path of the snapshot file updated with the
+        new tables, None to not write a snapshot
+        """
+        super().__init__(name="CsvWatcher", daemon=True)
+        self.store = store
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.stopped = threading.Event()
+        # modification times the current tables were built from
+        self.loaded_mtimes = store.current.csv_mtimes
+        # modification time of every file that failed to parse, it isn't
+        # retried until it changes again
+        self.failed_mtimes = {}
+        self.pending_mtimes = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print_and_log("Couldn't check CSV files, {}".format(e),
+                              error=True)
+
+    def stop(self):
+        self.stopped.set()
+
+    def check(self):
+        """
+        Reloads the changed CSV files if they didn't change since the last
+        check.
+        :return: True if new tables were published
+        """
+        csv_mtimes = get_csv_mtimes()
+        changed = set(fname for fname in CSV_FILES
+                      if csv_mtimes[fname] != self.loaded_mtimes.get(fname)
+                      and csv_mtimes[fname] != self.failed_mtimes.get(fname))
+        if not changed:
+            self.pending_mtimes = None
+            return False
+        if csv_mtimes != self.pending_mtimes:
+            # wait for one more poll in case the files are being written
+            self.pending_mtimes = csv_mtimes
+            return False
+        self.pending_mtimes = None
+
+        # files that failed keep the time of the data actually loaded, so a
+        # snapshot is never stamped with a version it doesn't hold
+        new_mtimes = dict(self.loaded_mtimes)
+        for fname in changed:
+            new_mtimes[fname] = csv_mtimes[fname]
+
+        start = time.perf_counter()
+        try:
+            self.store.update(lambda current: self.build(current, changed,
+                                                         new_mtimes))
+        except Exception as e:
+            print_and_log("Couldn't reload {}, keeping last good tables, {}"
+                          .format(", ".join(sorted(changed)), e), error=True)
+            for fname in changed:
+                self.failed_mtimes[fname] = csv_mtimes[fname]
+            return False
+        self.loaded_mtimes = new_mtimes
+        for fname in changed:
+            self.failed_mtimes.pop(fname, None)
+        print_and_log("Reloaded {} in {:.0f}ms".format(
+            ", ".join(sorted(changed)), (time.perf_counter() - start) * 1000))
+        return True
+
+    def build(self, current, changed, csv_mtimes):
+        """
+        Builds the new tables and writes them to the snapshot file. Runs
+        under the TableStore lock, so snapshots are never written at the
+        same time.
+        """
+        tables = rebuild_tables(current, changed, csv_mtimes)
+        if self.snapshot_path is not None:
+            try:
+                save_snapshot(self.snapshot_path, tables.full_afsc_dict,
+                              tables.prefix_dict, tables.csv_mtimes,
+                              tables.wiki_revision)
+            except OSError as e:
+                print_and_log("Couldn't save snapshot, {}".format(e),
+                              error=True)
+        return tables
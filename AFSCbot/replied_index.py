@@ -0,0 +1,84 @@
+import re
+import sqlite3
+import threading
+from helper_functions import print_and_log
+
+REPLIED_DB = "replied.db"
+
+# every reply ends with " ^^^^^^<comment id>", see process_comment.send_reply
+REPLIED_ID_REGEX = re.compile(r"\^{6}(\w+)\s*$")
+
+
+class RepliedIndex:
+    """
+    Local on-disk index of comment ids the bot has already replied to.
+    Ids are persisted to a SQLite file and mirrored in a set, so checking
+    whether a comment was handled is an O(1) lookup with no network call.
+    The index can be shared between threads.
+    """
+
+    def __init__(self, path=REPLIED_DB):
+        """
+        :param path: path of the SQLite file backing the index
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS replied "
+                          "(comment_id TEXT PRIMARY KEY)")
+        self.conn.commit()
+        self.ids = set(row[0] for row in
+                       self.conn.execute("SELECT comment_id FROM replied"))
+
+    def __contains__(self, comment_id):
+        return comment_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, comment_id):
+        """
+        Records that comment_id has been replied to.
+        :param comment_id: id of the comment the bot replied to
+        """
+        if comment_id in self.ids:
+            return
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO replied VALUES (?)",
+                              (comment_id,))
+            self.conn.commit()
+            self.ids.add(comment_id)
+
+    def seed_from_history(self, redditor):
+        """
+        Fills the index from the id footer of the bot's own comments.
+        :param redditor: PRAW redditor object of the bot
+        :return: number of ids found in the comment history
+        """
+        found = []
+        for comment in redditor.comments.new(limit=None):
+            match = REPLIED_ID_REGEX.search(comment.body)
+            if match:
+                found.append((match.group(1),))
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO replied VALUES (?)",
+                                  found)
+            self.conn.commit()
+            self.ids.update(row[0] for row in found)
+        return len(found)
+
+
+def load_replied_index(reddit, path=REPLIED_DB):
+    """
+    Opens the replied index and seeds it from the bot's comment history if
+    it is empty, which is the case on first run.
+    :param reddit: PRAW reddit object
+    :param path: path of the SQLite file backing the index
+    :return: RepliedIndex
+    """
+    replied_index = RepliedIndex(path)
+    if not len(replied_index):
+        print_and_log("Replied index is empty, seeding from comment history")
+        seeded = replied_index.seed_from_history(reddit.user.me())
+        print_and_log("Seeded replied index with {} comments".format(seeded))
+    return replied_index
@@ -0,0 +1,74 @@
+import sqlite3
+import threading
+import time
+
+REPLY_JOURNAL_DB = "reply_journal.db"
+# seconds replies are kept. Reddit archives threads after 6 months, after
+# which nobody can reply "deletethis!" to them
+JOURNAL_RETENTION = 15724800
+# seconds between deletes of expired replies
+EXPIRE_INTERVAL = 3600
+
+
+class ReplyJournal:
+    """
+    SQLite file mapping the id of every reply the bot sent to the comment
+    it replied to and that comment's author. AFSCbot writes it when a reply
+    is sent and AuthDelete reads it to authorize a "deletethis!" without
+    fetching the reply and its parent. The file is in WAL mode, so both
+    processes can use it at once, readers never block the writer. Replies
+    older than the retention are deleted, at most once per EXPIRE_INTERVAL.
+    """
+
+    def __init__(self, path=REPLY_JOURNAL_DB, retention=JOURNAL_RETENTION):
+        """
+        :param path: path of the SQLite file shared by the processes
+        :param retention: seconds a reply is kept
+        """
+        self.retention = retention
+        self.conn = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False)
+        self.lock = threading.Lock()
+        self.last_expire = 0
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS replies "
+                          "(reply_id TEXT PRIMARY KEY, comment_id TEXT, "
+                          "author TEXT, created REAL) WITHOUT ROWID")
+        self.conn.commit()
+
+    def record(self, reply_id, comment_id, author):
+        """
+        :param reply_id: id of the bot's reply
+        :param comment_id: id of the comment replied to
+        :param author: username of the comment's author
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO replies "
+                              "VALUES (?, ?, ?, ?)",
+                              (reply_id, comment_id, author, now))
+            if now - self.last_expire > EXPIRE_INTERVAL:
+                self.conn.execute("DELETE FROM replies WHERE created < ?",
+                                  (now - self.retention,))
+                self.last_expire = now
+            self.conn.commit()
+
+    def lookup(self, reply_id):
+        """
+        :param reply_id: id of a comment made by the bot
+        :return: tuple of the id and author of the comment it replied to,
+        None if the reply isn't in the journal
+        """
+        with self.lock:
+            return self.conn.execute("SELECT comment_id, author FROM replies "
+                                     "WHERE reply_id = ?",
+                                     (reply_id,)).fetchone()
+
+    def forget(self, reply_id):
+        """
+        :param reply_id: id of a reply that was deleted
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM replies WHERE reply_id = ?",
+                              (reply_id,))
+            self.conn.commit()
@@ -0,0 +1,94 @@
+import sys
+import time
+from process_comment import get_base_afsc, build_comment_line
+
+# every skill level the AFSC regexes accept, "" is an officer AFSC without one
+SKILL_LEVELS = ["", "X", "0", "1", "3", "5", "7", "9"]
+
+
+class ReplyLineIndex:
+    """
+    Finished reply line of every valid AFSC spelling, built once from the
+    AFSC and prefix dicts. Lines are keyed by the AFSC as it is printed in
+    the reply: prefix + AFSC + suffix, "K1W051C" for example, so rendering
+    a match is a dict lookup.
+    """
+
+    def __init__(self, full_afsc_dict, prefix_dict):
+        """
+        :param full_afsc_dict: AFSCTable used for afsc lookups
+        :param prefix_dict: dict used for prefix lookups
+        """
+        start = time.perf_counter()
+        self.lines = {}
+        for dict_type in ("enlisted", "officer"):
+            self.add_lines(full_afsc_dict.partition(dict_type),
+                           prefix_dict[dict_type], dict_type)
+        self.build_time = time.perf_counter() - start
+
+    def __len__(self):
+        return len(self.lines)
+
+    def add_lines(self, afsc_dict, prefix_dict, dict_type):
+        """
+        Adds the lines of every prefix, skill level and suffix combination
+        of the AFSCs in afsc_dict.
+        :param afsc_dict: enlisted or officer partition of the AFSCTable
+        :param prefix_dict: either the enlisted or officer prefix dict
+        :param dict_type: "enlisted" or "officer"
+        """
+        prefixes = [""] + list(prefix_dict.keys())
+        for base_afsc, afsc_info in afsc_dict.items():
+            # every way the AFSC can be written that resolves to base_afsc,
+            # "" comes first so "13S" + suffix "X" can't replace "13SX"
+            spellings = {}
+            for skill_level in SKILL_LEVELS:
+                if dict_type == "enlisted":
+                    afsc = base_afsc[:3] + skill_level + base_afsc[4:]
+                else:
+                    afsc = base_afsc[:3] + skill_level
+                afsc, tempAFSC = get_base_afsc(afsc, skill_level, dict_type)
+                if tempAFSC == base_afsc:
+                    spellings[afsc] = skill_level
+
+            suffixes = [""] + [shred_char
+                               for shred_char, _ in afsc_info.shreds]
+            for afsc, skill_level in spellings.items():
+                for prefix in prefixes:
+                    for suffix in suffixes:
+                        self.lines[prefix + afsc + suffix] = build_comment_line(
+                            prefix, afsc, skill_level, suffix, afsc_info,
+                            prefix_dict, dict_type)
+
+    def lookup(self, match, dict_type):
+        """
+        :param match: regex match or AFSCMatch of an AFSC
+        :param dict_type: "enlisted" or "officer"
+        :return: reply line of the match, None if the AFSC doesn't exist
+        """
+        prefix = match.group(2).upper()
+        suffix = match.group(5).upper()
+        afsc, tempAFSC = get_base_afsc(match.group(3).upper(),
+                                       match.group(4).upper(), dict_type)
+        # a prefix or suffix that doesn't exist is left out of the line
+        for key in (prefix + afsc + suffix, afsc + suffix,
+                    prefix + afsc, afsc):
+            line = self.lines.get(key)
+            if line is not None:
+                return line
+        return None
+
+    def size(self):
+        """
+        :return: approximate memory used by the keys and lines, in bytes
+        """
+        return sys.getsizeof(self.lines) + sum(
+            sys.getsizeof(key) + sys.getsizeof(line)
+            for key, line in self.lines.items())
+
+    def report(self):
+        """
+        :return: string describing the size and build time of the index
+        """
+        return "Reply line index: {} lines, {:.1f}MB, built in {:.0f}ms".format(
+            len(self), self.size() / 1000000, self.build_time * 1000)
@@ -0,0 +1,233 @@
+import queue
+import re
+import threading
+import time
+import praw
+import prawcore
+from helper_functions import print_and_log
+from metrics import METRICS
+from process_comment import build_reply_body, record_sent
+
+# API calls kept in reserve for the comment stream and the parent walks
+RESERVE = 10
+# number of times a reply is tried before it is dropped
+MAX_ATTEMPTS = 5
+# first retry delay for errors that aren't ratelimits, doubled every retry
+BACKOFF = 5
+# seconds waited for the API budget when the reset time isn't known
+BUDGET_WAIT = 10
+# "you are doing that too much. try again in 9 minutes."
+RATELIMIT_DELAY_REGEX = re.compile(r"(\d+) (second|minute)")
+
+
+class ReplyScheduler(threading.Thread):
+    """
+    Sends replies from a background thread, so reading the stream never
+    waits on a reply. Replies are sent only while the API budget reported
+    by reddit's X-Ratelimit-Remaining and X-Ratelimit-Reset headers has
+    more than the reserve left, otherwise the thread waits for the budget
+    to reset. Replies that hit a ratelimit or fail are retried with backoff.
+    """
+
+    def __init__(self, reddit, replied_index, reserve=RESERVE, on_done=None,
+                 journal=None):
+        """
+        :param reddit: PRAW reddit object, its auth.limits come from the
+        ratelimit headers of the last response
+        :param replied_index: RepliedIndex the sent replies are recorded in
+        :param reserve: API calls left for everything but the replies
+        :param on_done: optional callable taking the comment, called once
+        its reply was sent or given up on
+        :param journal: optional ReplyJournal the sent replies are recorded in
+        """
+        super().__init__(name="ReplyScheduler", daemon=True)
+        self.reddit = reddit
+        self.replied_index = replied_index
+        self.reserve = reserve
+        self.on_done = on_done
+        self.journal = journal
+        self.replies = queue.Queue()
+        # ids of comments with a reply waiting to be sent
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        # API calls counted from the "used" header of each ratelimit window
+        self.api_calls = 0
+        self.last_used = 0
+        self.last_reset = None
+
+    def submit(self, comment, reply_text):
+        """
+        Queues a reply, never blocks.
+        :param comment: PRAW comment to reply to
+        :param reply_text: list of strings representing lines in the reply
+        :return: False if a reply to the comment is already waiting
+        """
+        with self.pending_lock:
+            if comment.id in self.pending:
+                return False
+            self.pending.add(comment.id)
+        self.replies.put((comment, reply_text))
+        return True
+
+    def run(self):
+        while True:
+            comment, reply_text = self.replies.get()
+            try:
+                if comment.id not in self.replied_index:
+                    self.send(comment, reply_text)
+            finally:
+                with self.pending_lock:
+                    self.pending.discard(comment.id)
+                if self.on_done is not None:
+                    self.on_done(comment)
+
+    def send(self, comment, reply_text):
+        """
+        Sends a reply, retrying with backoff, then records it.
+        :param comment: PRAW comment to reply to
+        :param reply_text: list of strings representing lines in the reply
+        :return: True if the reply was sent
+        """
+        body = build_reply_body(reply_text, comment.id)
+        for attempt in range(MAX_ATTEMPTS):
+            self.wait_for_budget()
+            try:
+                with METRICS.timer("reply_seconds"):
+                    reply = comment.reply(body)
+            except Exception as err:
+                delay = get_retry_delay(err, attempt)
+                if delay is None:
+                    print_and_log("Reply to {} can't be sent, {}".format(
+                        comment.id, err), error=True)
+                    break
+                if attempt + 1 == MAX_ATTEMPTS:
+                    break
+                print_and_log("Reply to {} failed, retrying in {}s, {}".format(
+                    comment.id, delay, err), error=True)
+                time.sleep(delay)
+            else:
+                # only the reply itself is retried, it was sent by now
+                record_sent(comment, reply, self.replied_index, self.journal)
+                self.sent += 1
+                METRICS.inc("replies_total")
+                print_and_log("Sent reply...")
+                return True
+
+        print_and_log("Giving up on reply to {}".format(comment.id),
+                      error=True)
+        self.failed += 1
+        METRICS.inc("reply_failures_total")
+        return False
+
+    def wait_for_budget(self):
+        """
+        Waits for the ratelimit window to reset if the remaining budget is
+        down to the reserve.
+        """
+        self.update_usage()
+        delay = get_budget_delay(self.reddit.auth.limits, self.reserve)
+        if delay:
+            time.sleep(delay)
+
+    def update_usage(self):
+        """
+        Counts the API calls made since the last update from the ratelimit
+        headers.
+        :return: (remaining, reset_timestamp) tuple, None if not known yet
+        """
+        limits = self.reddit.auth.limits
+        used = limits.get("used")
+        reset_timestamp = limits.get("reset_timestamp")
+        if used is not None:
+            if reset_timestamp != self.last_reset:
+                # a new window started, its count starts from zero
+                self.api_calls += used
+            else:
+                self.api_calls += max(used - self.last_used, 0)
+            self.last_used = used
+            self.last_reset = reset_timestamp
+        return limits.get("remaining"), reset_timestamp
+
+    def report(self, comments_seen):
+        """
+        :param comments_seen: number of comments processed so far
+        :return: list of strings describing the API budget and replies
+        """
+        remaining, reset_timestamp = self.update_usage()
+        lines = ["Replies sent: {}, failed: {}, waiting: {}".format(
+            self.sent, self.failed, self.replies.qsize())]
+        if remaining is not None and reset_timestamp is not None:
+            lines.append("API calls left: {:.0f}, resets in {:.0f}s".format(
+                remaining, reset_timestamp - time.time()))
+        elif remaining is not None:
+            lines.append("API calls left: {:.0f}".format(remaining))
+        if comments_seen:
+            lines.append("API calls per processed comment: {:.2f}".format(
+                self.api_calls / comments_seen))
+        return lines
+
+
+def get_budget_delay(limits, reserve=RESERVE):
+    """
+    :param limits: auth.limits of the PRAW or asyncpraw reddit object
+    :param reserve: API calls left for everything but the replies
+    :return: seconds to wait for the ratelimit window to reset before the
+    next reply, 0 while more than the reserve is left
+    """
+    remaining = limits.get("remaining")
+    if remaining is None or remaining > reserve:
+        return 0
+    reset_timestamp = limits.get("reset_timestamp")
+    if reset_timestamp is None:
+        # PRAW and asyncpraw 8 don't report when the window resets
+        delay = BUDGET_WAIT
+    else:
+        delay = reset_timestamp - time.time()
+    if delay <= 0:
+        return 0
+    print_and_log("{:.0f} API calls left, waiting {:.0f}s for the ratelimit "
+                  "to reset".format(remaining, delay))
+    return delay
+
+
+def get_retry_delay(err, attempt, exceptions=praw.exceptions,
+                    core_exceptions=prawcore.exceptions):
+    """
+    :param err: exception raised while replying
+    :param attempt: number of failed attempts before this one
+    :param exceptions: exceptions module of praw, asyncpraw's for async
+    replies
+    :param core_exceptions: exceptions module of prawcore, asyncprawcore's
+    for async replies
+    :return: seconds to wait before trying again, None if the reply can
+    never be sent. Reddit API errors other than RATELIMIT, DELETED_COMMENT,
+    THREAD_LOCKED or TOO_OLD for example, and 4xx responses, a 403 from a
+    ban or a 404 for a removed thread, won't go away by retrying. Network
+    errors and 5xx responses are retried with backoff
+    """
+    if isinstance(err, exceptions.RedditAPIException):
+        return get_ratelimit_delay(err)
+    if (isinstance(err, core_exceptions.ResponseException)
+            and not isinstance(err, (core_exceptions.ServerError,
+                                     core_exceptions.TooManyRequests))):
+        return None
+    return BACKOFF * 2 ** attempt
+
+
+def get_ratelimit_delay(err):
+    """
+    :param err: praw or asyncpraw RedditAPIException
+    :return: seconds to wait from a RATELIMIT error, None for other errors
+    """
+    for item in err.items:
+        if item.error_type == "RATELIMIT":
+            match = RATELIMIT_DELAY_REGEX.search(item.message)
+            if not match:
+                return 60
+            delay = int(match.group(1))
+            if match.group(2) == "minute":
+                delay *= 60
+            return delay
+    return None
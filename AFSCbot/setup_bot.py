@@ -2,9 +2,33 @@ from pathlib import Path
 import praw
 import os
 import sys
+import threading
 import time
 
 from helper_functions import print_and_log
+from metrics import CountingRequestor
+
+
+class SerialRequestor(CountingRequestor):
+    """
+    PRAW isn't thread safe, yet the stream, the worker threads, the
+    ReplyScheduler, the WikiLinkRefresher and the Sharder all share one
+    praw.Reddit. Its requestor is the one place every HTTP request and
+    token refresh goes through, so a lock here sends them over the shared
+    HTTP session one at a time. Reddit's ratelimit caps the requests per
+    minute anyway, so the threads still overlap everything but the
+    requests themselves.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # reentrant, a request may refresh the access token first
+        self.lock = threading.RLock()
+
+    def request(self, *args, **kwargs):
+        with self.lock:
+            return super().request(*args, **kwargs)
+
 
 def login(username, password, client_secret, client_id, user_agent):
 
@@ -17,7 +41,8 @@ def login(username, password, client_secret, client_id, user_agent):
                 client_id=client_id,
                 client_secret=client_secret,
                 username=username,
-                password=password)
+                password=password,
+                requestor_class=SerialRequestor)
             print_and_log("Logged in")
             NotLoggedIn = False
         except praw.errors.InvalidUserPass:
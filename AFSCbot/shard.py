@@ -0,0 +1,246 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
+from helper_functions import print_and_log
+
+CLAIMS_DB = "claims.db"
+# seconds without a heartbeat before a shard, or a claim without a reply,
+# is considered abandoned
+LEASE_TTL = 60
+# seconds between heartbeats
+HEARTBEAT_INTERVAL = 10
+# comments of other shards kept, so a shard taken over can replay them
+REPLAY_SIZE = 1000
+# seconds claims are kept, long after the stream stops yielding a comment
+CLAIM_RETENTION = 86400
+# seconds between deletes of expired claims
+EXPIRE_INTERVAL = 3600
+
+
+def get_shard(comment_id, shard_count):
+    """
+    :param comment_id: id of the comment, without the t1_ prefix
+    :param shard_count: number of shards
+    :return: shard of the comment, the same in every instance
+    """
+    return zlib.crc32(comment_id.encode()) % shard_count
+
+
+class ClaimStore:
+    """
+    SQLite file shared by every instance on the host. An instance claims a
+    comment before walking its thread and replying, and only one claim can
+    succeed. A claim whose reply was never recorded expires after the
+    lease, so the comment can be picked up if its instance died. While
+    this instance still holds a claim, waiting on the ReplyScheduler for
+    example, renew() keeps extending its lease, until the reply is
+    recorded by mark_replied or the comment is given up by release. Shard
+    heartbeats are kept in the same file.
+    """
+
+    def __init__(self, path=CLAIMS_DB, owner=None, ttl=LEASE_TTL):
+        """
+        :param path: path of the SQLite file shared by the instances
+        :param owner: name of this instance, hostname and pid by default
+        :param ttl: seconds before a claim or shard is abandoned
+        """
+        self.owner = owner or "{}:{}".format(socket.gethostname(),
+                                             os.getpid())
+        self.ttl = ttl
+        # autocommit, transactions are opened explicitly
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.Lock()
+        # ids of the comments claimed by this instance and not replied to
+        self.held = set()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS claims "
+                          "(comment_id TEXT PRIMARY KEY, owner TEXT, "
+                          "claimed_at REAL, replied INTEGER DEFAULT 0)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS shards "
+                          "(shard INTEGER PRIMARY KEY, owner TEXT, "
+                          "heartbeat REAL)")
+
+    def claim(self, comment_id):
+        """
+        :param comment_id: id of the comment to claim
+        :return: True if this instance now owns the comment
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO claims (comment_id, owner, "
+                    "claimed_at) VALUES (?, ?, ?)",
+                    (comment_id, self.owner, now))
+                if cursor.rowcount == 0:
+                    # taken before, by this instance or by one whose lease
+                    # ran out without a reply
+                    cursor = self.conn.execute(
+                        "UPDATE claims SET owner = ?, claimed_at = ? "
+                        "WHERE comment_id = ? AND replied = 0 "
+                        "AND (owner = ? OR claimed_at < ?)",
+                        (self.owner, now, comment_id, self.owner,
+                         now - self.ttl))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            if cursor.rowcount == 1:
+                self.held.add(comment_id)
+        return cursor.rowcount == 1
+
+    def mark_replied(self, comment_id):
+        """
+        :param comment_id: id of a claimed comment the bot replied to
+        """
+        with self.lock:
+            self.conn.execute("UPDATE claims SET replied = 1 "
+                              "WHERE comment_id = ?", (comment_id,))
+            self.held.discard(comment_id)
+
+    def release(self, comment_id):
+        """
+        Stops renewing a claim, the comment got no reply. Does nothing if
+        the comment was replied to or never claimed.
+        :param comment_id: id of the comment that is done
+        """
+        with self.lock:
+            self.held.discard(comment_id)
+
+    def renew(self):
+        """
+        Extends the lease of every claim this instance still holds, so no
+        other instance takes over a comment whose reply is still queued.
+        Must be called more often than the lease runs out.
+        """
+        with self.lock:
+            now = time.time()
+            self.conn.executemany("UPDATE claims SET claimed_at = ? "
+                                  "WHERE comment_id = ? AND owner = ? "
+                                  "AND replied = 0",
+                                  [(now, comment_id, self.owner)
+                                   for comment_id in self.held])
+
+    def heartbeat(self, shard):
+        """
+        Records that this instance is alive and serving shard.
+        """
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO shards VALUES (?, ?, ?)",
+                              (shard, self.owner, time.time()))
+
+    def live_shards(self):
+        """
+        :return: set of the shards with a heartbeat within the lease
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT shard FROM shards "
+                                     "WHERE heartbeat >= ?",
+                                     (time.time() - self.ttl,)).fetchall()
+        return set(row[0] for row in rows)
+
+    def expire(self, max_age):
+        """
+        Deletes the claims older than max_age seconds, the stream never
+        yields them again.
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM claims WHERE claimed_at < ?",
+                              (time.time() - max_age,))
+
+
+class Sharder(threading.Thread):
+    """
+    Splits the comment stream between shard_count instances. Every
+    instance streams every comment and keeps those whose id hashes to its
+    shard. A background thread heartbeats the shard, and the shards of
+    instances that stopped heartbeating are spread over the live ones.
+    The comments of other shards seen recently are kept, so when a shard
+    is taken over its recent comments are replayed; the ClaimStore stops
+    those the dead instance already handled from getting a second reply.
+    """
+
+    def __init__(self, store, shard, shard_count,
+                 interval=HEARTBEAT_INTERVAL, replay_size=REPLAY_SIZE):
+        """
+        :param store: ClaimStore shared by the instances
+        :param shard: shard of this instance, from 0 to shard_count - 1
+        :param shard_count: number of instances
+        :param interval: seconds between heartbeats
+        :param replay_size: number of other shards' comments kept
+        """
+        super().__init__(name="Sharder", daemon=True)
+        self.store = store
+        self.shard = shard
+        self.shard_count = shard_count
+        self.interval = interval
+        # shards served by this instance, replaced as a whole by the thread
+        self.owned = frozenset([shard])
+        # owned shards the stream thread has seen, to spot new ones
+        self.routed = self.owned
+        self.skipped = deque(maxlen=replay_size)
+        self.last_expire = 0
+
+    def run(self):
+        while True:
+            try:
+                self.store.heartbeat(self.shard)
+                self.store.renew()
+                self.rebalance(self.store.live_shards() | {self.shard})
+                if time.time() - self.last_expire > EXPIRE_INTERVAL:
+                    self.store.expire(CLAIM_RETENTION)
+                    self.last_expire = time.time()
+            except Exception as e:
+                print_and_log("Couldn't update shards, {}".format(e),
+                              error=True)
+            time.sleep(self.interval)
+
+    def rebalance(self, live):
+        """
+        Takes over the dead shards assigned to this instance. Every live
+        instance computes the same assignment, dead shard d goes to the
+        live shard at position d % len(live).
+        :param live: set of the shards with a live instance
+        """
+        live = sorted(live)
+        owned = frozenset(shard for shard in range(self.shard_count)
+                          if shard == self.shard or
+                          (shard not in live and
+                           live[shard % len(live)] == self.shard))
+        if owned != self.owned:
+            print_and_log("Serving shards {} of {}".format(
+                ", ".join(str(shard) for shard in sorted(owned)),
+                self.shard_count))
+            self.owned = owned
+
+    def route(self, comment):
+        """
+        Called by the stream thread for every comment.
+        :param comment: PRAW comment from the stream
+        :return: list of the comments to process, the comment itself if it
+        belongs to an owned shard, after the replayed comments of any shard
+        taken over since the last call
+        """
+        owned = self.owned
+        comments = []
+        if owned != self.routed:
+            adopted = owned - self.routed
+            kept = deque(maxlen=self.skipped.maxlen)
+            for skipped in self.skipped:
+                if get_shard(skipped.id, self.shard_count) in adopted:
+                    comments.append(skipped)
+                else:
+                    kept.append(skipped)
+            self.skipped = kept
+            self.routed = owned
+        if get_shard(comment.id, self.shard_count) in owned:
+            comments.append(comment)
+        else:
+            self.skipped.append(comment)
+        return comments
@@ -0,0 +1,82 @@
+import json
+from helper_functions import print_and_log
+from pipeline import MAX_COMMENT_AGE
+from read_csv_files import WIKI_SUBREDDIT, WIKI_PAGE
+
+SUBREDDIT_CONFIG_FILE = "subreddits.json"
+
+
+class SubredditConfig:
+    """
+    Settings of one subreddit served by the bot. Subreddits using the same
+    wiki page share a TableStore, so the AFSC tables are only loaded once
+    per wiki.
+    """
+
+    def __init__(self, name, enabled=True, max_age=MAX_COMMENT_AGE,
+                 wiki_subreddit=WIKI_SUBREDDIT, wiki_page=WIKI_PAGE):
+        """
+        :param name: name of the subreddit
+        :param enabled: whether the bot replies in the subreddit
+        :param max_age: maximum age of a comment in seconds
+        :param wiki_subreddit: subreddit whose wiki the AFSC links come
+        from, empty for no links
+        :param wiki_page: name of the wiki page with the AFSC links
+        """
+        self.name = name
+        self.enabled = enabled
+        self.max_age = max_age
+        self.wiki_subreddit = wiki_subreddit
+        self.wiki_page = wiki_page
+        # TableStore of the subreddit's wiki, set by main
+        self.store = None
+
+    @property
+    def wiki(self):
+        """
+        :return: (wiki_subreddit, wiki_page) tuple, None if the subreddit
+        has no links
+        """
+        if not self.wiki_subreddit:
+            return None
+        return (self.wiki_subreddit, self.wiki_page)
+
+
+def load_subreddit_configs(subreddits, path=SUBREDDIT_CONFIG_FILE):
+    """
+    Builds the config of every subreddit, with the settings from the config
+    file overriding the defaults. The file is optional and maps subreddit
+    names to settings, for example:
+    {"AFROTC": {"max_age": 86400, "wiki_subreddit": ""},
+     "AirForceRecruits": {"enabled": false}}
+    :param subreddits: names of the subreddits, "AirForce+AFROTC" or a list
+    :param path: path of the JSON config file
+    :return: dict mapping lowercase subreddit names to SubredditConfig
+    """
+    if isinstance(subreddits, str):
+        subreddits = subreddits.split("+")
+    try:
+        with open(path) as f:
+            settings = {name.lower(): config
+                        for name, config in json.load(f).items()}
+    except FileNotFoundError:
+        settings = {}
+
+    configs = {}
+    for name in subreddits:
+        if name:
+            configs[name.lower()] = SubredditConfig(
+                name, **settings.get(name.lower(), {}))
+    for config in configs.values():
+        if not config.enabled:
+            print_and_log("Subreddit {} is disabled".format(config.name))
+    return configs
+
+
+def get_stream_name(configs):
+    """
+    :param configs: dict of SubredditConfig, see load_subreddit_configs
+    :return: multireddit name of the enabled subreddits, "AirForce+AFROTC"
+    """
+    return "+".join(config.name for config in configs.values()
+                    if config.enabled)
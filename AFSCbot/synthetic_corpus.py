@@ -0,0 +1,205 @@
+import argparse
+import json
+import random
+import time
+from afsc_tables import DICT_TYPES
+from read_csv_files import get_AFSCs, get_prefixes
+
+WORDS = ("the", "a", "my", "your", "and", "but", "so", "if", "was", "is",
+         "just", "not", "got", "had", "have", "been", "to", "for", "at", "in",
+         "on", "with", "after", "before", "every", "no", "yes", "lol",
+         "airman", "sergeant", "shirt", "supervisor", "commander", "shop",
+         "flight", "squadron", "wing", "base", "dorm", "chow", "hall", "gate",
+         "PT", "test", "waist", "run", "profile", "EPR", "OPR", "PCS", "TDY",
+         "deployment", "orders", "leave", "BAH", "BAS", "MEPS", "BMT", "tech",
+         "school", "recruiter", "retrain", "reenlist", "separate", "GI",
+         "bill", "TA", "CCAF", "degree", "promotion", "stripes", "SNCO",
+         "E-4", "E-5", "O-3", "mafia", "Tinder", "Kirtland", "Ramstein",
+         "Lackland", "Keesler", "Sheppard", "Minot", "Osan", "Kadena",
+         "honestly", "definitely", "probably", "hours", "days", "weeks",
+         "years", "shift", "swings", "mids", "weekend", "duty", "Friday",
+         "jet", "tail", "hangar", "flightline", "wrench", "bird", "sortie")
+# things that look like AFSCs but aren't, or aren't in the tables
+FALSE_POSITIVES = ("12s", "12S", "24/7", "14V", "1C4X2", "3X4", "9to5",
+                   "5 level", "7 level", "2020", "401k", "E4", "C-130J",
+                   "KC-135", "F-16C", "B52", "1st", "2nd", "3rd", "4th")
+WIKI_JOBS_URL = "https://www.reddit.com/r/AirForce/wiki/jobs/"
+ENLISTED_SKILL_LEVELS = ("1", "3", "5", "7", "9", "X")
+OFFICER_SKILL_LEVELS = ("1", "3", "4", "X", "")
+
+
+class CorpusGenerator:
+    """
+    Generates r/AirForce-like comment bodies from the AFSC tables, with a
+    controllable share of comments mentioning AFSCs. Mentions mix in
+    prefixes, shreds, lowercase, punctuation and wiki links, and comments
+    include quotes, false positives like "12s" and the occasional very long
+    rant. The same seed always gives the same corpus.
+    """
+
+    def __init__(self, full_afsc_dict, prefix_dict, afsc_rate=0.2,
+                 quote_rate=0.1, false_positive_rate=0.2, long_rate=0.01,
+                 seed=0):
+        """
+        :param full_afsc_dict: AFSCTable the AFSCs are picked from
+        :param prefix_dict: dict the prefixes are picked from
+        :param afsc_rate: share of the comments mentioning at least one AFSC
+        :param quote_rate: share of the comments quoting another comment
+        :param false_positive_rate: share of the comments with something
+        that looks like an AFSC but isn't
+        :param long_rate: share of the comments with thousands of words
+        :param seed: seed of the random generator
+        """
+        self.rng = random.Random(seed)
+        self.afsc_rate = afsc_rate
+        self.quote_rate = quote_rate
+        self.false_positive_rate = false_positive_rate
+        self.long_rate = long_rate
+        # (base afsc, shreds) of every AFSC, per dict type
+        self.afscs = {}
+        for dict_type in DICT_TYPES:
+            afscs = full_afsc_dict.partition(dict_type)
+            self.afscs[dict_type] = [
+                (afsc, sorted(shred_char for shred_char, _ in record.shreds))
+                for afsc, record in sorted(afscs.items())]
+        self.prefixes = {dict_type: sorted(prefixes)
+                         for dict_type, prefixes in prefix_dict.items()}
+
+    def afsc(self):
+        """
+        :return: string of a random AFSC mention, "K1W071B" for example
+        """
+        rng = self.rng
+        dict_type = "enlisted" if rng.random() < 0.8 else "officer"
+        base_afsc, shreds = rng.choice(self.afscs[dict_type])
+        if dict_type == "enlisted":
+            afsc = (base_afsc[:3] + rng.choice(ENLISTED_SKILL_LEVELS) +
+                    base_afsc[4:])
+        else:
+            afsc = base_afsc[:-1] + rng.choice(OFFICER_SKILL_LEVELS)
+        if rng.random() < 0.1:
+            afsc = rng.choice(self.prefixes[dict_type]) + afsc
+        if shreds and rng.random() < 0.3:
+            afsc += rng.choice(shreds)
+        if dict_type == "enlisted" and rng.random() < 0.2:
+            # enlisted matching isn't case sensitive
+            afsc = afsc.lower()
+        if rng.random() < 0.05:
+            return WIKI_JOBS_URL + base_afsc.lower()
+        return afsc + rng.choice(("", "", "", ",", ".", "?", "!"))
+
+    def sentence(self, words):
+        return " ".join(self.rng.choices(WORDS, k=words))
+
+    def comment(self):
+        """
+        :return: string of a random comment body
+        """
+        rng = self.rng
+        if rng.random() < self.long_rate:
+            words = rng.randint(2000, 10000)
+        else:
+            words = rng.randint(3, 80)
+        tokens = rng.choices(WORDS, k=words)
+        if rng.random() < self.afsc_rate:
+            for _ in range(rng.choice((1, 1, 1, 2, 3))):
+                tokens.insert(rng.randrange(len(tokens) + 1), self.afsc())
+        if rng.random() < self.false_positive_rate:
+            tokens.insert(rng.randrange(len(tokens) + 1),
+                          rng.choice(FALSE_POSITIVES))
+        # split into paragraphs of about 40 words
+        paragraphs = [" ".join(tokens[i:i + 40])
+                      for i in range(0, len(tokens), 40)]
+        if rng.random() < self.quote_rate:
+            quoted = self.sentence(rng.randint(3, 30))
+            if rng.random() < self.afsc_rate:
+                quoted += " " + self.afsc()
+            paragraphs.insert(0, ">" + quoted)
+        return "\n\n".join(paragraphs)
+
+    def comments(self, count):
+        """
+        :param count: number of comments
+        :return: generator of comment bodies
+        """
+        for _ in range(count):
+            yield self.comment()
+
+    def threads(self, count, max_depth=10):
+        """
+        Generates reddit comment objects grouped in threads of random depth,
+        with the fields FakeReddit.load_jsonl reads.
+        :param count: number of comments
+        :param max_depth: maximum number of comments in a thread
+        :return: generator of dicts, parents before their replies
+        """
+        rng = self.rng
+        created_utc = int(time.time()) - count
+        thread = 0
+        generated = 0
+        while generated < count:
+            link_id = "t3_s{}".format(thread)
+            parent_id = link_id
+            for _ in range(min(rng.randint(1, max_depth), count - generated)):
+                comment_id = "c{}".format(generated)
+                yield {"id": comment_id, "body": self.comment(),
+                       "author": "user{}".format(rng.randrange(1000)),
+                       "parent_id": parent_id, "link_id": link_id,
+                       "created_utc": created_utc + generated,
+                       "subreddit": "AirForce"}
+                parent_id = "t1_" + comment_id
+                generated += 1
+            thread += 1
+
+
+def write_corpus(path, generator, count, max_depth=10):
+    """
+    Writes count comments to a JSONL file, one comment object per line.
+    """
+    with open(path, "w") as f:
+        for comment in generator.threads(count, max_depth):
+            f.write(json.dumps(comment))
+            f.write("\n")
+
+
+def read_bodies(path, limit=None):
+    """
+    :param path: JSONL file of reddit comments
+    :param limit: maximum number of bodies read
+    :return: list of comment bodies
+    """
+    bodies = []
+    with open(path) as f:
+        for line in f:
+            if limit is not None and len(bodies) >= limit:
+                break
+            if line.strip():
+                bodies.append(json.loads(line)["body"])
+    return bodies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes a synthetic "
+                                                 "r/AirForce comment corpus")
+    parser.add_argument("out", help="JSONL file to write")
+    parser.add_argument("--count", type=int, default=1000000)
+    parser.add_argument("--max-depth", type=int, default=10,
+                        help="maximum number of comments in a thread")
+    parser.add_argument("--afsc-rate", type=float, default=0.2,
+                        help="share of the comments mentioning an AFSC")
+    parser.add_argument("--quote-rate", type=float, default=0.1)
+    parser.add_argument("--false-positive-rate", type=float, default=0.2)
+    parser.add_argument("--long-rate", type=float, default=0.01,
+                        help="share of the comments with thousands of words")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = CorpusGenerator(get_AFSCs(None), get_prefixes(),
+                                args.afsc_rate, args.quote_rate,
+                                args.false_positive_rate, args.long_rate,
+                                args.seed)
+    write_corpus(args.out, generator, args.count, args.max_depth)
+
+
+if __name__ == "__main__":
+    main()
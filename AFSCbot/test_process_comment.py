@@ -1,20 +1,68 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from types import SimpleNamespace
+from urllib.request import urlopen
+import asyncpraw
+import asyncprawcore
+import praw
+import prawcore
 from process_comment import (get_enlisted_regex_matches,
                              get_officer_regex_matches,
                              break_up_regex,
                              filter_out_quotes,
-                             generate_reply)
-
-from read_csv_files import get_AFSCs, get_prefixes
-from setup_bot import login
+                             generate_reply,
+                             render_reply,
+                             send_reply,
+                             AFSC_SCANNER)
+
+import helper_functions
+import read_csv_files
+from afsc_tables import AFSCTables, TableStore
+from batch import run_batch
+from checkpoint import StreamCheckpoint
+from read_csv_files import (CsvWatcher, get_AFSCs, get_csv_mtimes,
+                            get_prefixes, get_tables, load_snapshot,
+                            save_snapshot)
+from reply_journal import ReplyJournal
+from reply_lines import ReplyLineIndex
+from reply_scheduler import (BUDGET_WAIT, ReplyScheduler, get_budget_delay,
+                             get_retry_delay)
+from async_main import send_reply_async
+from fake_reddit import FakeReddit
+from metrics import Metrics
+from pipeline import (CommentContext, Pipeline, build_pipeline,
+                      subreddit_router)
+from replied_index import RepliedIndex
+from title_index import TitleIndex, TITLE_TRIGGER_SEARCH
+from shard import ClaimStore, Sharder, get_shard
+from subreddit_config import get_stream_name, load_subreddit_configs
+from typo_index import TypoIndex
+from wiki_refresher import WikiLinkRefresher
+import worker_pool
+from worker_pool import WorkerPool
 
 #####################
 """ Unit tests """
 #####################
 
-reddit = login()
+reddit = FakeReddit(wiki_links=[
+    "https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1",
+    "https://www.reddit.com/r/AirForce/wiki/jobs/1n2x1ac"])
 full_afsc_dict = get_AFSCs(reddit)
 prefix_dict = get_prefixes()
+reply_lines = ReplyLineIndex(full_afsc_dict, prefix_dict)
+
+
+def top_level_comment(body):
+    return reddit.add_thread([body], stream=False)[0]
 
 
 class FilterQuotes(unittest.TestCase):
@@ -44,49 +92,757 @@ class GenerateReply(unittest.TestCase):
     def test_normal_afsc(self):
         comment = "Hi I am a 1W051"
         expected = ["1W051 = Weather Journeyman [^wiki](https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1)"]
-        actual = generate_reply(comment, full_afsc_dict, prefix_dict)
+        actual = generate_reply(top_level_comment(comment), full_afsc_dict, prefix_dict)
         self.assertEqual(expected, actual)
 
     def test_quoted_afsc(self):
         comment = ">I heard you were a 1W0X1\n\nYou are mistaken, clearly I'm a 1W051"
         expected = ["1W051 = Weather Journeyman [^wiki](https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1)"]
-        actual = generate_reply(comment, full_afsc_dict, prefix_dict)
+        actual = generate_reply(top_level_comment(comment), full_afsc_dict, prefix_dict)
         self.assertEqual(expected, actual)
 
     def test_12s(self):
         comment = "I'm tired of working 12s as a K13SXB..."
-        expected = ["K13SXB = Instructor Space Operations, Spacelift"]
-        actual = generate_reply(comment, full_afsc_dict, prefix_dict)
+        expected = ["K13SXB = Instructor Space Operations, Space Electronic Warfare"]
+        actual = generate_reply(top_level_comment(comment), full_afsc_dict, prefix_dict)
         self.assertEqual(expected, actual)
 
     def test_caps(self):
         comment = "doesnt matter what caps I use with k1n2x1 or 1C8X2\n\n" \
                   "but it DOES matter what I use with W13BXY. 16f doesn't work."
+        # 1C8X2 is no longer in the CSV files, so it gets no line
         expected = ["K1N2X1 = Instructor Signals Intelligence Analyst [^wiki](https://www.reddit.com/r/AirForce/wiki/jobs/1n2x1ac)",
-                    "1C8X2 = Airfield Systems",
-                    "W13BXY = Weapons Officer Air Battle Manager, General"]
-        actual = generate_reply(comment, full_afsc_dict, prefix_dict)
+                    "W13BXY = Weapons and Tactics Instructor Air Battle Manager, General"]
+        actual = generate_reply(top_level_comment(comment), full_afsc_dict, prefix_dict)
         self.assertEqual(expected, actual)
 
     def test_afsc_doesnt_exist(self):
         comment = "These are valid AFSCs but they don't exist 1C4X2 and 14V"
         expected = []
-        actual = generate_reply(comment, full_afsc_dict, prefix_dict)
+        actual = generate_reply(top_level_comment(comment), full_afsc_dict, prefix_dict)
         self.assertEqual(expected, actual)
 
     def test_afsc_repeated(self):
         comment = "Here's a 1W051, there's a 1W051, everywhere's a 1W091"
         expected = ["1W051 = Weather Journeyman [^wiki](https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1)",
                     "1W091 = Weather Superintendent [^wiki](https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1)"]
-        actual = generate_reply(comment, full_afsc_dict, prefix_dict)
+        actual = generate_reply(top_level_comment(comment), full_afsc_dict, prefix_dict)
         self.assertEqual(expected, actual)
 
     def test_hyperlink(self):
         comment = "I just went to https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1"
         expected = []
-        actual = generate_reply(comment, full_afsc_dict, prefix_dict)
+        actual = generate_reply(top_level_comment(comment), full_afsc_dict, prefix_dict)
         self.assertEqual(expected, actual)
 
+    def test_afsc_in_parent(self):
+        thread = reddit.add_thread(["I'm a 1W051",
+                                    "cool, I'm a 1C8X2",
+                                    "1W051 and 1C8X2 both sound fun, "
+                                    "so does 1W091"], stream=False)
+        expected = ["1W091 = Weather Superintendent [^wiki](https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1)"]
+        actual = generate_reply(thread[-1], full_afsc_dict, prefix_dict)
+        self.assertEqual(expected, actual)
+
+
+class ReplyLineLookup(unittest.TestCase):
+    def test_same_as_generated(self):
+        comments = ["Hi I am a 1W051",
+                    "I'm tired of working 12s as a K13SXB...",
+                    "doesnt matter what caps I use with k1n2x1 or 1C8X2\n\n"
+                    "but it DOES matter what I use with W13BXY. 16f doesn't work.",
+                    "Z1W051 and 1W051Z are not real prefixes or suffixes",
+                    "Here's a 1W051, there's a 1W051, everywhere's a 1W091"]
+        for comment in comments:
+            expected = generate_reply(top_level_comment(comment), full_afsc_dict, prefix_dict)
+            actual = generate_reply(top_level_comment(comment), full_afsc_dict, prefix_dict,
+                                    reply_lines)
+            self.assertEqual(expected, actual)
+
+    def test_afsc_doesnt_exist(self):
+        matches = get_enlisted_regex_matches("1C4X2")
+        self.assertIsNone(reply_lines.lookup(next(matches), "enlisted"))
+
+
+class AFSCTableLookup(unittest.TestCase):
+    def test_record(self):
+        record = full_afsc_dict.lookup("enlisted", "1W0X1")
+        self.assertEqual("1W0X1", record.code)
+        self.assertEqual("https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1", record.link)
+        self.assertIsNone(full_afsc_dict.lookup("enlisted", "1C4X2"))
+        self.assertEqual("AC-130H", full_afsc_dict.lookup("officer", "12SX").shred("C"))
+
+    def test_dict_view(self):
+        enlisted = full_afsc_dict["enlisted"]
+        self.assertEqual("enlisted", enlisted["dict_type"])
+        self.assertEqual(full_afsc_dict.lookup("enlisted", "1W0X1").title,
+                         enlisted["1W0X1"]["job_title"])
+        self.assertEqual("AC-130H", full_afsc_dict["officer"]["12SX"]["shreds"]["C"])
+        self.assertIn("1N2X1", enlisted.keys())
+
+
+class TypoCorrection(unittest.TestCase):
+    typo_index = TypoIndex(full_afsc_dict.enlisted)
+
+    def reply(self, comment):
+        return generate_reply(top_level_comment(comment), full_afsc_dict, prefix_dict,
+                              reply_lines, self.typo_index)
+
+    def test_letter_for_digit(self):
+        expected = ["Did you mean 1W071 = Weather Craftsman [^wiki](https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1)"]
+        self.assertEqual(expected, self.reply("I'm a 1WO7l"))
+
+    def test_ambiguous(self):
+        # 1W0X1, 1C0X2 and 1N0X2 are all one substitution away
+        self.assertEqual([], self.reply("I was a 1W0X2"))
+
+    def test_already_mentioned(self):
+        expected = ["1W051 = Weather Journeyman [^wiki](https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1)"]
+        self.assertEqual(expected, self.reply("1W051, not 1WO51"))
+
+    def test_noise(self):
+        self.assertEqual([], self.reply("2020s 12345 9A250 20C3 40CX"))
+        self.assertEqual([], self.reply("1WOX1 1NOX1 1POX1 1SOX1"))
+
+    def test_off_by_default(self):
+        self.assertEqual([], generate_reply(top_level_comment("I'm a 1WOX1"),
+                                            full_afsc_dict, prefix_dict))
+
+    def test_shared_build(self):
+        # the worker threads all ask for the index of the first comment
+        tables = AFSCTables(full_afsc_dict, prefix_dict)
+        indexes = []
+        threads = [threading.Thread(
+            target=lambda: indexes.append(tables.get_typo_index(1)))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(set(map(id, indexes))))
+
+
+class TitleLookup(unittest.TestCase):
+    title_index = TitleIndex(full_afsc_dict, prefix_dict)
+
+    def codes(self, query):
+        return [result.code() for result in self.title_index.search(query, 3)]
+
+    def test_job_title(self):
+        self.assertEqual("1W0X1", self.codes("weather")[0])
+        self.assertEqual("1A1X1C", self.codes("C-17 loadmasters")[0])
+
+    def test_prefix_title(self):
+        self.assertEqual("K1A1X1C", self.codes("instructor c-17 loadmaster")[0])
+
+    def test_trigger(self):
+        trigger = TITLE_TRIGGER_SEARCH.search("So what's the AFSC for weather?")
+        self.assertEqual("weather", trigger.group(1))
+        self.assertIsNone(TITLE_TRIGGER_SEARCH.search("What AFSCs are open?"))
+        trigger = TITLE_TRIGGER_SEARCH.search("Then what AFSC is cyber?")
+        self.assertEqual("cyber", trigger.group(1))
+
+    def test_superlative(self):
+        for comment in ("Which AFSC is the most fun?",
+                        "which AFSC has the best bonus",
+                        "What's the AFSC for the best deployments?",
+                        "what afsc pays the most"):
+            self.assertIsNone(TITLE_TRIGGER_SEARCH.search(comment), comment)
+
+    def test_reply(self):
+        expected = ["1W0X1 = Weather [^wiki](https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1)"]
+        candidates = self.title_index.candidates("weather", 1)
+        self.assertEqual(expected, render_reply(candidates, full_afsc_dict,
+                                                prefix_dict, reply_lines))
+
+    def test_no_match(self):
+        self.assertEqual([], self.title_index.candidates("weather basket weaver"))
+
+
+class ReplyOwnership(unittest.TestCase):
+    def test_recorded(self):
+        journal = ReplyJournal(":memory:")
+        comment = reddit.add_thread(["1W071"], author="airman", stream=False)[0]
+        send_reply(["1W071 = Weather Craftsman"], comment, journal=journal)
+        reply_id = [comment_id for comment_id, data in reddit.store.items()
+                    if data["parent_id"] == comment.fullname][0]
+        self.assertEqual((comment.id, "airman"), journal.lookup(reply_id))
+        journal.forget(reply_id)
+        self.assertIsNone(journal.lookup(reply_id))
+
+
+class ReplyRetry(unittest.TestCase):
+    def api_error(self, error_type, message=""):
+        return praw.exceptions.RedditAPIException([[error_type, message, None]])
+
+    def http_error(self, error_class, status_code):
+        # asyncprawcore reads status, prawcore status_code
+        return error_class(SimpleNamespace(status_code=status_code,
+                                           status=status_code))
+
+    def test_permanent(self):
+        for error_type in ("DELETED_COMMENT", "THREAD_LOCKED", "TOO_OLD"):
+            self.assertIsNone(get_retry_delay(self.api_error(error_type), 0))
+        self.assertIsNone(get_retry_delay(
+            self.http_error(prawcore.exceptions.Forbidden, 403), 0))
+        self.assertIsNone(get_retry_delay(
+            self.http_error(prawcore.exceptions.NotFound, 404), 0))
+
+    def test_ratelimit(self):
+        err = self.api_error("RATELIMIT", "try again in 9 minutes.")
+        self.assertEqual(540, get_retry_delay(err, 0))
+
+    def test_transient(self):
+        self.assertEqual(10, get_retry_delay(
+            self.http_error(prawcore.exceptions.ServerError, 503), 1))
+        self.assertEqual(5, get_retry_delay(ConnectionError(), 0))
+
+    def test_budget(self):
+        self.assertEqual(0, get_budget_delay({"remaining": None}, 10))
+        self.assertEqual(0, get_budget_delay({"remaining": 50}, 10))
+        self.assertEqual(BUDGET_WAIT, get_budget_delay({"remaining": 5}, 10))
+        self.assertEqual(0, get_budget_delay(
+            {"remaining": 5, "reset_timestamp": time.time() - 1}, 10))
+
+    def test_async_permanent(self):
+        err = self.http_error(asyncprawcore.exceptions.Forbidden, 403)
+        self.assertIsNone(get_retry_delay(err, 0, asyncpraw.exceptions,
+                                          asyncprawcore.exceptions))
+        calls = []
+
+        async def reply(body):
+            calls.append(body)
+            raise err
+
+        comment = SimpleNamespace(id="c1", reply=reply)
+        reddit = SimpleNamespace(auth=SimpleNamespace(limits={}))
+        self.assertIsNone(asyncio.run(send_reply_async(reddit, comment,
+                                                       "body")))
+        self.assertEqual(["body"], calls)
+
+    def test_sent_once(self):
+        # recording a sent reply fails, the reply mustn't be sent again
+        class BrokenIndex:
+            def add(self, comment_id):
+                raise OSError("disk full")
+
+        calls = []
+        comment = SimpleNamespace(id="c1", author=None,
+                                  reply=lambda body: calls.append(body))
+        reddit = SimpleNamespace(auth=SimpleNamespace(limits={}))
+        scheduler = ReplyScheduler(reddit, BrokenIndex())
+        self.assertTrue(scheduler.send(comment, ["1W071 = Weather"]))
+        self.assertEqual(1, len(calls))
+
+
+class ClaimOwnership(unittest.TestCase):
+    ttl = 0.2
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tempdir.name, "claims.db")
+        self.first = ClaimStore(path, "first", self.ttl)
+        self.second = ClaimStore(path, "second", self.ttl)
+
+    def tearDown(self):
+        self.first.conn.close()
+        self.second.conn.close()
+        self.tempdir.cleanup()
+
+    def test_live_claim(self):
+        self.assertTrue(self.first.claim("c1"))
+        self.assertFalse(self.second.claim("c1"))
+
+    def test_expired_claim(self):
+        self.assertTrue(self.first.claim("c1"))
+        self.first.release("c1")
+        time.sleep(self.ttl * 1.5)
+        self.assertTrue(self.second.claim("c1"))
+        self.assertFalse(self.first.claim("c1"))
+
+    def test_renewed_claim(self):
+        # the reply is still waiting in the first instance's scheduler
+        self.assertTrue(self.first.claim("c1"))
+        for _ in range(3):
+            time.sleep(self.ttl / 2)
+            self.first.renew()
+        self.assertFalse(self.second.claim("c1"))
+
+    def test_replied_claim(self):
+        self.assertTrue(self.first.claim("c1"))
+        self.first.mark_replied("c1")
+        time.sleep(self.ttl * 1.5)
+        self.assertFalse(self.second.claim("c1"))
+
+    def test_takeover_replay(self):
+        # shard 0 of the first instance stops heartbeating and the second
+        # replays its recent comments, one replied to and one whose reply
+        # is still queued
+        comment_ids = [str(i) for i in range(20)]
+        first_ids = [comment_id for comment_id in comment_ids
+                     if get_shard(comment_id, 2) == 0]
+        sharder = Sharder(self.second, 1, 2)
+        for comment_id in comment_ids:
+            sharder.route(SimpleNamespace(id=comment_id))
+        self.assertTrue(self.first.claim(first_ids[0]))
+        self.first.mark_replied(first_ids[0])
+        self.assertTrue(self.first.claim(first_ids[1]))
+        time.sleep(self.ttl * 1.5)
+        self.first.renew()
+
+        sharder.rebalance({1})
+        replayed = sharder.route(SimpleNamespace(id=comment_ids[0]))
+        replayed_ids = [comment.id for comment in replayed]
+        self.assertEqual(first_ids, replayed_ids[:len(first_ids)])
+        claimed = [comment_id for comment_id in replayed_ids
+                   if self.second.claim(comment_id)]
+        self.assertNotIn(first_ids[0], claimed)
+        self.assertNotIn(first_ids[1], claimed)
+        self.assertIn(first_ids[2], claimed)
+
+
+class CsvReload(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.csv_folder = read_csv_files.CSV_FOLDER
+        read_csv_files.CSV_FOLDER = os.path.join(self.tempdir.name, "csv_files/")
+        shutil.copytree(self.csv_folder, read_csv_files.CSV_FOLDER)
+        self.snapshot_path = os.path.join(self.tempdir.name, "snapshot.json")
+        self.store = TableStore(get_tables(self.snapshot_path))
+        self.watcher = CsvWatcher(self.store, snapshot_path=self.snapshot_path)
+
+    def tearDown(self):
+        read_csv_files.CSV_FOLDER = self.csv_folder
+        self.tempdir.cleanup()
+
+    def write(self, fname, text, mtime):
+        path = read_csv_files.CSV_FOLDER + fname
+        with open(path, "w") as f:
+            f.write(text)
+        os.utime(path, (mtime, mtime))
+
+    def check_twice(self):
+        # changes are only loaded once they stay the same for a whole poll
+        self.watcher.check()
+        return self.watcher.check()
+
+    def test_failed_file_not_stamped(self):
+        old_mtime = self.store.current.csv_mtimes["EnlistedPrefixes.csv"]
+        self.write("EnlistedPrefixes.csv", "K\n", 1000)
+        self.assertFalse(self.check_twice())
+        self.assertEqual("Instructor",
+                         self.store.current.prefix_dict["enlisted"]["K"])
+
+        self.write("OfficerPrefixes.csv", "K,Instructor\n", 2000)
+        self.assertTrue(self.check_twice())
+        csv_mtimes = self.store.current.csv_mtimes
+        self.assertEqual(old_mtime, csv_mtimes["EnlistedPrefixes.csv"])
+        self.assertEqual(2000, csv_mtimes["OfficerPrefixes.csv"])
+        self.assertEqual("Instructor",
+                         self.store.current.prefix_dict["enlisted"]["K"])
+
+        # fixed, and changed again, the file is loaded
+        self.write("EnlistedPrefixes.csv", "K,Teacher\n", 3000)
+        self.assertTrue(self.check_twice())
+        self.assertEqual("Teacher",
+                         self.store.current.prefix_dict["enlisted"]["K"])
+
+
+class CheckpointOrder(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "checkpoint.json")
+        self.checkpoint = StreamCheckpoint(self.path, interval=3600)
+        self.comments = [reddit.add_comment("1W071", "someone", "t3_x", "t3_x",
+                                            created_utc=1000 + i)
+                         for i in range(4)]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def start_all(self):
+        for comment in self.comments:
+            self.checkpoint.start(comment)
+
+    def test_done_out_of_order(self):
+        first, second, third, _ = self.comments
+        self.start_all()
+        self.checkpoint.done(third)
+        self.checkpoint.done(second)
+        self.assertIsNone(self.checkpoint.fullname)
+        self.checkpoint.done(first)
+        self.assertEqual(third.fullname, self.checkpoint.fullname)
+
+    def test_deferred_reply(self):
+        # the first comment's reply is still waiting in the scheduler
+        first, second, _, _ = self.comments
+        self.start_all()
+        self.checkpoint.done(second)
+        self.checkpoint.flush()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(self.checkpoint.seen(second))
+        self.checkpoint.done(first)
+        self.assertEqual(second.fullname, self.checkpoint.fullname)
+
+    def test_replayed_older_comment(self):
+        # a shard taken over replays comments from before the checkpoint
+        first, second, third, fourth = self.comments
+        for comment in (second, third):
+            self.checkpoint.start(comment)
+            self.checkpoint.done(comment)
+        self.checkpoint.start(fourth)
+        self.checkpoint.start(first)
+        self.checkpoint.done(first)
+        self.assertEqual(third.fullname, self.checkpoint.fullname)
+        self.assertTrue(self.checkpoint.seen(first))
+        self.assertFalse(self.checkpoint.seen(fourth))
+        self.checkpoint.done(fourth)
+        self.assertEqual(fourth.fullname, self.checkpoint.fullname)
+
+    def test_flush_and_load(self):
+        first, second, third, fourth = self.comments
+        for comment in (first, second):
+            self.checkpoint.start(comment)
+            self.checkpoint.done(comment)
+        self.checkpoint.flush()
+        loaded = StreamCheckpoint(self.path)
+        self.assertEqual(second.fullname, loaded.fullname)
+        self.assertTrue(loaded.seen(first))
+        self.assertTrue(loaded.seen(second))
+        self.assertFalse(loaded.seen(third))
+
+
+class PipelineStages(unittest.TestCase):
+    def build(self, claims=None):
+        store = TableStore(AFSCTables(full_afsc_dict, prefix_dict))
+        return build_pipeline(store, RepliedIndex(":memory:"), ["AFSCbot"],
+                              claims=claims)
+
+    def names(self, comment_pipeline):
+        return [name for name, _ in comment_pipeline.stages]
+
+    def test_order(self):
+        self.assertEqual(["tables", "age", "author", "quotes", "scan",
+                          "resolve", "dedup", "ancestry", "render"],
+                         self.names(self.build()))
+
+    def test_claim_before_ancestry(self):
+        comment_pipeline = self.build(ClaimStore(":memory:", "first", 60))
+        names = self.names(comment_pipeline)
+        self.assertEqual(names.index("ancestry") - 1, names.index("claim"))
+        self.assertIn("claim", comment_pipeline.stats)
+
+    def test_reply(self):
+        context = self.build().run(top_level_comment("I'm a 1W071"))
+        self.assertEqual(["1W071 = Weather Craftsman [^wiki](https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1)"],
+                         context.reply_text)
+
+    def test_drop(self):
+        comment_pipeline = self.build()
+        self.assertIsNone(comment_pipeline.run(top_level_comment("no job")))
+        self.assertEqual({"calls": 1, "dropped": 1},
+                         {key: comment_pipeline.stats["scan"][key]
+                          for key in ("calls", "dropped")})
+        self.assertEqual(0, comment_pipeline.stats["resolve"]["calls"])
+        report = comment_pipeline.report()
+        self.assertEqual(len(comment_pipeline.stages), len(report))
+        self.assertTrue(report[4].startswith("scan: 1 calls, 1 dropped, "))
+        self.assertEqual("resolve: 0 calls, 0 dropped, 0.000ms avg",
+                         report[5])
+
+    def test_add_and_remove(self):
+        calls = []
+
+        def stage(name, keep=True):
+            return lambda context: calls.append(name) or keep
+
+        comment_pipeline = Pipeline([("a", stage("a")), ("c", stage("c"))])
+        comment_pipeline.add_stage("b", stage("b", keep=False), before="c")
+        self.assertEqual(["a", "b", "c"], self.names(comment_pipeline))
+        self.assertIsNone(comment_pipeline.run(None))
+        self.assertEqual(["a", "b"], calls)
+        comment_pipeline.remove_stage("b")
+        self.assertEqual(["a", "c"], self.names(comment_pipeline))
+        self.assertNotIn("b", comment_pipeline.stats)
+        self.assertIsNotNone(comment_pipeline.run(None))
+        self.assertEqual(["a", "b", "a", "c"], calls)
+
+
+class WorkerIsolation(unittest.TestCase):
+    def setUp(self):
+        self.submitted = []
+        self.done = []
+        scheduler = SimpleNamespace(
+            submit=lambda comment, reply_text: self.submitted.append(
+                comment.body),
+            report=lambda comments_seen: [])
+        checkpoint = SimpleNamespace(
+            start=lambda comment: None, seen=lambda comment: False,
+            done=lambda comment: self.done.append(comment.body))
+        self.pool = WorkerPool(Pipeline([("boom", self.stage)]), scheduler,
+                               workers=2, checkpoint=checkpoint)
+
+    def stage(self, context):
+        if "boom" in context.comment.body:
+            raise ValueError("bad comment")
+        return "1W071" in context.comment.body
+
+    def test_error_drops_one_comment(self):
+        for thread in self.pool.threads:
+            thread.start()
+        for body in ("boom", "1W071", "nothing", "1W071 again"):
+            self.pool.enqueue(top_level_comment(body))
+        self.pool.comments.join()
+        self.assertEqual(["1W071", "1W071 again"], sorted(self.submitted))
+        self.assertEqual(["boom", "nothing"], sorted(self.done))
+        self.assertEqual(set(), self.pool.in_progress)
+
+    def test_stream_restart(self):
+        first, second = top_level_comment("1W071"), top_level_comment("boom")
+        streams = []
+
+        def comments(skip_existing=False):
+            streams.append(skip_existing)
+            if len(streams) == 1:
+                yield first
+                raise ConnectionError("stream dropped")
+            yield second
+            # ends run(), which never returns on its own
+            raise KeyboardInterrupt
+
+        subreddit = SimpleNamespace(display_name="AirForce",
+                                    stream=SimpleNamespace(comments=comments))
+        delay = worker_pool.STREAM_RETRY_DELAY
+        worker_pool.STREAM_RETRY_DELAY = 0
+        try:
+            self.assertRaises(KeyboardInterrupt, self.pool.run, subreddit)
+        finally:
+            worker_pool.STREAM_RETRY_DELAY = delay
+        self.pool.comments.join()
+        self.assertEqual(2, len(streams))
+        self.assertEqual(["1W071"], self.submitted)
+        self.assertEqual(["boom"], self.done)
+
+
+class BatchReplay(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dump = os.path.join(self.tempdir.name, "dump.jsonl.gz")
+        self.out = os.path.join(self.tempdir.name, "replies.jsonl")
+        # missing, so the tables are read from the CSV files
+        self.snapshot = os.path.join(self.tempdir.name, "snapshot.json")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def run_dump(self, lines, **kwargs):
+        with gzip.open(self.dump, "wt") as f:
+            f.write("\n".join(lines) + "\n")
+        stats = run_batch(self.dump, self.out, snapshot_path=self.snapshot,
+                          ignored_authors=["AFSCbot"], **kwargs)
+        with open(self.out) as f:
+            return stats, [json.loads(line) for line in f]
+
+    def comment(self, comment_id, body, parent_id="t3_x", author="someone"):
+        return json.dumps({"id": comment_id, "parent_id": parent_id,
+                           "link_id": "t3_x", "body": body, "author": author,
+                           "subreddit": "AirForce", "created_utc": 0})
+
+    def test_replies(self):
+        stats, replies = self.run_dump([
+            self.comment("a", "I'm a 1W071"),
+            self.comment("b", "me too, 1W071", "t1_a"),
+            "not json",
+            self.comment("c", "1W051 here", "t1_gone"),
+            self.comment("d", "1W071", author="AFSCbot"),
+            self.comment("e", "no numbers")], processes=0)
+        self.assertEqual([("a", True), ("c", False)],
+                         [(reply["id"], reply["complete_thread"])
+                          for reply in replies])
+        self.assertEqual(["1W0X1"], replies[0]["afscs"])
+        self.assertIn("\n\n1W071 = Weather Craftsman\n\n", replies[0]["reply"])
+        self.assertEqual({"comments": 5, "bad_lines": 1,
+                          "comments_with_afscs": 3, "replies": 2,
+                          "already_mentioned": 1, "missing_parents": 1},
+                         {key: value for key, value in stats.to_dict().items()
+                          if key in ("comments", "bad_lines",
+                                     "comments_with_afscs", "replies",
+                                     "already_mentioned", "missing_parents")})
+
+    def test_window(self):
+        lines = [self.comment("a", "I'm a 1W071"),
+                 self.comment("x", "unrelated", "t3_y"),
+                 self.comment("b", "1W071 too", "t1_a")]
+        # with a window of one comment the top comment is gone by the reply
+        stats, replies = self.run_dump(lines, processes=0, window=1)
+        self.assertEqual(["a", "b"], [reply["id"] for reply in replies])
+        self.assertEqual(1, stats.missing_parents)
+        stats, replies = self.run_dump(lines, processes=0, window=3)
+        self.assertEqual(["a"], [reply["id"] for reply in replies])
+        self.assertEqual(1, stats.already_mentioned)
+
+    def test_processes(self):
+        lines = [self.comment("c{}".format(i), "1W0{}1".format(i % 3 * 2 + 3),
+                              "t1_c{}".format(i - 1) if i else "t3_x")
+                 for i in range(10)]
+        _, serial = self.run_dump(lines, processes=0)
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        helper_functions.logger.addHandler(handler)
+        try:
+            _, pooled = self.run_dump(lines, processes=2)
+        finally:
+            helper_functions.logger.removeHandler(handler)
+        self.assertEqual(serial, pooled)
+        # the tables are loaded by this process and by both workers
+        self.assertEqual(3, messages.count(
+            "Snapshot out of date, rebuilding AFSCs"))
+        self.assertEqual(["c0", "c1", "c2"], [reply["id"] for reply in serial])
+
+
+class SubredditRouting(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "subreddits.json")
+        with open(self.path, "w") as f:
+            json.dump({"afrotc": {"max_age": 86400, "wiki_subreddit": ""},
+                       "AirForceRecruits": {"enabled": False}}, f)
+        self.configs = load_subreddit_configs(
+            "AirForce+AFROTC+AirForceRecruits", self.path)
+        self.stores = {}
+        for name, config in self.configs.items():
+            # stands in for the AFSCTables of the subreddit's wiki
+            config.store = self.stores[name] = TableStore(object())
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def route(self, subreddit):
+        comment = reddit.add_comment("1W071", "someone", "t3_x", "t3_x",
+                                     subreddit=subreddit)
+        context = CommentContext(comment)
+        return subreddit_router(self.configs)(context), context
+
+    def test_settings(self):
+        config = self.configs["afrotc"]
+        self.assertEqual(("AFROTC", 86400, None),
+                         (config.name, config.max_age, config.wiki))
+        self.assertEqual(("AirForce", "index"), self.configs["airforce"].wiki)
+
+    def test_stream_name(self):
+        self.assertEqual("AirForce+AFROTC", get_stream_name(self.configs))
+
+    def test_empty(self):
+        self.assertEqual({}, load_subreddit_configs("", self.path))
+        self.assertEqual("", get_stream_name({}))
+        self.assertEqual(["AirForce", "AFROTC"],
+                         [config.name for config in load_subreddit_configs(
+                             "AirForce++AFROTC+", self.path).values()])
+
+    def test_route(self):
+        keep, context = self.route("afrotc")
+        self.assertTrue(keep)
+        self.assertIs(self.configs["afrotc"], context.config)
+        self.assertIs(self.stores["afrotc"].current, context.tables)
+
+    def test_drop(self):
+        for subreddit in ("AirForceRecruits", "AskReddit"):
+            keep, context = self.route(subreddit)
+            self.assertFalse(keep)
+            self.assertIsNone(context.config)
+
+
+class MetricsFormat(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics("test")
+        self.metrics.inc("replies_total")
+        self.metrics.inc("replies_total")
+        self.metrics.inc("matches_total", 3, stage="scan")
+        self.metrics.inc("matches_total", stage="resolve")
+        self.metrics.observe("stage_seconds", 0.003, stage="scan")
+        self.metrics.observe("stage_seconds", 100, stage="scan")
+
+    def test_render(self):
+        lines = self.metrics.render().splitlines()
+        self.assertEqual(["# TYPE test_matches_total counter",
+                          'test_matches_total{stage="resolve"} 1',
+                          'test_matches_total{stage="scan"} 3',
+                          "# TYPE test_replies_total counter",
+                          "test_replies_total 2",
+                          "# TYPE test_stage_seconds histogram"], lines[:6])
+        buckets = [line for line in lines if "_bucket" in line]
+        self.assertEqual(16, len(buckets))
+        self.assertEqual('test_stage_seconds_bucket{stage="scan",le="0.0025"} 0',
+                         buckets[2])
+        self.assertEqual('test_stage_seconds_bucket{stage="scan",le="0.005"} 1',
+                         buckets[3])
+        self.assertEqual('test_stage_seconds_bucket{stage="scan",le="30.0"} 1',
+                         buckets[-2])
+        self.assertEqual('test_stage_seconds_bucket{stage="scan",le="+Inf"} 2',
+                         buckets[-1])
+        self.assertEqual(['test_stage_seconds_sum{stage="scan"} 100.003',
+                          'test_stage_seconds_count{stage="scan"} 2'],
+                         lines[-2:])
+
+    def test_serve(self):
+        server = self.metrics.serve(0)
+        try:
+            with urlopen("http://127.0.0.1:{}/metrics".format(
+                    server.server_address[1])) as response:
+                self.assertEqual(self.metrics.render(),
+                                 response.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TableSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "snapshot.json")
+        self.csv_mtimes = get_csv_mtimes()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_round_trip(self):
+        save_snapshot(self.path, full_afsc_dict, prefix_dict, self.csv_mtimes,
+                      "rev1")
+        self.assertEqual([], [name for name in os.listdir(self.tempdir.name)
+                              if name.endswith(".tmp")])
+        loaded_afscs, loaded_prefixes, wiki_revision = load_snapshot(
+            self.path, self.csv_mtimes)
+        self.assertEqual(full_afsc_dict.to_dict(), loaded_afscs.to_dict())
+        self.assertEqual(prefix_dict, loaded_prefixes)
+        self.assertEqual("rev1", wiki_revision)
+
+    def test_out_of_date(self):
+        self.assertIsNone(load_snapshot(self.path, self.csv_mtimes))
+        save_snapshot(self.path, full_afsc_dict, prefix_dict, self.csv_mtimes,
+                      "rev1")
+        changed = dict(self.csv_mtimes)
+        changed["EnlistedAFSCs.csv"] += 1
+        self.assertIsNone(load_snapshot(self.path, changed))
+        with open(self.path, "w") as f:
+            f.write("{")
+        self.assertIsNone(load_snapshot(self.path, self.csv_mtimes))
+
+    def test_wiki_refresh(self):
+        store = TableStore(AFSCTables(get_AFSCs(None), prefix_dict,
+                                      self.csv_mtimes))
+        refresher = WikiLinkRefresher(reddit, store, snapshot_path=self.path)
+        self.assertEqual("", store.current.full_afsc_dict.enlisted["1W0X1"].link)
+        self.assertTrue(refresher.refresh())
+        tables = store.current
+        self.assertEqual("https://www.reddit.com/r/AirForce/wiki/jobs/1w0x1",
+                         tables.full_afsc_dict.enlisted["1W0X1"].link)
+        self.assertEqual(tables.wiki_revision,
+                         load_snapshot(self.path, self.csv_mtimes)[2])
+        # same revision, nothing is downloaded or published
+        self.assertFalse(refresher.refresh())
+        self.assertIs(tables, store.current)
+
 
 class EnlistedRegexMatch(unittest.TestCase):
     def test_normal_afsc(self):
@@ -496,6 +1252,35 @@ class OfficerRegexMatch(unittest.TestCase):
         self.assertEqual(len(str_matches), 0)
 
 
+class ScannerMatch(unittest.TestCase):
+    def test_same_as_regex_matches(self):
+        comments = ["Q1A371 Q1A1X1 K1B4X1 T1C671",
+                    "13BX, 14NX, and 16GX! What about W11F5H?",
+                    "doesnt matter what caps I use with k1n2x1 or 1C8X2\n\n"
+                    "but it DOES matter what I use with W13BXY. 16f doesn't work.",
+                    "I'm tired of working 12s as a K13SXB...",
+                    "https://www.reddit.com/r/AirForce/wiki/jobs/1a8x1"]
+        for comment in comments:
+            enlisted = break_up_regex(get_enlisted_regex_matches(comment))
+            officer = break_up_regex(get_officer_regex_matches(comment))
+            candidates = AFSC_SCANNER.scan(comment)
+            self.assertEqual(enlisted, break_up_regex(
+                [match for dict_type, match in candidates if dict_type == "enlisted"]))
+            self.assertEqual(officer, break_up_regex(
+                [match for dict_type, match in candidates if dict_type == "officer"]))
+
+    def test_order_and_type(self):
+        comment = "12HX and 1w051"
+        candidates = AFSC_SCANNER.scan(comment)
+        self.assertEqual([dict_type for dict_type, match in candidates],
+                         ["officer", "enlisted"])
+        self.assertEqual(candidates[1][1].group(1), "1w051")
+
+    def test_no_digit(self):
+        comment = "No AFSC in here, just words"
+        self.assertEqual(AFSC_SCANNER.scan(comment), [])
+
+
 """
 Some of these tests may fail because the csv files update.
 In that case, double check if any titles have changed.
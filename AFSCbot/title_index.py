@@ -0,0 +1,282 @@
+import argparse
+import bisect
+import heapq
+import math
+import re
+import time
+from collections import namedtuple
+from process_comment import AFSCMatch, get_base_afsc
+
+# words that say nothing about the job
+STOPWORDS = frozenset(["a", "an", "and", "are", "as", "afsc", "afscs", "do",
+                       "does", "for", "i", "in", "is", "job", "jobs", "my",
+                       "of", "or", "s", "the", "to", "what", "whats",
+                       "which"])
+# a query word shorter than this only matches whole title words
+MIN_PARTIAL_LENGTH = 3
+# share of the weight a word gets for only starting a title word
+PARTIAL_WEIGHT = 0.5
+# AFSCs in the reply to a trigger phrase
+TRIGGER_RESULTS = 3
+# searches remembered, the cache is emptied once it is full
+TITLE_CACHE_SIZE = 10000
+
+# words that ask for a ranking, not a job title
+SUPERLATIVES = ("most", "least", "best", "worst", "better", "worse",
+                "easiest", "hardest", "highest", "lowest")
+
+# "what's the AFSC for weather?", "which AFSC is loadmaster", "what AFSC is
+# cyber", but not "which AFSC is the most fun" or "which AFSC has the best
+# bonus"
+TITLE_TRIGGER_REGEX = (r"\b(?:what(?:'s|s|\s+is)?|which)\s+(?:the\s+|an?\s+)?"
+                       r"afsc\s+(?:is\s+)?(?:for\s+)?(?:an?\s+|the\s+)?"
+                       r"(?!(?:\w+\s+)?(?:the\s+)?(?:" + "|".join(SUPERLATIVES) +
+                       r")\b)([^?.!,\n]{2,60})")
+TITLE_TRIGGER_SEARCH = re.compile(TITLE_TRIGGER_REGEX, re.IGNORECASE)
+
+WORD_SEARCH = re.compile(r"[a-z0-9]+")
+
+
+class TitleMatch(namedtuple("TitleMatch", ["dict_type", "prefix", "afsc",
+                                           "suffix", "title", "score"])):
+    """
+    A single reverse lookup result. prefix and suffix are "" unless the
+    query named a prefix title or a shred.
+    """
+    __slots__ = ()
+
+    def code(self):
+        """
+        :return: the AFSC as it is printed, "K1A1X1B" for example
+        """
+        return self.prefix + self.afsc + self.suffix
+
+
+def get_words(text):
+    """
+    :param text: job title or query
+    :return: list of the lowercase words of text, without plural s
+    """
+    words = []
+    for word in WORD_SEARCH.findall(text.lower()):
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    return words
+
+
+class TitleIndex:
+    """
+    Inverted index from the words of the job and shred titles to the AFSCs
+    that have them, built once with the AFSCTables. Each query word is a
+    dict lookup, and a word that isn't in any title falls back to the
+    title words it starts, found by bisecting the sorted words. Rarer
+    words weigh more, and results that match every query word with the
+    fewest extra title words rank first. The same few jobs are asked about
+    over and over, so results are cached by query words.
+    """
+
+    def __init__(self, full_afsc_dict, prefix_dict):
+        """
+        :param full_afsc_dict: AFSCTable used for afsc lookups
+        :param prefix_dict: dict used for prefix lookups
+        """
+        start = time.perf_counter()
+        self.prefix_dict = prefix_dict
+        # (query words, limit, require_all) -> list of TitleMatch
+        self.cache = {}
+        # (dict_type, base afsc, suffix, title, number of distinct words)
+        self.entries = []
+        # dict type -> word -> list of entry ids
+        self.postings = {}
+        for dict_type in ("enlisted", "officer"):
+            postings = self.postings[dict_type] = {}
+            for base_afsc, record in full_afsc_dict.partition(
+                    dict_type).items():
+                self.add(postings, dict_type, base_afsc, "", record.title)
+                for shred_char, shred_title in record.shreds:
+                    self.add(postings, dict_type, base_afsc, shred_char,
+                             record.title + ", " + shred_title)
+        # dict type -> sorted words, for the partial word matches
+        self.words = {dict_type: sorted(postings)
+                      for dict_type, postings in self.postings.items()}
+        self.weights = {}
+        for postings in self.postings.values():
+            for word, ids in postings.items():
+                self.weights[word] = self.weights.get(word, 0) + len(ids)
+        for word, count in self.weights.items():
+            self.weights[word] = math.log(len(self.entries) / count) + 1
+        # dict type -> word -> list of (prefix title words, prefix char) of
+        # the prefix titles with the word
+        self.prefix_titles = {}
+        for dict_type, prefixes in prefix_dict.items():
+            titles = self.prefix_titles[dict_type] = {}
+            for prefix, title in sorted(prefixes.items()):
+                title_words = frozenset(get_words(title)) - STOPWORDS
+                for word in title_words:
+                    titles.setdefault(word, []).append((title_words, prefix))
+        self.build_time = time.perf_counter() - start
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, postings, dict_type, base_afsc, suffix, title):
+        words = set(get_words(title)) - STOPWORDS
+        entry_id = len(self.entries)
+        self.entries.append((dict_type, base_afsc, suffix, title, len(words)))
+        for word in words:
+            postings.setdefault(word, []).append(entry_id)
+
+    def get_prefix(self, dict_type, words):
+        """
+        :param words: set of query words
+        :return: tuple of the prefix char whose title is among the words,
+        "" if none, and the words left once that title is taken out
+        """
+        best = ("", words)
+        titles = self.prefix_titles.get(dict_type, {})
+        for word in words:
+            for title_words, prefix in titles.get(word, ()):
+                # the longest title wins, "flight instructor" over
+                # "instructor"
+                if (title_words < words
+                        and len(title_words) > len(words) - len(best[1])):
+                    best = (prefix, words - title_words)
+        return best
+
+    def match_word(self, dict_type, word):
+        """
+        :return: list of (entry ids, weight) tuples of the title words
+        matching word, the word itself or else the title words it starts
+        """
+        postings = self.postings[dict_type]
+        ids = postings.get(word)
+        if ids is not None:
+            return [(ids, self.weights[word])]
+        if len(word) < MIN_PARTIAL_LENGTH:
+            return []
+        words = self.words[dict_type]
+        matches = []
+        i = bisect.bisect_left(words, word)
+        while i < len(words) and words[i].startswith(word):
+            matches.append((postings[words[i]],
+                            self.weights[words[i]] * PARTIAL_WEIGHT))
+            i += 1
+        return matches
+
+    def search(self, query, limit=5, require_all=False):
+        """
+        :param query: words of a job title, "loadmaster" or "c-17 loadmaster"
+        :param limit: maximum number of results
+        :param require_all: only return AFSCs matching every query word
+        :return: list of TitleMatch, best first
+        """
+        query_words = frozenset(get_words(query)) - STOPWORDS
+        key = (query_words, limit, require_all)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        if len(self.cache) >= TITLE_CACHE_SIZE:
+            self.cache.clear()
+        results = self.cache[key] = self.rank(query_words, limit,
+                                              require_all)
+        return results
+
+    def rank(self, query_words, limit, require_all):
+        """
+        search without the cache.
+        :param query_words: frozenset of the query words
+        """
+        ranked = []
+        prefixes = {}
+        for dict_type in self.postings:
+            prefix, words = self.get_prefix(dict_type, query_words)
+            prefixes[dict_type] = prefix
+            scores = {}
+            matched = {}
+            for word in words:
+                matches = self.match_word(dict_type, word)
+                # a title with several words starting with word counts once
+                seen = set() if len(matches) > 1 else None
+                for ids, weight in matches:
+                    for entry_id in ids:
+                        if seen is not None:
+                            if entry_id in seen:
+                                continue
+                            seen.add(entry_id)
+                        scores[entry_id] = scores.get(entry_id, 0) + weight
+                        matched[entry_id] = matched.get(entry_id, 0) + 1
+            for entry_id, score in scores.items():
+                if require_all and matched[entry_id] < len(words):
+                    continue
+                # title words the query didn't ask for make a match less
+                # exact
+                extra = self.entries[entry_id][4] - matched[entry_id]
+                ranked.append((-score / (1 + 0.2 * extra), entry_id))
+
+        results = []
+        for score, entry_id in heapq.nsmallest(limit, ranked):
+            dict_type, base_afsc, suffix, title, _ = self.entries[entry_id]
+            prefix = prefixes[dict_type]
+            if prefix:
+                title = self.prefix_dict[dict_type][prefix] + " " + title
+            results.append(TitleMatch(dict_type, prefix, base_afsc, suffix,
+                                      title, round(-score, 3)))
+        return results
+
+    def candidates(self, query, limit=TRIGGER_RESULTS):
+        """
+        Looks up the AFSCs asked for in a comment, as candidates for the
+        rest of the pipeline.
+        :param query: job title asked for, from TITLE_TRIGGER_SEARCH
+        :param limit: maximum number of AFSCs
+        :return: list of (dict_type, AFSCMatch) tuples of the AFSCs
+        matching every word of the query
+        """
+        candidates = []
+        # some of the results may be left out below
+        for result in self.search(query, limit * 2, require_all=True):
+            if len(candidates) == limit:
+                break
+            afsc = result.afsc
+            if result.dict_type == "enlisted":
+                skill_level = afsc[3]
+            else:
+                skill_level = "X" if afsc.endswith("X") else ""
+            # AFSCs the reply lines can't be built for are left out
+            if get_base_afsc(afsc, skill_level, result.dict_type)[1] != afsc:
+                continue
+            candidates.append((result.dict_type, AFSCMatch(
+                result.code(), result.prefix, afsc, skill_level,
+                result.suffix)))
+        return candidates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Finds the AFSCs of a job "
+                                                 "title")
+    parser.add_argument("query", nargs="+", help="words of the job title")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    # imported here, read_csv_files needs this module through afsc_tables
+    import logging
+    import helper_functions
+    from read_csv_files import get_tables
+    helper_functions.logger.setLevel(logging.WARNING)
+    title_index = get_tables().title_index
+
+    start = time.perf_counter()
+    results = title_index.search(" ".join(args.query), args.limit)
+    elapsed = time.perf_counter() - start
+    for result in results:
+        print("{:8} {:6.3f}  {}".format(result.code(), result.score,
+                                         result.title))
+    print("{} results in {:.1f}us, index of {} titles built in {:.1f}ms"
+          .format(len(results), elapsed * 1e6, len(title_index),
+                  title_index.build_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
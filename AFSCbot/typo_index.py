@@ -0,0 +1,212 @@
+import re
+import threading
+import time
+from helper_functions import log_debug
+from process_comment import CorrectedMatch, get_base_afsc
+
+# typos further than this from every AFSC are never corrected
+MAX_TYPO_DISTANCE = 2
+# near miss lookups remembered, the cache is emptied once it is full
+TYPO_CACHE_SIZE = 10000
+# comments with more near misses than this are treated as noise, serial or
+# part numbers for example, and get no corrections at all
+MAX_TYPOS = 2
+
+# bare codes that could be a mistyped enlisted AFSC: 4 to 6 characters,
+# starting with a digit, not part of a longer word, path or number
+TYPO_TOKEN_REGEX = r"(?<![\w/.-])(\d[A-Z0-9]{3,5})(?![\w/-])"
+TYPO_TOKEN_SEARCH = re.compile(TYPO_TOKEN_REGEX, re.IGNORECASE)
+# officer AFSCs start with 2 digits, "13BX", enlisted ones don't
+OFFICER_SHAPE = re.compile(r"\d\d[A-Z]")
+
+# letters often typed in place of a digit
+DIGIT_LOOKALIKES = str.maketrans("OIL", "011")
+# positions of an enlisted AFSC that are always digits, "1W0X1"
+DIGIT_POSITIONS = (0, 2, 4)
+
+
+def get_deletions(code, max_distance):
+    """
+    :param code: uppercase string
+    :param max_distance: maximum number of characters deleted
+    :return: set of every string left after deleting up to max_distance
+    characters of code, code itself included
+    """
+    deletions = {code}
+    current = {code}
+    for _ in range(max_distance):
+        current = {word[:i] + word[i + 1:]
+                   for word in current for i in range(len(word))}
+        deletions |= current
+    return deletions
+
+
+def get_edit_distance(a, b, max_distance):
+    """
+    :return: number of insertions, deletions, substitutions and swaps of
+    adjacent characters turning a into b, max_distance + 1 if it is more
+    than max_distance
+    """
+    if len(a) == len(b):
+        # most typos are a single substitution or swap, no table needed
+        mismatches = [i for i in range(len(a)) if a[i] != b[i]]
+        if len(mismatches) <= 1:
+            return len(mismatches)
+        if (len(mismatches) == 2 and mismatches[1] == mismatches[0] + 1
+                and a[mismatches[0]] == b[mismatches[1]]
+                and a[mismatches[1]] == b[mismatches[0]]):
+            return 1
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2]
+                    and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+def normalize_token(token):
+    """
+    Fixes the letters typed in place of a digit and swaps the skill level
+    of a 5 character code for an X, "1WO51" becomes ("1W0X1", "5").
+    :param token: uppercase token from TYPO_TOKEN_SEARCH
+    :return: tuple of the code to look up and the skill level, "" if the
+    token has none
+    """
+    if len(token) != 5:
+        return token, ""
+    chars = list(token)
+    for i in DIGIT_POSITIONS:
+        chars[i] = chars[i].translate(DIGIT_LOOKALIKES)
+    chars[3] = chars[3].replace("O", "0")
+    skill_level = chars[3] if chars[3] in "13579" else ""
+    if skill_level:
+        chars[3] = "X"
+    return "".join(chars), skill_level
+
+
+class TypoIndex:
+    """
+    Deletion index of the enlisted base AFSCs. Every string left after
+    deleting up to max_distance characters of an AFSC points back to it,
+    so the AFSCs near a typo are found by looking up the typo's own
+    deletions, a few dozen dict lookups instead of a scan over every AFSC.
+    Only enlisted AFSCs are indexed, officer AFSCs are too short for a
+    near miss to mean anything. The index is shared by the worker threads,
+    the cache is only touched under its lock.
+    """
+
+    def __init__(self, afscs, max_distance=1):
+        """
+        :param afscs: enlisted partition of the AFSCTable
+        :param max_distance: maximum edit distance of a correction, 1 or 2
+        """
+        start = time.perf_counter()
+        self.afscs = afscs
+        self.max_distance = min(max_distance, MAX_TYPO_DISTANCE)
+        self.deletions = {}
+        # code -> nearest base AFSC or None, most typos are made again
+        self.cache = {}
+        self.lock = threading.Lock()
+        for base_afsc in afscs:
+            for deletion in get_deletions(base_afsc, self.max_distance):
+                self.deletions.setdefault(deletion, []).append(base_afsc)
+        self.build_time = time.perf_counter() - start
+
+    def nearest(self, code):
+        """
+        :param code: uppercase code with the skill level as an X
+        :return: the only base AFSC nearest to code within max_distance,
+        None if there is none or several are as near
+        """
+        if code in self.afscs:
+            return code
+        with self.lock:
+            try:
+                return self.cache[code]
+            except KeyError:
+                pass
+        best = self.find_nearest(code)
+        with self.lock:
+            if len(self.cache) >= TYPO_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[code] = best
+        return best
+
+    def find_nearest(self, code):
+        best = None
+        best_distance = self.max_distance + 1
+        tied = False
+        seen = set()
+        for deletion in get_deletions(code, self.max_distance):
+            for base_afsc in self.deletions.get(deletion, ()):
+                if base_afsc in seen:
+                    continue
+                seen.add(base_afsc)
+                distance = get_edit_distance(code, base_afsc,
+                                             self.max_distance)
+                if distance < best_distance:
+                    best, best_distance, tied = base_afsc, distance, False
+                elif distance == best_distance:
+                    tied = True
+                    if distance == 1:
+                        # nothing but the code itself is nearer
+                        break
+            if tied and best_distance == 1:
+                break
+        if tied:
+            log_debug("%s is as near to several AFSCs, skipping", code)
+            return None
+        return best
+
+    def correct(self, formatted_comment, candidates):
+        """
+        Finds the near misses of enlisted AFSCs in a comment. Codes that
+        are already valid candidates, that are ambiguous, or that would
+        correct to an AFSC the comment already mentions are left alone.
+        :param formatted_comment: string not including any quoted text
+        :param candidates: list of the resolved (dict_type, AFSCMatch)
+        tuples of the comment
+        :return: list of ("enlisted", CorrectedMatch) tuples, empty if the
+        comment has more than MAX_TYPOS near misses
+        """
+        known = set(match.group(1).upper() for _, match in candidates)
+        mentioned = set(get_base_afsc(match.group(3).upper(),
+                                      match.group(4).upper(), dict_type)[1]
+                        for dict_type, match in candidates)
+        corrections = []
+        for token in TYPO_TOKEN_SEARCH.findall(formatted_comment):
+            token = token.upper()
+            if (token in known or sum(char.isdigit() for char in token) < 2
+                    or token.isdigit() or OFFICER_SHAPE.match(token)):
+                continue
+            known.add(token)
+            code, skill_level = normalize_token(token)
+            base_afsc = self.nearest(code)
+            if base_afsc is None or base_afsc in mentioned:
+                continue
+            if (len(code) == len(base_afsc) == 5
+                    and code[3] != base_afsc[3]):
+                # a skill level on an AFSC without them, "9A250" for 9A200
+                continue
+            mentioned.add(base_afsc)
+            afsc = base_afsc
+            if skill_level:
+                afsc = base_afsc[:3] + skill_level + base_afsc[4:]
+            log_debug("Corrected %s to %s", token, afsc)
+            corrections.append(("enlisted", CorrectedMatch(
+                token, "", afsc, skill_level or afsc[3], "")))
+            if len(corrections) > MAX_TYPOS:
+                log_debug("Too many near misses, skipping corrections")
+                return []
+        return corrections
@@ -0,0 +1,105 @@
+import threading
+from afsc_tables import AFSCTables
+from helper_functions import print_and_log
+from read_csv_files import (get_wiki_revision, get_wiki_links,
+                            save_snapshot, SNAPSHOT_FILE, WIKI_SUBREDDIT,
+                            WIKI_PAGE)
+
+# how often the wiki is checked for a new revision, in seconds
+WIKI_TTL = 3600
+# how long to wait after a failed refresh before trying again, in seconds
+WIKI_RETRY_DELAY = 60
+
+
+class WikiLinkRefresher(threading.Thread):
+    """
+    Background thread keeping the wiki links of the AFSC tables up to date.
+    Every ttl seconds it checks the latest wiki revision, and only when it
+    changed the page is downloaded and parsed. New tables with the new
+    links are then published to the TableStore, so the comment stream is
+    never blocked by the wiki.
+    """
+
+    def __init__(self, reddit, store, ttl=WIKI_TTL,
+                 snapshot_path=SNAPSHOT_FILE, wiki_subreddit=WIKI_SUBREDDIT,
+                 wiki_page=WIKI_PAGE):
+        """
+        :param reddit: PRAW reddit object
+        :param store: TableStore the new tables are published to
+        :param ttl: seconds between revision checks
+        :param snapshot_path: path of the snapshot file updated with the
+        new links, None to not write a snapshot
+        :param wiki_subreddit: subreddit whose wiki has the links
+        :param wiki_page: name of the wiki page with the links
+        """
+        super().__init__(name="WikiLinkRefresher-" + wiki_subreddit,
+                         daemon=True)
+        self.reddit = reddit
+        self.store = store
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.wiki_subreddit = wiki_subreddit
+        self.wiki_page = wiki_page
+        self.stopped = threading.Event()
+
+    def run(self):
+        delay = 0
+        while not self.stopped.wait(delay):
+            try:
+                self.refresh()
+                delay = self.ttl
+            except Exception as e:
+                print_and_log("Couldn't refresh wiki links, {}".format(e),
+                              error=True)
+                delay = WIKI_RETRY_DELAY
+
+    def stop(self):
+        self.stopped.set()
+
+    def refresh(self):
+        """
+        Checks the wiki revision and publishes new tables if it changed.
+        :return: True if new tables were published
+        """
+        wiki_revision = get_wiki_revision(self.reddit, self.wiki_subreddit,
+                                          self.wiki_page)
+        if wiki_revision == self.store.current.wiki_revision:
+            return False
+
+        wiki_page = self.reddit.subreddit(self.wiki_subreddit).wiki[
+            self.wiki_page]
+        links = get_wiki_links(wiki_page.content_html, self.wiki_subreddit)
+        self.store.update(lambda current: self.build(current, links,
+                                                     wiki_revision))
+        print_and_log("Loaded {} wiki links from /r/{} revision {}".format(
+            len(links), self.wiki_subreddit, wiki_revision))
+        return True
+
+    def build(self, current, links, wiki_revision):
+        """
+        Builds the new tables and writes them to the snapshot file. Runs
+        under the TableStore lock, so snapshots are never written at the
+        same time.
+        """
+        tables = with_links(current, links, wiki_revision)
+        if self.snapshot_path is not None:
+            try:
+                save_snapshot(self.snapshot_path, tables.full_afsc_dict,
+                              tables.prefix_dict, tables.csv_mtimes,
+                              tables.wiki_revision)
+            except OSError as e:
+                print_and_log("Couldn't save snapshot, {}".format(e),
+                              error=True)
+        return tables
+
+
+def with_links(tables, links, wiki_revision):
+    """
+    Builds a copy of tables with the given wiki links, tables is unchanged.
+    :param tables: current AFSCTables
+    :param links: dict mapping base AFSC to link, see get_wiki_links
+    :param wiki_revision: wiki revision id the links were taken from
+    :return: new AFSCTables
+    """
+    return AFSCTables(tables.full_afsc_dict.with_links(links),
+                      tables.prefix_dict, tables.csv_mtimes, wiki_revision)
@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+import traceback
+from helper_functions import print_and_log
+from metrics import METRICS
+
+# number of worker threads processing comments
+WORKERS = 4
+# maximum number of streamed comments waiting for a worker
+QUEUE_SIZE = 100
+# how long to wait before restarting the stream after an error, in seconds
+STREAM_RETRY_DELAY = 10
+# how often, in streamed comments, the pipeline stats are logged
+STATS_INTERVAL = 100
+
+
+class WorkerPool:
+    """
+    One producer, the thread calling run(), reads the comment stream into
+    a bounded queue and a pool of worker threads processes the comments.
+    When every worker is busy and the queue is full the producer waits,
+    which keeps the backlog bounded. Each comment is processed in its own
+    try block, so an error only drops that comment. Workers share the
+    read-only AFSC tables through the TableStore without locking. They
+    also share the stream's praw.Reddit, whose requests are serialized by
+    setup_bot.SerialRequestor, so only the local work and the waits
+    between requests run in parallel.
+    """
+
+    def __init__(self, comment_pipeline, scheduler, workers=WORKERS,
+                 queue_size=QUEUE_SIZE, checkpoint=None, sharder=None):
+        """
+        :param comment_pipeline: Pipeline from build_pipeline
+        :param scheduler: ReplyScheduler the replies are submitted to
+        :param workers: number of worker threads
+        :param queue_size: maximum number of comments waiting for a worker
+        :param checkpoint: optional StreamCheckpoint, comments at or before
+        it are skipped. Comments with a reply are marked done by the
+        scheduler's on_done.
+        :param sharder: optional Sharder, only the comments of the shards
+        it owns are processed
+        """
+        self.comment_pipeline = comment_pipeline
+        self.scheduler = scheduler
+        self.checkpoint = checkpoint
+        self.sharder = sharder
+        self.comments = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self.work, daemon=True,
+                                         name="Worker-{}".format(i))
+                        for i in range(workers)]
+        # ids of queued or running comments, so each one is processed once
+        self.in_progress = set()
+        self.in_progress_lock = threading.Lock()
+
+    def run(self, subreddit, skip_existing=False):
+        """
+        Starts the workers and streams comments into the queue forever.
+        :param subreddit: PRAW subreddit to stream comments from
+        :param skip_existing: skip the comments made before the stream
+        started
+        """
+        for thread in self.threads:
+            thread.start()
+        print_and_log("Starting processing loop for subreddit: {} with {} "
+                      "workers".format(subreddit.display_name,
+                                       len(self.threads)))
+
+        comments_seen = 0
+        while True:
+            try:
+                for streamed in METRICS.timed(
+                        subreddit.stream.comments(skip_existing=skip_existing),
+                        "stream_fetch_seconds"):
+                    if (self.checkpoint is not None
+                            and self.checkpoint.seen(streamed)):
+                        METRICS.inc("checkpoint_skipped_total")
+                        continue
+                    if self.sharder is None:
+                        comments = [streamed]
+                    else:
+                        comments = self.sharder.route(streamed)
+                    for comment in comments:
+                        self.enqueue(comment)
+
+                    comments_seen += 1
+                    if comments_seen % STATS_INTERVAL == 0:
+                        print_and_log("Comments streamed since start of "
+                                      "script: {}, queued: {}".format(
+                                          comments_seen, self.comments.qsize()))
+                        for line in self.comment_pipeline.report():
+                            print_and_log(line)
+                        for line in self.scheduler.report(comments_seen):
+                            print_and_log(line)
+            except Exception as err:
+                print_and_log("Comment stream failed, restarting, {}".format(
+                    err), error=True)
+                time.sleep(STREAM_RETRY_DELAY)
+
+    def enqueue(self, comment):
+        """
+        Queues a comment for the workers, blocks while the queue is full.
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.start(comment)
+        with self.in_progress_lock:
+            if comment.id in self.in_progress:
+                return
+            self.in_progress.add(comment.id)
+        self.comments.put(comment)
+
+    def work(self):
+        while True:
+            comment = self.comments.get()
+            try:
+                if not self.process(comment):
+                    self.done(comment)
+            except Exception:
+                print_and_log("Error processing comment {}\n{}".format(
+                    comment.id, traceback.format_exc()), error=True)
+                self.done(comment)
+            finally:
+                with self.in_progress_lock:
+                    self.in_progress.discard(comment.id)
+                self.comments.task_done()
+
+    def done(self, comment):
+        """
+        Called for the comments that got no reply.
+        """
+        if self.sharder is not None:
+            self.sharder.store.release(comment.id)
+        if self.checkpoint is not None:
+            self.checkpoint.done(comment)
+
+    def process(self, comment):
+        """
+        :param comment: PRAW comment to process
+        :return: True if a reply was queued
+        """
+        context = self.comment_pipeline.run(comment)
+        if context is None:
+            return False
+        print_and_log("Preparing to reply to id {} by author: {}".format(
+            comment.id, comment.author))
+        self.scheduler.submit(comment, context.reply_text)
+        return True